@@ -0,0 +1,468 @@
+"""Benchmarks for the storm pipeline stages and the scraper parser.
+
+The stage and parser benchmarks run on synthetic frames and pages so
+no database connection is needed. The suite loads synthetic hydromet
+(synthetic_hydromet.py) into a scratch database on the local Postgres
+and times the ingest path and the pipeline end to end. Every suite run
+is appended to benchmarks/history.jsonl and compared with the previous
+runs of the same scale, layout and host, so regressions show up.
+
+optional arguments:
+python benchmarks.py [rows rows ...]
+defaults to 10k, 1M and 10M rows
+
+python benchmarks.py parse [record_dir]
+times the chronhist table parsers on the pages recorded by
+HLFormScraper(record_dir=...), or on a synthetic 179 day page
+
+python benchmarks.py suite [scale] [layout] [database]
+scale small, medium or large (default small), layout plain,
+partitioned or encoded (default partitioned), database is dropped
+and recreated (default hl_bench). Exits 1 on a regression.
+"""
+
+import os
+import json
+import socket
+import subprocess
+from collections import OrderedDict
+from datetime import datetime
+from glob import glob
+import numpy as np
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from time import time
+from sys import argv
+
+from storm_pipeline import (create_moving_sum, define_storm_events,
+                            aggregate_rain_data_by_storm)
+from hl_http_scraping import parse_chronhist_table
+from sql_class import (ManipulateDatabase, HydrometLoader, ConnectionPool,
+                       set_pool)
+from synthetic_hydromet import SyntheticHydromet
+
+
+# Rows above this are too slow for the iterrows engine, its time is
+# extrapolated from a run on the first LEGACY_ROW_CAP rows instead
+LEGACY_ROW_CAP = 10000
+
+# Time ranges of synthetic hydromet the suite loads, every registry
+# gauge at 15 minutes is about 2M readings a year
+SCALES = OrderedDict([('small', ('2012-01-01', '2012-02-01')),
+                      ('medium', ('2012-01-01', '2013-01-01')),
+                      ('large', ('2008-01-01', '2018-01-01'))])
+LAYOUTS = ('plain', 'partitioned', 'encoded')
+
+# The per-storm query path runs on this many storms, its time is
+# extrapolated to all of them
+LOOP_STORM_CAP = 100
+
+HISTORY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, 'benchmarks', 'history.jsonl')
+# A benchmark regressed when it is slower than the median of the last
+# HISTORY_WINDOW comparable runs by REGRESSION_TOLERANCE and by at
+# least REGRESSION_FLOOR seconds. Runs on one machine vary by a third
+# or more, so nothing is judged before HISTORY_MIN_RUNS runs and
+# short timings are ignored.
+HISTORY_WINDOW = 5
+HISTORY_MIN_RUNS = 3
+REGRESSION_TOLERANCE = 0.5
+REGRESSION_FLOOR = 0.1
+
+
+def synthetic_max_precip(n_rows, seed=0):
+    """Returns a DataFrame shaped like the query_max_precip result
+
+    [collection_time | Rain (inches)] at 15 minute spacing, mostly
+    zeros with short bursts of rain and a few missing readings
+    """
+    rng = np.random.RandomState(seed)
+    times = pd.date_range('1950-01-01', periods=n_rows, freq='15min')
+    rain = np.zeros(n_rows)
+    raining = rng.random_sample(n_rows) < 0.03
+    rain[raining] = np.round(rng.exponential(0.08, raining.sum()), 2)
+    rain[rng.random_sample(n_rows) < 0.001] = np.nan
+
+    # Query results are not ordered by time
+    order = rng.permutation(n_rows)
+    return pd.DataFrame({'collection_time': times[order],
+                         'Rain (inches)': rain[order]},
+                        columns=['collection_time', 'Rain (inches)'])
+
+
+def bench_moving_sum(n_rows, leading_hours=10, trailing_hours=24):
+    """Times both create_moving_sum engines on n_rows rows
+
+    Returns dict of seconds for each engine and whether the results
+    agree on the rows both engines ran on
+    """
+    df = synthetic_max_precip(n_rows)
+
+    start = time()
+    fast = create_moving_sum(df.copy(), leading_hours, trailing_hours)
+    fast_secs = time() - start
+
+    legacy_rows = min(n_rows, LEGACY_ROW_CAP)
+    legacy_df = df.iloc[:legacy_rows].copy()
+    start = time()
+    legacy = create_moving_sum(legacy_df, leading_hours, trailing_hours,
+                               engine='iterrows')
+    legacy_secs = (time() - start) * n_rows / float(legacy_rows)
+
+    check = create_moving_sum(df.iloc[:legacy_rows].copy(),
+                              leading_hours, trailing_hours)
+    match = np.allclose(check, legacy)
+
+    return {'rows': n_rows,
+            'searchsorted': fast_secs,
+            'iterrows': legacy_secs,
+            'iterrows_estimated': legacy_rows < n_rows,
+            'match': match}
+
+
+def bench_storm_events(n_rows, threshold=0.5):
+    """Times define_storm_events on a moving sum of n_rows rows
+
+    Returns dict of seconds and number of storms found
+    """
+    df = synthetic_max_precip(n_rows)
+    df['moving_rain_sum'] = create_moving_sum(df, 10, 24)
+
+    start = time()
+    storms = define_storm_events(df, threshold=threshold)
+    return {'rows': n_rows,
+            'seconds': time() - start,
+            'storms': len(storms)}
+
+
+def synthetic_chronhist_page(n_rows, sensors=('Rain (inches)',
+                                               'Lake Level (ft above MSL)'),
+                             tbody=False, seed=0):
+    """Returns html shaped like a chronhist result page
+
+    Form state and gauge options around a result table of n_rows
+    15 minute rows, a sensor per column, some cells empty (&nbsp;).
+    tbody adds the tbody a browser's page_source has.
+    """
+    rng = np.random.RandomState(seed)
+    times = pd.date_range('2015-05-01', periods=n_rows, freq='15min')
+    values = np.round(rng.random_sample((n_rows, len(sensors))) * 700, 2)
+    empty = rng.random_sample(values.shape) < 0.02
+
+    parts = ['<html><head><title>Historical Data</title></head><body>',
+             '<form method="post" action="chronhist.aspx">',
+             '<input type="hidden" name="__VIEWSTATE" value="{}" />'.format(
+                 'x' * 60000),
+             '<select name="DropDownList1">']
+    parts.extend('<option value="{0}">Gauge {0}</option>'.format(i)
+                 for i in xrange(275))
+    parts.append('</select>')
+    parts.append('<table border="1"><tbody>' if tbody else
+                 '<table border="1">')
+    parts.append('<tr><th>Date - Time</th>{}</tr>'.format(
+        ''.join('<th>{}</th>'.format(sensor) for sensor in sensors)))
+    for stamp, row, missing in zip(times.strftime('%m/%d/%Y %H:%M'),
+                                   values, empty):
+        cells = ''.join('<td>&nbsp;</td>' if gone else
+                        '<td>{}</td>'.format(value)
+                        for value, gone in zip(row, missing))
+        parts.append('<tr><td>{}</td>{}</tr>'.format(stamp, cells))
+    parts.append('</tbody></table>' if tbody else '</table>')
+    parts.append('</form></body></html>')
+    return ''.join(parts)
+
+
+def bench_parse_table(pages, gauge='3963'):
+    """Times both parse_chronhist_table engines over pages
+
+    Returns dict of seconds for each engine, readings parsed and
+    whether the engines agree on every page
+    """
+    start = time()
+    fast = [parse_chronhist_table(page, gauge) for page in pages]
+    fast_secs = time() - start
+
+    start = time()
+    legacy = [parse_chronhist_table(page, gauge, engine='bs4')
+              for page in pages]
+    legacy_secs = time() - start
+
+    match = all(_same_readings(a, b) for a, b in zip(fast, legacy))
+    return {'pages': len(pages),
+            'readings': sum(len(rows) for rows in fast if rows),
+            'lxml': fast_secs,
+            'bs4': legacy_secs,
+            'match': match}
+
+
+def _same_readings(fast, legacy):
+    """The bs4 engine keeps timestamps as the page's strings"""
+    if fast is None or legacy is None:
+        return fast is None and legacy is None
+    if len(fast) != len(legacy):
+        return False
+    stamps = pd.to_datetime([row[0] for row in legacy])
+    return all(a[0] == stamp and a[1:] == b[1:]
+               for a, b, stamp in zip(fast, legacy, stamps))
+
+
+def run_suite(scale='small', layout='partitioned', database='hl_bench',
+              seed=0, threshold=0.5):
+    """Loads synthetic hydromet into a scratch database and times
+    the ingest path and the storm pipeline on it
+
+    INPUT:
+        scale       | key of SCALES
+        layout      | 'plain', 'partitioned' or 'encoded' hydromet
+        database    | local database to drop and recreate
+        threshold   | storm threshold of define_storm_events
+
+    OUTPUT:
+        dict    | {scale | layout | rows | storms | match | seconds}
+                  seconds is {benchmark: seconds} in run order, match
+                  whether the bulk, rollup and index aggregates agree
+    """
+    if scale not in SCALES:
+        raise ValueError("Unknown scale: {}".format(scale))
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: {}".format(layout))
+    start, end = SCALES[scale]
+    synthetic = SyntheticHydromet(start, end, seed=seed)
+
+    seconds = OrderedDict()
+    pool = _scratch_database(database)
+    # The pipeline functions take their connections from get_pool
+    previous = set_pool(pool)
+    try:
+        with ManipulateDatabase(pool=pool) as md:
+            _create_layout(md, layout, pd.Timestamp(start).year,
+                           pd.Timestamp(end).year)
+            seconds['generate'], seconds['ingest'], rows = \
+                _ingest(md, synthetic)
+            # Statistics were gathered on the empty table, the storm
+            # query plans need them current
+            _, seconds['analyze'] = _timed(md.create_indexes)
+            _, seconds['rollups'] = _timed(md.create_rollup_tables)
+            df, seconds['max_precip_query'] = _timed(
+                lambda: pd.concat(list(md.iter_max_precip()),
+                                  ignore_index=True))
+
+        moving, seconds['moving_sum'] = _timed(create_moving_sum, df, 10, 24)
+        df['moving_rain_sum'] = moving
+        storms, seconds['storm_events'] = _timed(define_storm_events, df,
+                                                 threshold=threshold)
+
+        aggregates = {}
+        for method in ('bulk', 'rollup', 'index'):
+            aggregates[method], seconds['aggregate_' + method] = _timed(
+                aggregate_rain_data_by_storm, storms, method=method)
+        sample = storms[:LOOP_STORM_CAP]
+        _, loop_secs = _timed(aggregate_rain_data_by_storm, sample,
+                              method='loop')
+        seconds['aggregate_loop'] = \
+            loop_secs * len(storms) / float(max(len(sample), 1))
+    finally:
+        set_pool(previous)
+        pool.closeall()
+
+    match = all(_same_aggregates(aggregates['bulk'], aggregates[method])
+                for method in ('rollup', 'index'))
+    return {'scale': scale,
+            'layout': layout,
+            'rows': rows,
+            'storms': len(storms),
+            'match': match,
+            'seconds': seconds}
+
+
+def load_history(path=HISTORY_PATH):
+    """Suite results recorded so far, oldest first"""
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def record_history(result, path=HISTORY_PATH):
+    """Appends a suite result with the time, commit and host"""
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    entry = dict(result,
+                 time=datetime.now().isoformat(),
+                 commit=_git_commit(),
+                 host=socket.gethostname())
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def find_regressions(result, history, host=None):
+    """Benchmarks of result slower than the median of the last
+    HISTORY_WINDOW runs of the same scale and layout on this host,
+    none until there are HISTORY_MIN_RUNS such runs
+
+    OUTPUT:
+        list    | [(benchmark, seconds, baseline seconds), ...]
+    """
+    host = host or socket.gethostname()
+    runs = [entry for entry in history
+            if entry['scale'] == result['scale'] and
+            entry['layout'] == result['layout'] and
+            entry.get('host') == host][-HISTORY_WINDOW:]
+
+    regressions = []
+    if len(runs) < HISTORY_MIN_RUNS:
+        return regressions
+    for name, seconds in result['seconds'].items():
+        past = [entry['seconds'][name] for entry in runs
+                if name in entry['seconds']]
+        if len(past) < HISTORY_MIN_RUNS:
+            continue
+        baseline = float(np.median(past))
+        if (seconds > baseline * (1 + REGRESSION_TOLERANCE) and
+                seconds - baseline > REGRESSION_FLOOR):
+            regressions.append((name, seconds, baseline))
+    return regressions
+
+
+def _scratch_database(name):
+    """Drops and recreates database name on the local server,
+    returns a ConnectionPool to it"""
+    local = ManipulateDatabase()
+    if name == local.db:
+        raise ValueError("Will not drop the working database {}".format(
+            name))
+    conn = psycopg2.connect(user=local.user, password=local.password,
+                            host=local.host, dbname='postgres')
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(
+        sql.Identifier(name)))
+    cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(name)))
+    cur.close()
+    conn.close()
+    return ConnectionPool(local.user, local.password, name, local.host)
+
+
+def _create_layout(md, layout, start_year, end_year):
+    md.migrate_layout(partition=layout != 'plain', start_year=start_year,
+                      end_year=end_year)
+    if layout == 'encoded':
+        md.migrate_encoding()
+
+
+def _ingest(md, synthetic, chunk_days=30):
+    """Loads synthetic through HydrometLoader, the scrapers' path.
+    Returns generation seconds, load seconds and rows loaded."""
+    loader = HydrometLoader(md)
+    generate = load = 0.
+    start = time()
+    for readings in synthetic.readings(chunk_days):
+        generated = time()
+        generate += generated - start
+        loader.add(readings)
+        start = time()
+        load += start - generated
+    loader.close()
+    load += time() - start
+    return generate, load, loader.rows
+
+
+def _timed(func, *args, **kwargs):
+    start = time()
+    result = func(*args, **kwargs)
+    return result, time() - start
+
+
+def _same_aggregates(a, b):
+    """X and y of two aggregate_rain_data_by_storm methods agree.
+    Rollup sums are double precision, hydromet values real."""
+    for left, right in zip(a, b):
+        if list(left.columns) != list(right.columns) or len(left) != len(right):
+            return False
+        values = [df.iloc[:, 2:].values.astype(np.float64)
+                  for df in (left, right)]
+        if not np.allclose(values[0], values[1], rtol=1e-5, atol=1e-4,
+                           equal_nan=True):
+            return False
+    return True
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_suite(result, regressions):
+    slow = {name: baseline for name, _, baseline in regressions}
+    print "suite {} {}: {} readings, {} storms, aggregates match {}".format(
+        result['scale'], result['layout'], result['rows'],
+        result['storms'], result['match'])
+    for name, seconds in result['seconds'].items():
+        line = "{:>18} | {:10.3f}s".format(name, seconds)
+        if name == 'ingest':
+            line += " | {:10.0f} rows/s".format(
+                result['rows'] / max(seconds, 1e-9))
+        if name == 'aggregate_loop' and result['storms'] > LOOP_STORM_CAP:
+            line += " (est)"
+        if name in slow:
+            line += " | REGRESSION, median {:.3f}s".format(slow[name])
+        print line
+
+
+def _print_moving_sum(result):
+    legacy = "{:12.2f}s".format(result['iterrows'])
+    if result['iterrows_estimated']:
+        legacy += " (est)"
+    print "{:>10} rows | searchsorted {:10.3f}s | iterrows {} | match {}".\
+        format(result['rows'], result['searchsorted'], legacy,
+               result['match'])
+
+
+if __name__ == "__main__":
+    if len(argv) > 1 and argv[1] == 'parse':
+        if len(argv) > 2:
+            pages = []
+            for path in sorted(glob(os.path.join(argv[2], '*.html'))):
+                with open(path, 'rb') as f:
+                    pages.append(f.read())
+        else:
+            pages = [synthetic_chronhist_page(179 * 96),
+                     synthetic_chronhist_page(179 * 96, tbody=True)]
+        result = bench_parse_table(pages)
+        print "parse_chronhist_table on {} pages, {} readings".format(
+            result['pages'], result['readings'])
+        print "lxml {:8.3f}s | bs4 {:8.3f}s | {:5.1f}x | match {}".format(
+            result['lxml'], result['bs4'],
+            result['bs4'] / max(result['lxml'], 1e-9), result['match'])
+        raise SystemExit
+
+    if len(argv) > 1 and argv[1] == 'suite':
+        scale = argv[2] if len(argv) > 2 else 'small'
+        layout = argv[3] if len(argv) > 3 else 'partitioned'
+        database = argv[4] if len(argv) > 4 else 'hl_bench'
+        result = run_suite(scale, layout, database)
+        regressions = find_regressions(result, load_history())
+        record_history(result)
+        _print_suite(result, regressions)
+        raise SystemExit(1 if regressions or not result['match'] else 0)
+
+    sizes = [10000, 1000000, 10000000]
+    if len(argv) > 1:
+        sizes = [int(arg) for arg in argv[1:]]
+
+    print "create_moving_sum (leading 10h, trailing 24h)"
+    for n in sizes:
+        _print_moving_sum(bench_moving_sum(n))
+
+    print "define_storm_events (threshold 0.5)"
+    for n in sizes:
+        result = bench_storm_events(n)
+        print "{:>10} rows | {:10.3f}s | {} storms".\
+            format(result['rows'], result['seconds'], result['storms'])
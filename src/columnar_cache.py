@@ -0,0 +1,242 @@
+"""Columnar on-disk cache for hydromet extracts and pipeline frames.
+
+Each entry is a directory of one .npy file per column plus a JSON
+manifest, named by a hash of what produced it (stage name, parameters
+and the version of its inputs). Columns are memory mapped on load, so
+reading a few columns or a time range only touches those bytes, and
+entries do not depend on the pandas version that wrote them.
+
+    cache = ColumnarCache('../cache')
+    key = cache.key('moving_sum', {'leading_hours': 10},
+                    source=md.data_version())
+    if not cache.exists(key):
+        cache.save(key, df)
+    rain = cache.load(key, columns=['moving_rain_sum'],
+                      start='2015-05-01', end='2015-06-01')
+
+optional arguments:
+python columnar_cache.py root
+lists the entries in a cache directory
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from threading import current_thread
+from datetime import datetime
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+
+MANIFEST = 'manifest.json'
+INDEX = '__index__'
+
+
+class ColumnarCache(object):
+    """
+    Content keyed store of DataFrames as memory mapped NumPy columns
+    """
+
+    def __init__(self, root='cache'):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+
+    def key(self, name, params=None, source=None):
+        """Key for the output of `name` run with params on source
+
+        source is anything identifying the inputs, e.g. upstream
+        keys or ManipulateDatabase.data_version(). A change to any
+        part gives a new key, so stale entries are never read.
+        """
+        payload = json.dumps([name, params or {}, source],
+                             sort_keys=True, default=str)
+        return "{}-{}".format(name, hashlib.sha1(payload).hexdigest()[:16])
+
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self._path(key), MANIFEST))
+
+
+    def save(self, key, df, params=None):
+        """Writes df as key, replacing any entry of the same key
+
+        A time ordered datetime index or column is recorded so load
+        can cut time ranges with a binary search
+        """
+        tmp = self._path('.tmp-{}-{}-{}'.format(key, os.getpid(),
+                                                current_thread().ident))
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        manifest = {'key': key,
+                    'params': params,
+                    'rows': len(df),
+                    'created': datetime.now().isoformat(),
+                    'columns': [],
+                    'index': None,
+                    'sorted_by': None}
+
+        if not isinstance(df.index, pd.RangeIndex):
+            manifest['index'] = self._save_column(tmp, INDEX,
+                                                  df.index.name,
+                                                  df.index.values)
+            if _is_time_ordered(df.index.values):
+                manifest['sorted_by'] = INDEX
+
+        for i, column in enumerate(df.columns):
+            values = df[column].values
+            manifest['columns'].append(
+                self._save_column(tmp, 'c{}'.format(i), column, values))
+            if manifest['sorted_by'] is None and _is_time_ordered(values):
+                manifest['sorted_by'] = column
+
+        with open(os.path.join(tmp, MANIFEST), 'w') as f:
+            json.dump(manifest, f, indent=1, default=str)
+
+        self.invalidate(key)
+        try:
+            os.rename(tmp, self._path(key))
+        except OSError:
+            # Another process saved the same key first
+            shutil.rmtree(tmp)
+
+
+    def load(self, key, columns=None, start=None, end=None):
+        """Reads an entry back as a DataFrame
+
+        columns     - only read these columns
+        start/end   - inclusive time range on the entry's time
+                      ordered index or column (see save)
+
+        Raises KeyError if the entry does not exist
+        """
+        manifest = self.manifest(key)
+        path = self._path(key)
+
+        wanted = manifest['columns']
+        if columns is not None:
+            by_name = {c['name']: c for c in wanted}
+            missing = [c for c in columns if c not in by_name]
+            if missing:
+                raise KeyError("{} has no columns {}".format(key, missing))
+            wanted = [by_name[c] for c in columns]
+
+        lo, hi = 0, manifest['rows']
+        if start is not None or end is not None:
+            sorted_by = manifest['sorted_by']
+            if sorted_by is None:
+                raise ValueError("{} has no time ordered column".format(key))
+            if sorted_by == INDEX:
+                times = _read(path, manifest['index'])
+            else:
+                times = _read(path, [c for c in manifest['columns']
+                                     if c['name'] == sorted_by][0])
+            if start is not None:
+                lo = np.searchsorted(times, np.datetime64(pd.Timestamp(start)),
+                                     side='left')
+            if end is not None:
+                hi = np.searchsorted(times, np.datetime64(pd.Timestamp(end)),
+                                     side='right')
+
+        data = {}
+        for column in wanted:
+            data[column['name']] = np.array(_read(path, column)[lo:hi])
+        index = None
+        if manifest['index'] is not None:
+            index = pd.Index(np.array(_read(path, manifest['index'])[lo:hi]),
+                             name=manifest['index']['name'])
+        df = pd.DataFrame(data, columns=[c['name'] for c in wanted],
+                          index=index)
+        if index is None:
+            df.index = pd.RangeIndex(lo, hi)
+        return df
+
+
+    def manifest(self, key):
+        path = os.path.join(self._path(key), MANIFEST)
+        if not os.path.exists(path):
+            raise KeyError(key)
+        with open(path) as f:
+            return json.load(f)
+
+
+    def get_or_compute(self, key, compute, params=None, columns=None):
+        """Loads key, or runs compute() and saves its DataFrame first"""
+        if not self.exists(key):
+            self.save(key, compute(), params=params)
+        return self.load(key, columns=columns)
+
+
+    def invalidate(self, key):
+        """Removes one entry"""
+        path = self._path(key)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+    def clear(self, name=None):
+        """Removes every entry, or only those of stage `name`
+
+        Returns the number of entries removed
+        """
+        removed = 0
+        for key in self.keys():
+            if name is None or key.rsplit('-', 1)[0] == name:
+                self.invalidate(key)
+                removed += 1
+        return removed
+
+
+    def keys(self):
+        return sorted(key for key in os.listdir(self.root)
+                      if not key.startswith('.') and self.exists(key))
+
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+
+    def _save_column(self, path, stem, name, values):
+        """Saves one column, object columns (e.g. strings) are
+        pickled and read without memory mapping"""
+        values = np.asarray(values)
+        filename = stem + '.npy'
+        mmap = values.dtype != object
+        np.save(os.path.join(path, filename), values, allow_pickle=not mmap)
+        return {'name': name,
+                'file': filename,
+                'dtype': str(values.dtype),
+                'mmap': mmap}
+
+
+def _read(path, column):
+    filename = os.path.join(path, column['file'])
+    if column['mmap']:
+        return np.load(filename, mmap_mode='r')
+    return np.load(filename, allow_pickle=True)
+
+
+def _is_time_ordered(values):
+    values = np.asarray(values)
+    if not np.issubdtype(values.dtype, np.datetime64):
+        return False
+    return bool(values.shape[0] < 2 or (values[1:] >= values[:-1]).all())
+
+
+if __name__ == "__main__":
+    root = 'cache'
+    if len(argv) > 1:
+        root = argv[1]
+
+    cache = ColumnarCache(root)
+    for key in cache.keys():
+        manifest = cache.manifest(key)
+        print "{:40} {:>10} rows  {}".format(
+            key, manifest['rows'],
+            ', '.join(str(c['name']) for c in manifest['columns']))
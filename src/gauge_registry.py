@@ -0,0 +1,193 @@
+"""Gauge registry, the one list of gauges the scrapers and the model use.
+
+gauge_list.csv holds the model gauges in scraping order with their
+watershed, role ('rain' or 'lake') and rating table (tables/, lakes
+only). tables/full_gauge_list.txt is the site catalogue of every
+gauge, used to name gauges outside the model. Both are read once per
+process and cached, so changing the feature set is an edit of
+gauge_list.csv.
+
+    rain = rain_gauges()                    # ['4594', '3991', ...]
+    lakes = lake_gauges(watershed='Lake Travis')
+    df = rename_columns(df)                 # '3963_max' -> 'Mansfield Dam_max'
+
+optional arguments:
+python gauge_registry.py [gauge ...]
+"""
+
+import os
+import re
+from threading import Lock
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+REGISTRY_CSV = os.path.join(SRC_DIR, 'gauge_list.csv')
+CATALOG_TXT = os.path.join(SRC_DIR, os.pardir, 'tables',
+                           'full_gauge_list.txt')
+
+ROLES = ('rain', 'lake')
+
+# Column suffixes of the storm lake aggregates
+LAKE_SUFFIXES = ('_max', '_min')
+
+_CACHE = {}
+_CACHE_LOCK = Lock()
+
+
+def load_registry(path=REGISTRY_CSV):
+    """Model gauges, cached per path
+
+    OUTPUT:
+        DataFrame   | index gauge id (str), in file order
+                      [name | watershed | role | rating_table]
+                      rating_table is None for gauges without one
+    """
+    key = ('registry', path)
+    with _CACHE_LOCK:
+        if key not in _CACHE:
+            df = pd.read_csv(path, dtype=str, skipinitialspace=True)
+            df['value'] = df['value'].str.strip()
+            df = df.set_index('value')
+            df.index.name = 'gauge'
+            df = df.where(df.notnull(), None)
+            unknown = set(df['role']) - set(ROLES)
+            if unknown:
+                raise ValueError("Unknown gauge roles in {}: {}".format(
+                    path, sorted(unknown)))
+            if df.index.duplicated().any():
+                raise ValueError("Repeated gauges in {}".format(path))
+            _CACHE[key] = df
+        return _CACHE[key]
+
+
+def load_catalog(path=CATALOG_TXT):
+    """Every gauge on the site, cached per path
+
+    OUTPUT:
+        dict    | {gauge id: name}
+    """
+    key = ('catalog', path)
+    with _CACHE_LOCK:
+        if key not in _CACHE:
+            catalog = {}
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        match = re.match(r'^\s*(\d+)\s+(.+?)\s*$', line)
+                        if match:
+                            catalog[match.group(1)] = match.group(2)
+            _CACHE[key] = catalog
+        return _CACHE[key]
+
+
+def gauges(role=None, watershed=None):
+    """Model gauge ids in registry order, optionally of one role
+    and/or watershed"""
+    df = load_registry()
+    keep = np.ones(len(df), dtype=bool)
+    if role is not None:
+        if role not in ROLES:
+            raise ValueError("Unknown gauge role: {}".format(role))
+        keep &= (df['role'] == role).values
+    if watershed is not None:
+        keep &= (df['watershed'] == watershed).values
+    return list(df.index[keep])
+
+
+def rain_gauges(watershed=None):
+    return gauges('rain', watershed)
+
+
+def lake_gauges(watershed=None, rated=None):
+    """Lake gauge ids, rated True/False keeps only the dams with/
+    without a rating table"""
+    ids = gauges('lake', watershed)
+    if rated is None:
+        return ids
+    tables = load_registry()['rating_table']
+    return [gauge for gauge in ids if (tables[gauge] is not None) == rated]
+
+
+def watersheds():
+    """Watershed names in registry order"""
+    return list(pd.unique(load_registry()['watershed']))
+
+
+def gauge_name(gauge):
+    """Name of a model or catalogue gauge, KeyError if unknown"""
+    gauge = str(gauge)
+    df = load_registry()
+    if gauge in df.index:
+        return df.at[gauge, 'name']
+    return load_catalog()[gauge]
+
+
+def gauge_info(gauge):
+    """Registry row of a model gauge as a dict, KeyError if unknown"""
+    row = load_registry().loc[str(gauge)]
+    info = row.to_dict()
+    info['gauge'] = str(gauge)
+    return info
+
+
+def rating_tables():
+    """{gauge id: (dam name, table file)} of the rated lakes"""
+    df = load_registry()
+    rated = df[df['rating_table'].notnull()]
+    return {gauge: (row['name'], row['rating_table'])
+            for gauge, row in rated.iterrows()}
+
+
+def scrape_list():
+    """[(gauge number, gauge name), ...] in scraping order, as the
+    scrapers take them"""
+    df = load_registry()
+    return [(int(gauge), name) for gauge, name in zip(df.index, df['name'])]
+
+
+def rename_columns(df, to='name'):
+    """Renames gauge id columns ('3963', '3963_max') to names
+    ('Mansfield Dam', 'Mansfield Dam_max'), or back with to='id'.
+    Other columns are left alone. Returns a renamed copy."""
+    registry = load_registry()
+    if to == 'name':
+        lookup = pd.Series(registry['name'].values, index=registry.index)
+    elif to == 'id':
+        lookup = pd.Series(registry.index.values, index=registry['name'])
+    else:
+        raise ValueError("Unknown rename target: {}".format(to))
+
+    columns = pd.Index([str(c) for c in df.columns])
+    suffix = '|'.join(LAKE_SUFFIXES)
+    parts = columns.str.extract(r'^(.*?)({})?$'.format(suffix), expand=True)
+    mapped = parts[0].map(lookup)
+    renamed = np.where(mapped.notnull(),
+                       mapped.fillna('') + parts[1].fillna(''),
+                       np.asarray(df.columns, dtype=object))
+    out = df.copy()
+    out.columns = list(renamed)
+    return out
+
+
+def clear_cache():
+    """Forget the loaded files, e.g. after editing gauge_list.csv"""
+    with _CACHE_LOCK:
+        _CACHE.clear()
+
+
+if __name__ == "__main__":
+    ids = argv[1:] or list(load_registry().index)
+    registry = load_registry()
+    for gauge in ids:
+        if gauge in registry.index:
+            info = gauge_info(gauge)
+            print "{:>5} {:22} {:18} {:5} {}".format(
+                gauge, info['name'], info['watershed'], info['role'],
+                info['rating_table'] or '')
+        else:
+            print "{:>5} {:22} (not in the model)".format(
+                gauge, load_catalog().get(gauge, 'unknown'))
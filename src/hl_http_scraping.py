@@ -0,0 +1,716 @@
+"""Selenium-free scraping backend for the lcra hydromet site.
+
+Replays the chronhist.aspx form posts directly over HTTP, carrying
+the ASP.NET hidden fields (__VIEWSTATE, __EVENTVALIDATION, ...) from
+each response into the next request. No browser is needed.
+
+Each gauge/sensor pair walks back from end_date one window at a
+time and stops at the first window without a result table, the same
+as HLScraper. Windows for different pairs are fetched at once by a
+bounded pool of worker threads. Inserts happen on the main thread.
+
+In incremental mode each gauge is only scraped from the day of its
+latest observation in hydromet onwards.
+
+Window lengths adapt per pair to the readings and response time of
+the previous window (scrape_jobs.WindowSizer), up to the site's 179
+days. Pairs with a long range to cover first probe for the start of
+their history (scrape_jobs.find_history_start), so the walk back
+stops there instead of at the first empty window.
+
+Page loads, postbacks, submits, parsing and inserts are timed with
+metrics.METRICS; the log keeps errors, probes and totals.
+
+optional arguments:
+python hl_http_scraping.py start_date end_date concurrency url record_dir incremental
+set end date to 'none' if not desired, record_dir to 'none' to not record
+"""
+
+# Tools for building element loops
+from bs4 import BeautifulSoup
+from lxml import etree
+import requests
+
+# scipy
+import pandas as pd
+import numpy as np
+
+# Python
+from functools import partial
+from threading import Thread, Lock, local
+from Queue import Queue
+from time import sleep, time
+from datetime import date, timedelta
+from hashlib import sha1
+from io import BytesIO
+from sys import argv
+import os
+import re
+
+# SQL module
+from sql_class import ManipulateDatabase, HydrometLoader, get_pool
+
+# Gauges to scrape
+from gauge_registry import scrape_list
+
+from metrics import METRICS
+
+# Resumable job queue
+from scrape_jobs import (date_windows, parse_window_date, WindowSizer,
+                         find_history_start, MAX_WINDOW_DAYS)
+
+
+# Form fields that decide which page the site returns, used to name
+# recorded pages
+RECORD_FIELDS = ('__EVENTTARGET', 'DropDownList1', 'DropDownList2',
+                 'Date1', 'Date2', 'Button1')
+
+
+def parse_chronhist_table(page_source, gauge, engine='lxml'):
+    """Parses the result table of a chronhist page
+
+    INPUT:
+        string  (page_source) | html of the page
+        gauge                 | gauge id stored with every reading
+        engine                | 'lxml' streams the result table
+                                through parse_chronhist_arrays,
+                                'bs4' builds a BeautifulSoup tree of
+                                the whole page as originally written
+
+    OUTPUT:
+        list    | [(timestamp, gauge, sensor, value), ...]
+                  None if the page has no result table
+
+    The first row holds the sensor headers and the first column the
+    timestamps. Empty cells (&nbsp;) are stored as None.
+
+    Names are not encoded here. The tuples are the format
+    HydrometLoader, insert_gauge_readings and the Selenium scraper
+    share, and every row refers to the one gauge string and one
+    string per sensor column, a pointer per reading rather than a
+    copy. On an encoded table (migrate_encoding) they become lookup
+    ids once per batch at COPY time. parse_chronhist_arrays gives
+    the typed arrays of a page.
+    """
+    if engine == 'bs4':
+        return _parse_chronhist_soup(page_source, gauge)
+    elif engine != 'lxml':
+        raise ValueError("Unknown parser engine: {}".format(engine))
+
+    parsed = parse_chronhist_arrays(page_source)
+    if parsed is None:
+        return None
+    times, sensors, values = parsed
+
+    gauge = str(gauge)
+    stamps = times.astype('M8[us]').astype(object)
+    cells = values.astype(object)
+    cells[np.isnan(values)] = None
+    return [(stamp, gauge, sensor, value)
+            for stamp, row in zip(stamps, cells.tolist())
+            for sensor, value in zip(sensors, row)]
+
+
+def parse_chronhist_arrays(page_source):
+    """Parses the result table of a chronhist page into typed arrays
+
+    Only the result table is cut out of the page and parsed, row by
+    row with lxml iterparse, instead of building a tree of the whole
+    page.
+
+    OUTPUT:
+        ndarray | datetime64[ns] timestamps, one per row
+        list    | sensor headers, one per value column
+        ndarray | float64 values, rows x sensors, NaN for empty cells
+        None if the page has no result table
+    """
+    fragment = _result_table_html(page_source)
+    if fragment is None:
+        return None
+
+    rows = []
+    for _, row in etree.iterparse(BytesIO(fragment), events=('end',),
+                                  tag='tr', html=True, encoding='utf-8'):
+        rows.append([_cell_text(cell) for cell in row
+                     if cell.tag in ('th', 'td')])
+        row.clear()
+    if not rows:
+        return None
+
+    sensors = rows[0][1:]
+    body = rows[1:]
+    times = pd.to_datetime([row[0] for row in body],
+                           infer_datetime_format=True).values
+    # Short rows are padded as empty cells
+    width = len(sensors)
+    cells = [(row[1:] + [None] * width)[:width] for row in body]
+    values = np.array([[u'nan' if not cell or cell == u'\xa0' else cell
+                        for cell in row] for row in cells],
+                      dtype=np.float64).reshape(len(body), len(sensors))
+    return times, sensors, values
+
+
+def _result_table_html(page_source):
+    """The table holding the first tbody (browser pages) or else
+    the first header cell (raw html), as utf-8 bytes. None if the
+    page has neither."""
+    if isinstance(page_source, unicode):
+        page_source = page_source.encode('utf-8')
+    lower = page_source.lower()
+    found = (re.search(br'<tbody[\s>]', lower) or
+             re.search(br'<th[\s>]', lower))
+    if found is None:
+        return None
+    start = lower.rfind(b'<table', 0, found.start())
+    end = lower.find(b'</table>', found.end())
+    if start == -1 or end == -1:
+        return None
+    return page_source[start:end + len(b'</table>')]
+
+
+def _cell_text(cell):
+    if len(cell):
+        return u''.join(cell.itertext())
+    return cell.text
+
+
+def _parse_chronhist_soup(page_source, gauge):
+    """parse_chronhist_table with BeautifulSoup"""
+    soup = BeautifulSoup(page_source, 'lxml')
+
+    # Browsers add a tbody to the table, the raw html may not have one
+    table = soup.find("tbody")
+    if table is None:
+        header = soup.find("th")
+        if header is None:
+            return None
+        table = header.find_parent("table")
+
+    rows = table.find_all("tr", recursive=False)
+    headers = [header.string for header
+               in rows[0].find_all(["th", "td"], recursive=False)]
+
+    inserts = []
+    for row in rows[1:]:
+        values = [v.string for v
+                  in row.find_all(["th", "td"], recursive=False)]
+
+        for val, head in zip(values[1:], headers[1:]):
+            if val == u'\xa0':
+                insval = None
+            else:
+                insval = float(val)
+            inserts.append((values[0], str(gauge), head, insval))
+
+    return inserts
+
+
+def recording_key(method, fields):
+    """File name of a recorded page for a request"""
+    parts = [method] + ["{}={}".format(name, fields.get(name, ''))
+                        for name in RECORD_FIELDS]
+    return sha1("&".join(parts)).hexdigest() + ".html"
+
+
+class HLFormScraper(object):
+
+    def __init__(self,
+                 url='http://hydromet.lcra.org/chronhist.aspx',
+                 start_date='01/01/2001',
+                 end_date=None,
+                 concurrency=8,
+                 localhostdb=True,
+                 logname="defaultlog",
+                 record_dir=None,
+                 timeout=60,
+                 incremental=False,
+                 batch_rows=50000,
+                 commit_rows=500000,
+                 adaptive=True,
+                 probe=True):
+
+        self.url = url
+        self.start_date = self._conv_date(start_date)
+        if not end_date:
+            self.end_date = date.today()
+        else:
+            self.end_date = self._conv_date(end_date)
+        self.concurrency = concurrency
+        self.record_dir = record_dir
+        self.timeout = timeout
+        self.incremental = incremental
+        self.latest_dates = {}
+        # Adapt window lengths per gauge/sensor, probe long ranges
+        # for the start of their history first
+        self.adaptive = adaptive
+        self.probe = probe
+        self.sizers = {}
+        self.history_starts = {}
+
+        self.gauge_list = None
+        self.sensor_states = {}
+        self.jobs = Queue()
+        self.results = Queue()
+        self.workers = []
+        self._local = local()
+        self._db_lock = Lock()
+        self.md = ManipulateDatabase(pool=get_pool(server=not localhostdb))
+        self.md.connect()
+        # Commit at least every minute so finished jobs are marked
+        # done well inside their lease
+        self.loader = HydrometLoader(self.md,
+                                     batch_rows=batch_rows,
+                                     commit_rows=commit_rows,
+                                     commit_seconds=60)
+        self.log = open(logname, 'w')
+
+
+    def start(self, gauge_list=None):
+        """Scrapes every gauge in gauge_list (defaults to
+        gauge_list.csv) with `concurrency` requests in flight
+        """
+        self.log.write("Start Scraper\n")
+        self._load_latest_dates()
+        if gauge_list is None:
+            gauge_list = self._get_gauge_list()
+        self.gauge_list = gauge_list
+
+        self.workers = [Thread(target=self._worker)
+                        for _ in xrange(self.concurrency)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+        self._cycle_jobs()
+
+
+    def run_jobs(self, queue):
+        """Works through a ScrapeJobQueue with `concurrency` threads
+
+        Gauge jobs add a window job per sensor for start_date to
+        end_date. Jobs already finished in an earlier run are never
+        leased again, so a restart only scrapes what is missing.
+        """
+        self.log.write("Start Job Scraper\n")
+        self._load_latest_dates()
+        threads = [Thread(target=self._job_worker,
+                          args=(queue, "worker-{}".format(i)))
+                   for i in xrange(self.concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with self._db_lock:
+            self.loader.close()
+
+
+    def quit(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self.loader.close()
+        self.log.write("loaded \t\t- {} records {:.0f} records/sec\n".\
+            format(self.loader.rows, self.loader.rows_per_second))
+        self.log.write(METRICS.summary().to_string(
+            float_format='{:.3f}'.format) + "\n")
+        self.md.close()
+        self.log.close()
+
+
+    def _get_gauge_list(self):
+        """Returns a list of (gauge number, gauge name) tuples"""
+        return scrape_list()
+
+
+    def _cycle_jobs(self):
+        """Feeds the worker pool and handles results until every
+        gauge/sensor pair has run out of windows
+
+        Gauge jobs return the form state for each sensor, window jobs
+        return parsed readings. A pair only queues its next window
+        once the previous one returned a table.
+        """
+        outstanding = 0
+        for gaugevalue, gaugename in self.gauge_list:
+            self.jobs.put(('gauge', gaugevalue))
+            outstanding += 1
+
+        while outstanding:
+            job, result, seconds = self.results.get()
+            outstanding -= 1
+
+            if isinstance(result, Exception):
+                self.log.write("exception \t- {} {!r}\n".format(job[:2],
+                                                               result))
+                continue
+
+            if job[0] == 'gauge':
+                for sensor, fields in result:
+                    if self._should_probe(job[1]):
+                        self.jobs.put(('probe', job[1], sensor, fields))
+                        outstanding += 1
+                        continue
+                    window = self._first_window(job[1], sensor)
+                    if window:
+                        self.jobs.put(('window', job[1], sensor, fields)
+                                      + window)
+                        outstanding += 1
+                continue
+
+            if job[0] == 'probe':
+                _, gauge, sensor, fields = job
+                self.history_starts[(gauge, sensor)] = result
+                self.log.write("probed \t\t- {} {} history from {}\n".\
+                    format(gauge, sensor, self._conv_date(result)))
+                window = self._first_window(gauge, sensor)
+                if window:
+                    self.jobs.put(('window', gauge, sensor, fields) + window)
+                    outstanding += 1
+                continue
+
+            _, gauge, sensor, fields, start, end = job
+            if result is None:
+                self.log.write("exception \t- tbody not found {} {} {}\n".\
+                    format(gauge, sensor, self._conv_date(start)))
+                continue
+
+            self._sql_entry(result)
+            if self.adaptive:
+                self._sizer(gauge, sensor).update((end - start).days,
+                                                  len(result), seconds)
+            window = self._next_window(gauge, sensor, start)
+            if window:
+                self.jobs.put(('window', gauge, sensor, fields) + window)
+                outstanding += 1
+
+
+    def _worker(self):
+        """Runs jobs from the queue until it receives None"""
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            start = time()
+            try:
+                if job[0] == 'gauge':
+                    result = self._get_sensor_states(job[1])
+                elif job[0] == 'probe':
+                    result = self._probe_history(*job[1:])
+                else:
+                    result = self._get_window(*job[1:])
+            except Exception as e:
+                result = e
+            self.results.put((job, result, time() - start))
+
+
+    def _job_worker(self, queue, name):
+        """Leases and runs queue jobs until none are left"""
+        while True:
+            job = queue.lease(name)
+            if job is None:
+                # Windows waiting on the loader only complete once
+                # committed, so commit before waiting on them. A
+                # failed load has already failed its jobs.
+                try:
+                    with self._db_lock:
+                        self.loader.flush()
+                        self.loader.commit()
+                except Exception as e:
+                    self.log.write("exception \t- load {!r}\n".format(e))
+                if not queue.has_unfinished():
+                    break
+                sleep(1)
+                continue
+
+            job_id, gauge, sensor, start, end = job
+            try:
+                if not sensor:
+                    # Same window grid every run, minus windows that
+                    # end before the gauge's latest observation or the
+                    # probed start of the sensor's history
+                    start_date = self._gauge_start_date(gauge)
+                    grid = date_windows(self.start_date, self.end_date)
+                    for sensor, fields in self._cached_sensor_states(gauge):
+                        floor = start_date
+                        if self._should_probe(gauge):
+                            floor = self._probe_history(gauge, sensor,
+                                                        fields)
+                        queue.add_windows(gauge, sensor,
+                                          [(start, end) for start, end
+                                           in grid if end >= floor])
+                    queue.complete(job_id)
+                    continue
+
+                fields = dict(self._cached_sensor_states(gauge))[sensor]
+                inserts = self._get_window(gauge, sensor, fields,
+                                           parse_window_date(start),
+                                           parse_window_date(end))
+                if inserts is None:
+                    self.log.write("exception \t- tbody not found {} {} {}\n".\
+                        format(gauge, sensor, start))
+                    queue.mark_empty(job_id)
+                    continue
+
+                # A failed load fails this job and every other job
+                # whose rows were rolled back with it, through on_error
+                try:
+                    with self._db_lock:
+                        self._sql_entry(inserts,
+                                        on_commit=partial(queue.complete,
+                                                          job_id,
+                                                          len(inserts)),
+                                        on_error=partial(queue.fail, job_id))
+                except Exception as e:
+                    self.log.write("exception \t- load {!r}\n".format(e))
+
+            except Exception as e:
+                self.log.write("exception \t- job {} {!r}\n".format(job_id,
+                                                                      e))
+                queue.fail(job_id, e)
+
+
+    def _cached_sensor_states(self, gauge):
+        """Sensor form states of a gauge, fetched once per run"""
+        states = self.sensor_states.get(gauge)
+        if states is None:
+            states = self._get_sensor_states(gauge)
+            self.sensor_states[gauge] = states
+        return states
+
+
+    def _get_sensor_states(self, gauge):
+        """Selects a gauge and each of its sensors through postbacks
+
+        OUTPUT:
+            list    | [(sensor value, form fields), ...] with the
+                      fields ready for a date window submit
+        """
+        soup = self._request('GET', {})
+        fields = self._form_fields(soup)
+        fields.update({'__EVENTTARGET': 'DropDownList1',
+                       '__EVENTARGUMENT': '',
+                       'DropDownList1': str(gauge)})
+        soup = self._request('POST', fields)
+
+        states = []
+        for optionvalue, optionname in self._get_sensor_options(soup):
+            fields = self._form_fields(soup)
+            fields.update({'DropDownList1': str(gauge),
+                           'DropDownList2': optionvalue})
+
+            if self._autopostback(soup, 'DropDownList2'):
+                fields.update({'__EVENTTARGET': 'DropDownList2',
+                               '__EVENTARGUMENT': ''})
+                sensorsoup = self._request('POST', fields)
+                fields = self._form_fields(sensorsoup)
+                fields.update({'DropDownList1': str(gauge),
+                               'DropDownList2': optionvalue})
+
+            button = soup.find("input", attrs={'name': 'Button1'})
+            fields.update({'__EVENTTARGET': '',
+                           '__EVENTARGUMENT': '',
+                           'Button1': button.get('value', '')})
+            states.append((optionvalue, fields))
+
+        return states
+
+
+    def _get_window(self, gauge, sensor, fields, start, end):
+        """Submits one date window and parses the result table"""
+        fields = dict(fields)
+        fields.update({'Date1': self._conv_date(start),
+                       'Date2': self._conv_date(end)})
+        page = self._request('POST', fields, parse=False)
+        with METRICS.timer('scrape.parse', gauge=gauge) as timing:
+            inserts = parse_chronhist_table(page, gauge)
+            timing.bytes = len(page)
+            if inserts is None:
+                METRICS.count('scrape.no_table', gauge=gauge)
+            else:
+                timing.rows = len(inserts)
+        return inserts
+
+
+    def _request(self, method, fields, parse=True):
+        """Sends a form request with this thread's session,
+        recording the page when record_dir is set"""
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+
+        if method == 'GET':
+            name = 'scrape.page_load'
+        elif fields.get('__EVENTTARGET'):
+            name = 'scrape.postback'
+        else:
+            name = 'scrape.submit'
+        labels = {}
+        if fields.get('DropDownList1'):
+            labels['gauge'] = fields['DropDownList1']
+
+        with METRICS.timer(name, **labels) as timing:
+            if method == 'GET':
+                response = session.get(self.url, timeout=self.timeout)
+            else:
+                response = session.post(self.url, data=fields,
+                                        timeout=self.timeout)
+            response.raise_for_status()
+            timing.bytes = len(response.content)
+
+        if self.record_dir:
+            path = os.path.join(self.record_dir,
+                                recording_key(method, fields))
+            with open(path, 'wb') as f:
+                f.write(response.content)
+
+        if parse:
+            return BeautifulSoup(response.content, 'lxml')
+        return response.content
+
+
+    def _form_fields(self, soup):
+        """Hidden ASP.NET state fields of the form"""
+        return {field.get('name'): field.get('value', '')
+                for field in soup.find_all("input", type="hidden")
+                if field.get('name')}
+
+
+    def _get_sensor_options(self, soup):
+        dl2 = soup.find(id=('DropDownList2'))
+        alloptions = dl2.find_all("option")
+
+        return [(o.get('value'), o.contents[0]) for o in alloptions]
+
+
+    def _autopostback(self, soup, name):
+        """True if changing the select posts the form back"""
+        select = soup.find("select", attrs={'name': name})
+        return '__doPostBack' in (select.get('onchange') or '')
+
+
+    def _load_latest_dates(self):
+        """In incremental mode, looks up where each gauge left off"""
+        if self.incremental:
+            self.latest_dates = self.md.get_latest_gauge_dates()
+            self.log.write("incremental \t- {} gauges with data\n".\
+                format(len(self.latest_dates)))
+
+
+    def _gauge_start_date(self, gauge):
+        """Oldest date to scrape for a gauge: start_date, or the day
+        of its latest observation in incremental mode"""
+        latest = self.latest_dates.get(str(gauge))
+        if latest is None:
+            return self.start_date
+        return max(latest, self.start_date)
+
+
+    def _should_probe(self, gauge):
+        """Probe when the range to walk spans several full windows"""
+        windows = ((self.end_date - self._gauge_start_date(gauge)).days //
+                   (MAX_WINDOW_DAYS + 1))
+        return self.probe and windows >= 4
+
+
+    def _probe_history(self, gauge, sensor, fields):
+        """Oldest date worth walking back to for a gauge/sensor,
+        see scrape_jobs.find_history_start"""
+        def has_data(start, end):
+            inserts = self._get_window(gauge, sensor, fields, start, end)
+            return bool(inserts) and any(value is not None
+                                         for _, _, _, value in inserts)
+
+        return find_history_start(has_data, self._gauge_start_date(gauge),
+                                  self.end_date)
+
+
+    def _sizer(self, gauge, sensor):
+        sizer = self.sizers.get((gauge, sensor))
+        if sizer is None:
+            sizer = self.sizers[(gauge, sensor)] = WindowSizer()
+        return sizer
+
+
+    def _walk_start_date(self, gauge, sensor):
+        """Oldest date to walk back to for a gauge/sensor"""
+        start_date = self._gauge_start_date(gauge)
+        history = self.history_starts.get((gauge, sensor))
+        if history is not None:
+            start_date = max(start_date, history)
+        return start_date
+
+
+    def _first_window(self, gauge, sensor):
+        return self._sizer(gauge, sensor).window(
+            self.end_date, self._walk_start_date(gauge, sensor))
+
+
+    def _next_window(self, gauge, sensor, cur_start_date):
+        cur_end_date = cur_start_date - timedelta(1) #inclusive
+        return self._sizer(gauge, sensor).window(
+            cur_end_date, self._walk_start_date(gauge, sensor))
+
+
+    def _sql_entry(self, inserts, on_commit=None, on_error=None):
+
+        with METRICS.timer('scrape.insert') as timing:
+            timing.rows = len(inserts)
+            self.loader.add(inserts, on_commit=on_commit, on_error=on_error)
+
+    def _conv_date(self, dt):
+        """Convert a string of m/d/Y to date object
+        dstr > date string
+        or vice versa
+        """
+
+        if isinstance(dt, str):
+            m, d, y = int(dt[:2]), int(dt[3:5]), int(dt[6:])
+            return date(y, m, d)
+        else:
+            return dt.strftime("%m/%d/%Y")
+
+
+if __name__ == "__main__":
+    start_date = '01/01/1950'
+    end_date = None
+    concurrency = 8
+    url = 'http://hydromet.lcra.org/chronhist.aspx'
+    record_dir = None
+    incremental = False
+
+    if len(argv) > 1:
+        start_date = argv[1]
+
+    if len(argv) > 2:
+        if argv[2] != "none":
+            end_date = argv[2]
+
+    if len(argv) > 3:
+        concurrency = int(argv[3])
+
+    if len(argv) > 4:
+        url = argv[4]
+
+    if len(argv) > 5:
+        if argv[5] != "none":
+            record_dir = argv[5]
+
+    if len(argv) > 6:
+        incremental = argv[6] == "incremental"
+
+    METRICS.configure('defaulthttp.metrics.jsonl')
+    hls = HLFormScraper(url=url,
+                        start_date=start_date,
+                        end_date=end_date,
+                        concurrency=concurrency,
+                        localhostdb=False,
+                        logname='defaulthttp',
+                        record_dir=record_dir,
+                        incremental=incremental)
+    hls.start()
+
+    hls.quit()
@@ -5,12 +5,23 @@ using methods from another module.
 
 Requires selenium webdriver for chrome.
 
+Gauges are shared out to a BrowserPool of long-lived headless Chrome
+sessions, one thread per session. Pages are waited on explicitly
+(postbacks, then the result tbody) instead of with implicit waits,
+and only sessions that crash are restarted.
+
+Page loads, form postbacks and submits, parsing and database inserts
+are timed per gauge with metrics.METRICS; the log keeps errors and
+totals.
+
 Due to the nested nature of the scraper, functions are ordered
 in descending order by nest-level in the code.
 
 optional arguments:
-python hl_scraping start_date end_date logname
+python hl_scraping start_date end_date logname incremental sessions
 set end date to 'none' if not desired
+'incremental' only scrapes each gauge from its latest observation
+sessions is the number of browsers, default 4
 """
 
 # Tools for building element loops
@@ -24,16 +35,182 @@ import numpy as np
 # Web Driver Tools
 from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.support.ui import Select
-from selenium.common.exceptions import NoSuchElementException
+from selenium.webdriver.support.ui import Select, WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.common.by import By
+from selenium.common.exceptions import WebDriverException
 
 # Python
-from time import sleep
-from datetime import date, timedelta, datetime
+from Queue import Queue
+from threading import Thread, Lock, local
+from time import sleep, time
+from datetime import date, timedelta
 from sys import argv
 
 # SQL module
-from sql_class import ManipulateDatabase
+from sql_class import ManipulateDatabase, HydrometLoader, get_pool
+
+# Gauges to scrape
+from gauge_registry import scrape_list
+
+# Table parsing shared with the HTTP backend
+from hl_http_scraping import parse_chronhist_table
+
+# Window sizing shared with the HTTP backend
+from scrape_jobs import WindowSizer
+from metrics import METRICS
+
+
+class BrowserPool(object):
+    """
+    Long-lived browser sessions shared by scraper threads
+
+    size      - number of sessions, launched on first use
+    headless  - run Chrome without a window
+    page_load_timeout - seconds before a page load counts as failed
+
+    map(func, items) runs func(driver, item) for every item with one
+    thread per session. A session that raises WebDriverException is
+    quit and relaunched and its item retried, the others keep
+    running. A session that fails to launch counts as a failed
+    attempt of the item it was for.
+    """
+
+    def __init__(self, size=4, headless=True, page_load_timeout=120):
+        self.size = size
+        self.headless = headless
+        self.page_load_timeout = page_load_timeout
+        self.restarts = 0
+        self.idle = Queue()
+        for _ in xrange(size):
+            self.idle.put(None)
+        self._drivers = set()
+        self._lock = Lock()
+
+
+    def acquire(self):
+        """A live session, waits for one to be free. If a session
+        cannot be launched its slot is freed and the error raised."""
+        driver = self.idle.get()
+        try:
+            if driver is None or not _alive(driver):
+                driver = self._replace(driver)
+        except Exception:
+            self.idle.put(None)
+            raise
+        return driver
+
+
+    def release(self, driver, crashed=False):
+        """Returns a session, a crashed one is quit and relaunched by
+        the next acquire"""
+        if crashed:
+            self._discard(driver)
+            driver = None
+        self.idle.put(driver)
+
+
+    def map(self, func, items, attempts=3):
+        """Runs func(driver, item) for each item on the sessions
+
+        OUTPUT:
+            list    | [(item, exception), ...] items that still
+                      failed after `attempts` tries
+        """
+        work = Queue()
+        for item in items:
+            work.put((item, 1))
+        failed = []
+
+        def worker():
+            while True:
+                job = work.get()
+                if job is None:
+                    break
+                item, attempt = job
+                driver = None
+                crashed = False
+                try:
+                    driver = self.acquire()
+                    func(driver, item)
+                except Exception as e:
+                    # Launch failures and browser errors are retried,
+                    # errors of func itself are not
+                    retry = (driver is None or
+                             isinstance(e, WebDriverException))
+                    if driver is not None and retry:
+                        crashed = not _alive(driver)
+                    if retry and attempt < attempts:
+                        work.put((item, attempt + 1))
+                    else:
+                        failed.append((item, e))
+                finally:
+                    try:
+                        if driver is not None:
+                            self.release(driver, crashed=crashed)
+                    finally:
+                        work.task_done()
+
+        threads = [Thread(target=worker) for _ in xrange(self.size)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        work.join()
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        return failed
+
+
+    def quit(self):
+        with self._lock:
+            drivers, self._drivers = self._drivers, set()
+        for driver in drivers:
+            _quit_quietly(driver)
+
+
+    def _launch(self):
+        options = webdriver.ChromeOptions()
+        if self.headless:
+            options.add_argument('--headless')
+            options.add_argument('--disable-gpu')
+        driver = webdriver.Chrome(chrome_options=options)
+        driver.set_page_load_timeout(self.page_load_timeout)
+        with self._lock:
+            self._drivers.add(driver)
+        return driver
+
+
+    def _replace(self, driver):
+        """Quits a crashed (or never launched) session and launches a
+        new one in its place"""
+        if driver is not None:
+            self._discard(driver)
+        return self._launch()
+
+
+    def _discard(self, driver):
+        with self._lock:
+            self._drivers.discard(driver)
+            self.restarts += 1
+        _quit_quietly(driver)
+
+
+def _alive(driver):
+    """True if the browser still answers"""
+    try:
+        driver.current_url
+        return True
+    except WebDriverException:
+        return False
+
+
+def _quit_quietly(driver):
+    try:
+        driver.quit()
+    except Exception:
+        pass
 
 
 class HLScraper(object):
@@ -45,7 +222,13 @@ class HLScraper(object):
                  start_date='01/01/2001',
                  end_date=None,
                  localhostdb=True,
-                 logname="defaultlog"):
+                 logname="defaultlog",
+                 incremental=False,
+                 batch_rows=50000,
+                 commit_rows=500000,
+                 sessions=4,
+                 headless=True,
+                 wait_seconds=30):
 
         self.url = url
 
@@ -64,16 +247,45 @@ class HLScraper(object):
             self.end_date = date.today()
         else:
             self.end_date = self._conv_date(end_date)
-        self.driver = None
+        # Each scraper thread drives its own session and gauge
+        self._local = local()
+        self.pool = BrowserPool(size=sessions, headless=headless)
+        # Longest explicit wait for a postback or the result table
+        self.wait_seconds = wait_seconds
         self.gauge_list = None
-        self.cur_gauge = None
-        self.md = ManipulateDatabase()
-        if not localhostdb:
-            self.md.load_dbinfo_server()
+        self.incremental = incremental
+        self.latest_dates = {}
+        # End date of the next window of each (gauge, sensor) walk,
+        # None once the walk is done, so a gauge retried after a
+        # browser error goes on where it stopped
+        self._walk_ends = {}
+        self.md = ManipulateDatabase(pool=get_pool(server=not localhostdb))
         self.md.connect()
+        self.loader = HydrometLoader(self.md,
+                                     batch_rows=batch_rows,
+                                     commit_rows=commit_rows)
+        self._db_lock = Lock()
         self.log = open(logname, 'w')
 
 
+    @property
+    def driver(self):
+        """Browser session of the current thread"""
+        return getattr(self._local, 'driver', None)
+
+    @driver.setter
+    def driver(self, driver):
+        self._local.driver = driver
+
+    @property
+    def cur_gauge(self):
+        """Gauge the current thread is scraping"""
+        return getattr(self._local, 'cur_gauge', None)
+
+    @cur_gauge.setter
+    def cur_gauge(self, gauge):
+        self._local.cur_gauge = gauge
+
 
     def start(self,
               url='http://hydromet.lcra.org/chronhist.aspx',
@@ -87,6 +299,8 @@ class HLScraper(object):
         for STDOUT to log the behavior
         """
         self.log.write("Start Scraper\n")
+        if self.incremental:
+            self.latest_dates = self.md.get_latest_gauge_dates()
         self.get_remaining_gauge_list(self.start_gauge_value,
                                       self.end_gauge_value)
 
@@ -96,7 +310,13 @@ class HLScraper(object):
 
 
     def quit(self):
-        self.driver.quit()
+        self.pool.quit()
+        self.loader.close()
+        self.log.write("loaded \t\t- {} records {:.0f} records/sec\n".\
+            format(self.loader.rows, self.loader.rows_per_second))
+        self.log.write(METRICS.summary().to_string(
+            float_format='{:.3f}'.format) + "\n")
+        self.md.close()
 
 
     def get_remaining_gauge_list(self,
@@ -136,43 +356,54 @@ class HLScraper(object):
         # allgauges = dl1.find_all("option")
         #
         # return [(g.get('value'), g.contents[0]) for g in allgauges]
-        df = pd.read_csv("gauge_list.csv",
-                          dtype={'value':np.int32,
-                                 'name':np.dtype('S')})
-        return [(val, name) for val, name in df.itertuples(index=False)]
-
-    def _refresh_driver(self):
-        if self.driver:
-            self.driver.quit()
-        self.driver = webdriver.Chrome()
-        # self.driver = webdriver.PhantomJS()
-        # self.driver.set_window_size(1120, 550) # CHECK TIME SPLIT with phantom JS and chrome
-        self.driver.implicitly_wait(30)
-        self.driver.get(self.url)
-
+        return scrape_list()
 
     def _cycle_gauges(self):
-        """Cycles through the gauges in the gauge list.
+        """Cycles through the gauges in the gauge list, one gauge per
+        browser session at a time.
         Calls the _cycle_options function to cycle through sensors
+
+        A gauge retried after a browser error skips the sensors it
+        finished and goes on after the last window it loaded, the
+        readings loaded before the error are not loaded again.
         """
+        failed = self.pool.map(self._scrape_gauge, self.gauge_list)
+        for (gaugevalue, gaugename), error in failed:
+            self.log.write("exception \t- gauge {} {!r}\n".format(gaugevalue,
+                                                                error))
+        self.log.write("sessions \t- {} restarted\n".format(
+            self.pool.restarts))
+
+
+    def _scrape_gauge(self, driver, gauge):
+        """Scrapes every sensor of one gauge with a pooled session"""
+        gaugevalue, gaugename = gauge
+        self.driver = driver
+        self.cur_gauge = gaugevalue
+        # Fresh form, the session itself is kept
+        with METRICS.timer('scrape.page_load', gauge=gaugevalue):
+            self.driver.get(self.url)
+            element = self._wait_for_name('DropDownList1')
+
+        with METRICS.timer('scrape.postback', gauge=gaugevalue):
+            Select(element).select_by_value(str(gaugevalue))
+            self._wait_for_postback(element)
+
+        self._cycle_options()
 
-        for gaugevalue, gaugename in self.gauge_list:
-            self._refresh_driver()
-            select = Select(
-                     self.driver.find_element_by_name('DropDownList1')
-                           )
-            self.log.write(("-" * 70) + "\n")
-            self.log.write(("-" * 70) + "\n")
-            self.log.write((" " * 70) + "\n")
-            self.log.write( "selected \t- DropDownList1\n")
-            select.select_by_value(str(gaugevalue))
-            self.cur_gauge = gaugevalue
-            self.log.write( "clicked \t- {:15} {:15}\n".\
-                format(gaugevalue, gaugename))
-            self.log.write(("-" * 70) + "\n")
-            self.log.write(("-" * 70) + "\n")
-
-            self._cycle_options()
+
+    def _wait_for_name(self, name):
+        """Element by name once it is on the page"""
+        return WebDriverWait(self.driver, self.wait_seconds).until(
+            EC.presence_of_element_located((By.NAME, name)))
+
+
+    def _wait_for_postback(self, element):
+        """Waits for the page to reload if changing element posts
+        the form back (ASP.NET AutoPostBack)"""
+        if '__doPostBack' in (element.get_attribute('onchange') or ''):
+            WebDriverWait(self.driver, self.wait_seconds).until(
+                EC.staleness_of(element))
 
 
     def _cycle_options(self):
@@ -182,17 +413,14 @@ class HLScraper(object):
         sensor_options = self._get_sensor_options()
 
         for optionvalue, optionname in sensor_options:
-            select = Select(
-                     self.driver.find_element_by_name('DropDownList2')
-                           )
-            select.select_by_value(optionvalue)
-            # option.click()
-            self.log.write(("-" * 70) + "\n")
-            self.log.write("\nselected \t- DropDownList2\n")
-            self.log.write("clicked \t- {:15} {:15}\n".\
-                format(optionvalue, optionname))
-            self.log.write(("-" * 70) + "\n")
-            self._cycle_dates()
+            key = (str(self.cur_gauge), optionvalue)
+            if key in self._walk_ends and self._walk_ends[key] is None:
+                continue
+            with METRICS.timer('scrape.postback', gauge=self.cur_gauge):
+                element = self._wait_for_name('DropDownList2')
+                Select(element).select_by_value(optionvalue)
+                self._wait_for_postback(element)
+            self._cycle_dates(key)
 
 
     def _get_sensor_options(self):
@@ -205,81 +433,90 @@ class HLScraper(object):
         return [(o.get('value'), o.contents[0]) for o in alloptions]
 
 
-    def _cycle_dates(self):
-        """Cycles through date options"""
-        drang = timedelta(days=179)  ##### MAY BE ATTR IN FUTURE
-        cur_end_date = self.end_date
-        cur_start_date = cur_end_date - drang
+    def _cycle_dates(self, key):
+        """Cycles through date options, each window sized from the
+        readings and response time of the one before (WindowSizer)
 
-        while cur_end_date >= self.start_date:
+        key - (gauge, sensor option) of the walk, which starts after
+              the last window loaded by an earlier attempt
+        """
+        sizer = WindowSizer()
+        start_date = self._gauge_start_date()
+        window = sizer.window(self._walk_ends.get(key, self.end_date),
+                              start_date)
+
+        while window:
+            cur_start_date, cur_end_date = window
             self._enter_dates(cur_start_date, cur_end_date)
 
-            submit = self.driver.find_element_by_name("Button1")
-            submit.click()
-            self.log.write( "clicked \t- Button1\n")
+            started = time()
+            with METRICS.timer('scrape.submit', gauge=self.cur_gauge):
+                submit = self._wait_for_name("Button1")
+                submit.click()
+                # The result page replaces the form
+                WebDriverWait(self.driver, self.wait_seconds).until(
+                    EC.staleness_of(submit))
 
             flag = self._parse_table()
             if flag == "break":
                 break
+            # Handed to the loader, a retry must not load it again
+            self._walk_ends[key] = cur_start_date - timedelta(1)
+            sizer.update((cur_end_date - cur_start_date).days, flag,
+                         time() - started)
+
+            window = sizer.window(cur_start_date - timedelta(1), #inclusive
+                                  start_date)
+        self._walk_ends[key] = None
 
-            cur_end_date = cur_start_date - timedelta(1) #inclusive
-            cur_start_date = max(cur_end_date - drang, self.start_date)
+
+    def _gauge_start_date(self):
+        """Oldest date to scrape for the current gauge: start_date, or
+        the day of its latest observation in incremental mode"""
+        latest = self.latest_dates.get(str(self.cur_gauge))
+        if latest is None:
+            return self.start_date
+        return max(latest, self.start_date)
 
 
     def _enter_dates(self, start, end):
-        start_date_field = self.driver.find_element_by_name("Date1")
-        end_date_field = self.driver.find_element_by_name("Date2")
+        start_date_field = self._wait_for_name("Date1")
+        end_date_field = self._wait_for_name("Date2")
 
         start_date_field.clear()
         start_date_field.send_keys(self._conv_date(start))
         end_date_field.clear()
         end_date_field.send_keys(self._conv_date(end))
 
-        self.log.write( "selected \t- Date2\n")
-        self.log.write( "entered \t- {:15} {:15}\n".\
-            format("End Date", self._conv_date(end)))
-        self.log.write( "selected \t- Date1\n")
-        self.log.write( "entered \t- {:15} {:15}\n".\
-            format("Start Date", self._conv_date(start)))
-
 
     def _parse_table(self):
-        """Check if table exists, then parse using bs4"""
-        try:
-            table = self.driver.find_element_by_tag_name("tbody")
-        except NoSuchElementException:
-            self.log.write( "exception \t- tbody not found\n")
-            return "break"
-
-        soup = BeautifulSoup(self.driver.page_source, 'lxml')
-        tbody = soup.find("tbody")
-
-        rows = tbody.children
-        headers = [header.string for header
-                      in rows.next().children][1:-1]
+        """Check if table exists, then parse it with lxml. Returns
+        the number of readings, "break" if there is no table
 
-        inserts = []
-        for row in list(rows)[:-1]:
-            values = [v.string for v in row.children][1:-1]
+        Called once the result page has loaded, so a missing tbody
+        is known at once instead of after a 30 second implicit wait
+        """
+        if not self.driver.find_elements_by_tag_name("tbody"):
+            METRICS.count('scrape.no_table', gauge=self.cur_gauge)
+            return "break"
 
-            for val, head in zip(values[1:], headers[1:]):
-                if val.string == u'\xa0':
-                    insval = None
-                else:
-                    insval = float(val)
-                inserts.append((values[0], str(self.cur_gauge), head, insval))
-        self.log.write( "parsed \t\t- tbody\n")
+        with METRICS.timer('scrape.parse', gauge=self.cur_gauge) as timing:
+            page_source = self.driver.page_source
+            inserts = parse_chronhist_table(page_source, self.cur_gauge)
+            timing.rows = len(inserts)
+            timing.bytes = len(page_source)
 
         self._sql_entry(inserts)
+        return len(inserts)
 
 
     def _sql_entry(self, inserts):
-
-        self.md.insert_gauge_readings(inserts)
-
-        now = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-        self.log.write( "access time\t- {}\n".format(now))
-        self.log.write( "inserted \t- {} records\n\n".format(len(inserts)))
+        """Hands readings to the loader, timed with the wait for the
+        other sessions' inserts"""
+        with METRICS.timer('scrape.insert', gauge=self.cur_gauge) as timing:
+            timing.rows = len(inserts)
+            with self._db_lock:
+                self.loader.add(inserts)
 
     def _conv_date(self, dt):
         """Convert a string of m/d/Y to date object
@@ -309,12 +546,21 @@ if __name__ == "__main__":
     if len(argv) > 3:
         logname = argv[3]
 
+    incremental = len(argv) > 4 and argv[4] == "incremental"
+
+    sessions = 4
+    if len(argv) > 5:
+        sessions = int(argv[5])
+
+    METRICS.configure(logname + '.metrics.jsonl')
     hls = HLScraper(start_gauge_value=start_gauge_value,
                     end_gauge_value=end_gauge_value,
                     start_date='01/01/1950',
                     end_date=None,
                     localhostdb=False,
-                    logname=logname)
+                    logname=logname,
+                    incremental=incremental,
+                    sessions=sessions)
     hls.start()
 
     hls.quit()
@@ -0,0 +1,144 @@
+"""Continuous lake inflow series from lake-level readings.
+
+The 15 minute lake levels of a dam are median smoothed to knock out
+sensor spikes, converted to storage with the dam's rating curve and
+differenced into a net inflow rate (acre-feet/hour, storage change
+including releases). Storage at any time is interpolated from the
+series, so the inflow over any window is a subtraction instead of a
+query. Like the rate, storage is not interpolated across gaps longer
+than max_gap_hours:
+
+    series = derive_inflow(times, levels, get_curve('3963'))
+    acre_feet = window_inflow(series, starts, ends)
+
+optional arguments:
+python inflow.py gauge
+"""
+
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+from rating_curves import get_curve
+
+
+LAKE_SENSOR = 'Lake Level (ft above MSL)'
+
+
+def derive_inflow(times, levels, curve, smooth_readings=13,
+                  max_gap_hours=2):
+    """Storage and net inflow for a lake-level series
+
+    INPUT:
+        times           | sorted datetime64 array
+        levels          | ft-MSL readings aligned with times
+        curve           | RatingCurve of the dam
+        smooth_readings | width of the centered rolling median, 13
+                          readings is about 3 hours
+        max_gap_hours   | no rate across gaps longer than this
+
+    OUTPUT:
+        DataFrame   | index collection_time,
+                      [level | volume | inflow]
+                      volume in acre-feet of the smoothed level,
+                      inflow in acre-feet/hour over the interval
+                      ending at each reading (NaN for the first)
+    """
+    times = np.asarray(times, dtype='datetime64[ns]')
+    levels = np.asarray(levels, dtype=np.float64)
+
+    smoothed = pd.Series(levels).rolling(smooth_readings, center=True,
+                                         min_periods=1).median().values
+    volume = curve.volume(smoothed)
+
+    inflow = np.full(times.shape[0], np.nan)
+    if times.shape[0] > 1:
+        hours = np.diff(times).astype('timedelta64[s]').astype(np.float64)
+        hours /= 3600.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.diff(volume) / hours
+        rate[(hours <= 0) | (hours > max_gap_hours)] = np.nan
+        inflow[1:] = rate
+
+    return pd.DataFrame({'level': levels,
+                         'volume': volume,
+                         'inflow': inflow},
+                        columns=['level', 'volume', 'inflow'],
+                        index=pd.Index(times, name='collection_time'))
+
+
+def storage_at(series, times, max_gap_hours=2):
+    """Storage (acre-feet) at arbitrary times, linearly interpolated
+    between readings, NaN outside the series and between readings
+    more than max_gap_hours apart"""
+    known = series['volume'].notnull().values
+    index = series.index.values[known].astype(np.int64)
+    volume = series['volume'].values[known]
+    t = np.asarray(pd.to_datetime(times).values).astype(np.int64)
+    if index.shape[0] == 0:
+        return np.full(t.shape[0], np.nan)
+
+    # Reading at or before each time
+    i = np.searchsorted(index, t, side='right') - 1
+    i = np.clip(i, 0, max(index.shape[0] - 2, 0))
+    j = np.minimum(i + 1, index.shape[0] - 1)
+    span = (index[j] - index[i]).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(span > 0, (t - index[i]) / span, 0.)
+    out = volume[i] + frac * (volume[j] - volume[i])
+    # A time on a reading needs no interpolation
+    bridged = ((span <= max_gap_hours * 3600e9) |
+               (t == index[i]) | (t == index[j]))
+    return np.where((t >= index[0]) & (t <= index[-1]) & bridged,
+                    out, np.nan)
+
+
+def window_inflow(series, starts, ends, max_gap_hours=2):
+    """Net inflow in acre-feet over each [start, end] window
+
+    INPUT:
+        DataFrame       | derive_inflow output
+        starts/ends     | window bounds, any datetime-like sequence
+        max_gap_hours   | as for derive_inflow, NaN for a window with
+                          an edge inside a longer gap
+    """
+    return (storage_at(series, ends, max_gap_hours) -
+            storage_at(series, starts, max_gap_hours))
+
+
+def load_inflow(md, gauge, smooth_readings=13, max_gap_hours=2,
+                itersize=100000):
+    """derive_inflow for a dam's full lake-level history in hydromet
+
+    INPUT:
+        ManipulateDatabase
+        gauge       | gauge id with a rating curve, e.g. '3963'
+    """
+    curve = get_curve(gauge)
+    if curve is None:
+        raise KeyError("No rating curve for gauge {}".format(gauge))
+
+    chunks = list(md.iter_sensor_readings(gauge, LAKE_SENSOR,
+                                          itersize=itersize))
+    if chunks:
+        readings = pd.concat(chunks, ignore_index=True)
+    else:
+        readings = pd.DataFrame({'collection_time': np.array([], 'M8[ns]'),
+                                 'value': np.array([], np.float64)})
+    return derive_inflow(readings['collection_time'].values,
+                         readings['value'].values, curve,
+                         smooth_readings=smooth_readings,
+                         max_gap_hours=max_gap_hours)
+
+
+if __name__ == "__main__":
+    from sql_class import ManipulateDatabase, get_pool
+
+    gauge = '3963'
+    if len(argv) > 1:
+        gauge = argv[1]
+
+    with ManipulateDatabase(pool=get_pool()) as md:
+        series = load_inflow(md, gauge)
+    print series.describe()
@@ -0,0 +1,369 @@
+"""Timers and counters for the scrapers, the database and the pipeline.
+
+Every timed phase (page load, form submit, parse, COPY, each query,
+each pipeline stage) is recorded with its duration and, where known,
+the rows and bytes it handled. A timer started inside another timer
+of the same thread records that one as its parent, so nested phases
+(the queries of a pipeline stage) are not counted twice in the
+shares of the report. Events are kept as running totals in memory
+and, once configured, appended to a JSON-lines file, one object per
+event, so several processes can share one file.
+
+    from metrics import METRICS
+    METRICS.configure('scrape.metrics.jsonl')
+    with METRICS.timer('scrape.parse', gauge='3963') as t:
+        inserts = parse_chronhist_table(page, '3963')
+        t.rows = len(inserts)
+    METRICS.count('scrape.empty_window')
+    print METRICS.prometheus_text()
+
+optional arguments:
+python metrics.py report file.jsonl [file.jsonl ...]
+    per-phase latency breakdown of recorded events
+python metrics.py prometheus file.jsonl [file.jsonl ...]
+    the same events as Prometheus text
+"""
+
+import json
+import os
+import re
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock, local
+from time import time
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+
+class Timing(object):
+    """Handed out by Metrics.timer, set rows/bytes inside the block"""
+
+    def __init__(self):
+        self.rows = None
+        self.bytes = None
+        self.seconds = None
+
+
+class Metrics(object):
+    """
+    Process wide registry of timings and counters
+
+    path - JSON-lines file events are appended to, None to only keep
+           the in-memory totals
+    """
+
+    def __init__(self, path=None):
+        self._lock = Lock()
+        # Names of the timers running in each thread, innermost last
+        self._local = local()
+        self._fd = None
+        self._pid = None
+        self.path = None
+        self.totals = {}
+        self.counters = {}
+        if path is not None:
+            self.configure(path)
+
+
+    def configure(self, path):
+        """Appends events to path from now on"""
+        with self._lock:
+            self._close()
+            self.path = path
+            if path is not None:
+                directory = os.path.dirname(path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Times the block as one event of `name`"""
+        timing = Timing()
+        running = self._running()
+        running.append(name)
+        start = time()
+        try:
+            yield timing
+        finally:
+            timing.seconds = time() - start
+            running.pop()
+            self.record(name, timing.seconds, rows=timing.rows,
+                        bytes=timing.bytes, **labels)
+
+
+    def timed(self, name):
+        """Decorator timing every call, rows are the length of a list
+        or DataFrame result"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name) as timing:
+                    result = func(*args, **kwargs)
+                    if isinstance(result, (list, pd.DataFrame)):
+                        timing.rows = len(result)
+                return result
+            return wrapper
+        return decorator
+
+
+    def record(self, name, seconds, rows=None, bytes=None, **labels):
+        """One timed event, nested in the timer running in this thread
+        if there is one"""
+        running = self._running()
+        parent = running[-1] if running else None
+        key = (name, _label_key(labels))
+        with self._lock:
+            total = self.totals.get(key)
+            if total is None:
+                total = self.totals[key] = {'calls': 0, 'seconds': 0.,
+                                            'top_seconds': 0.,
+                                            'max_seconds': 0.,
+                                            'rows': 0, 'bytes': 0}
+            total['calls'] += 1
+            total['seconds'] += seconds
+            if parent is None:
+                total['top_seconds'] += seconds
+            total['max_seconds'] = max(total['max_seconds'], seconds)
+            total['rows'] += rows or 0
+            total['bytes'] += bytes or 0
+        self._write({'name': name, 'seconds': seconds, 'rows': rows,
+                     'bytes': bytes, 'parent': parent, 'labels': labels})
+
+
+    def count(self, name, value=1, **labels):
+        """Adds value to the counter `name`"""
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._write({'name': name, 'count': value, 'labels': labels})
+
+
+    def summary(self):
+        """Totals recorded by this process as a report frame"""
+        events = []
+        for (name, labels), total in self.totals.items():
+            events.append(dict(total, name=name, labels=dict(labels)))
+        return summarize(pd.DataFrame(events), totals=True)
+
+
+    def prometheus_text(self):
+        """Totals of this process in the Prometheus text format"""
+        timings = [(name, dict(labels), total) for (name, labels), total
+                   in sorted(self.totals.items())]
+        counters = [(name, dict(labels), value) for (name, labels), value
+                    in sorted(self.counters.items())]
+        return _prometheus(timings, counters)
+
+
+    def reset(self):
+        with self._lock:
+            self.totals = {}
+            self.counters = {}
+
+
+    def _running(self):
+        if not hasattr(self._local, 'timers'):
+            self._local.timers = []
+        return self._local.timers
+
+
+    def _write(self, event):
+        if self.path is None:
+            return
+        event['ts'] = time()
+        event['pid'] = os.getpid()
+        line = json.dumps(event, default=str) + '\n'
+        with self._lock:
+            if self._fd is None or self._pid != os.getpid():
+                # Workers forked from a process with the file open
+                # get their own descriptor
+                self._fd = os.open(self.path,
+                                   os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                   0o644)
+                self._pid = os.getpid()
+            # One write per line so processes do not interleave lines
+            os.write(self._fd, line)
+
+
+    def _close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+
+# Shared by every module of a process
+METRICS = Metrics()
+
+
+def read_events(paths):
+    """Events of one or more JSON-lines files as a DataFrame"""
+    events = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    return pd.DataFrame(events)
+
+
+def summarize(events, by_labels=False, totals=False):
+    """Per-phase latency breakdown
+
+    INPUT:
+        DataFrame   | read_events output, or per-key totals with
+                      totals=True (Metrics.summary)
+        by_labels   | one row per name and label set instead of name
+
+    OUTPUT:
+        DataFrame   | index name, [calls | total_s | share | mean_ms |
+                      p50_ms | p95_ms | max_ms | rows | rows_per_s |
+                      mb], slowest total first. Percentiles need the
+                      individual events and are NaN for totals.
+
+    share is total_s over the time of the top-level phases, the ones
+    not timed inside another timer. Nested phases are already part of
+    their parent's time, so only the top-level shares add up to 1.
+    Events recorded without a parent field count as top-level.
+    """
+    columns = ['calls', 'total_s', 'share', 'mean_ms', 'p50_ms',
+               'p95_ms', 'max_ms', 'rows', 'rows_per_s', 'mb']
+    if events.empty or 'seconds' not in events:
+        return pd.DataFrame(columns=columns)
+
+    timed = events[events['seconds'].notnull()].copy()
+    timed['key'] = timed['name']
+    if by_labels:
+        timed['key'] = [name + _label_text(labels or {})
+                        for name, labels in zip(timed['name'],
+                                                timed['labels'])]
+    for column in ('rows', 'bytes'):
+        timed[column] = pd.to_numeric(timed[column]).fillna(0)
+    if totals:
+        top = timed['top_seconds'].astype(np.float64)
+    elif 'parent' in timed:
+        top = timed['seconds'].where(timed['parent'].isnull(), 0.)
+    else:
+        top = timed['seconds']
+    top_seconds = top.sum()
+
+    rows = []
+    for key, group in timed.groupby('key'):
+        seconds = group['seconds'].values.astype(np.float64)
+        if totals:
+            calls = group['calls'].sum()
+            total = seconds.sum()
+            p50 = p95 = np.nan
+            longest = group['max_seconds'].max()
+        else:
+            calls = len(seconds)
+            total = seconds.sum()
+            p50, p95 = np.percentile(seconds, [50, 95])
+            longest = seconds.max()
+        n_rows = group['rows'].sum()
+        rows.append({'name': key,
+                     'calls': int(calls),
+                     'total_s': total,
+                     'mean_ms': 1000. * total / max(calls, 1),
+                     'p50_ms': 1000. * p50,
+                     'p95_ms': 1000. * p95,
+                     'max_ms': 1000. * longest,
+                     'rows': int(n_rows),
+                     'rows_per_s': n_rows / total if total > 0 else np.nan,
+                     'mb': group['bytes'].sum() / 1e6})
+
+    df = pd.DataFrame(rows).set_index('name')
+    df['share'] = (df['total_s'] / top_seconds if top_seconds > 0
+                   else np.nan)
+    return df.sort_values('total_s', ascending=False)[columns]
+
+
+def events_prometheus_text(events):
+    """Prometheus text of recorded events, totals per name/labels"""
+    timings = {}
+    counters = {}
+    for event in events.to_dict('records'):
+        labels = event.get('labels') or {}
+        key = (event['name'], _label_key(labels))
+        if 'count' in event and not pd.isnull(event.get('count')):
+            counters[key] = counters.get(key, 0) + event['count']
+            continue
+        total = timings.setdefault(key, {'calls': 0, 'seconds': 0.,
+                                         'rows': 0, 'bytes': 0})
+        total['calls'] += 1
+        total['seconds'] += event['seconds']
+        for column in ('rows', 'bytes'):
+            if not pd.isnull(event.get(column)):
+                total[column] += event[column]
+    return _prometheus(
+        [(name, dict(labels), total) for (name, labels), total
+         in sorted(timings.items())],
+        [(name, dict(labels), value) for (name, labels), value
+         in sorted(counters.items())])
+
+
+def _prometheus(timings, counters):
+    lines = []
+    typed = set()
+    for name, labels, total in timings:
+        metric = _metric_name(name)
+        if metric not in typed:
+            lines.append('# TYPE {}_seconds summary'.format(metric))
+            typed.add(metric)
+        text = _label_text(labels)
+        lines.append('{}_seconds_count{} {}'.format(metric, text,
+                                                    total['calls']))
+        lines.append('{}_seconds_sum{} {!r}'.format(metric, text,
+                                                    float(total['seconds'])))
+        if total['rows']:
+            lines.append('{}_rows_total{} {}'.format(metric, text,
+                                                     int(total['rows'])))
+        if total['bytes']:
+            lines.append('{}_bytes_total{} {}'.format(metric, text,
+                                                      int(total['bytes'])))
+    for name, labels, value in counters:
+        metric = _metric_name(name)
+        if metric not in typed:
+            lines.append('# TYPE {}_total counter'.format(metric))
+            typed.add(metric)
+        lines.append('{}_total{} {}'.format(metric, _label_text(labels),
+                                            _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _number(value):
+    """Whole numbers without the .0 JSON/pandas round trips add"""
+    if float(value).is_integer():
+        return int(value)
+    return repr(float(value))
+
+
+def _metric_name(name):
+    return 'hl_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in sorted(labels.items())) + '}'
+
+
+if __name__ == "__main__":
+    if len(argv) < 3 or argv[1] not in ('report', 'prometheus'):
+        print "python metrics.py report|prometheus file.jsonl [...]"
+        raise SystemExit(1)
+
+    events = read_events(argv[2:])
+    if argv[1] == 'prometheus':
+        print events_prometheus_text(events),
+    else:
+        pd.set_option('display.width', 160)
+        print summarize(events).to_string(float_format='{:.3f}'.format)
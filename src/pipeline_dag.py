@@ -0,0 +1,168 @@
+"""Memoized stage graph for the storm pipeline.
+
+Stages are functions of the DataFrames of their input stages and of
+keyword parameters. Every output is saved to a ColumnarCache under a
+key hashed from the stage name, its parameters and the keys of its
+inputs (or the source version for stages without inputs). A
+parameter change therefore only re-runs the stages downstream of it,
+everything else is read back from the cache.
+
+Stages whose inputs are ready run at the same time, in threads of
+one process. Their time goes to database queries and numpy, which
+release the GIL, and they share the process's connection pool.
+
+    dag = PipelineDAG(ColumnarCache('../cache'), source=version)
+    dag.add('moving_sum', moving_sum_stage,
+            params={'leading_hours': 10, 'trailing_hours': 24})
+    dag.add('storms', storm_events_stage, ['moving_sum'],
+            {'threshold': 0.5})
+    frames = dag.run(['storms'])
+"""
+
+import sys
+from collections import OrderedDict
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from Queue import Queue
+
+import pandas as pd
+
+from metrics import METRICS
+
+
+class Stage(object):
+    """One node of the graph, func(*input frames, **params) returns
+    a DataFrame"""
+
+    def __init__(self, name, func, inputs=(), params=None):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.params = dict(params or {})
+
+
+class PipelineDAG(object):
+    """
+    Stage graph with cached, parameter keyed outputs
+
+    source - identifies the data the root stages read, e.g.
+             ManipulateDatabase.data_version()
+    """
+
+    def __init__(self, cache, source=None):
+        self.cache = cache
+        self.source = source
+        self.stages = OrderedDict()
+        # Stages executed (not read from the cache) by the last run
+        self.ran = []
+
+
+    def add(self, name, func, inputs=(), params=None):
+        """Adds a stage, its inputs must already be in the graph so
+        stages are always in a runnable order"""
+        if name in self.stages:
+            raise ValueError("Stage {} already exists".format(name))
+        for upstream in inputs:
+            if upstream not in self.stages:
+                raise ValueError("Unknown input {} for stage {}".format(
+                    upstream, name))
+        stage = Stage(name, func, inputs, params)
+        self.stages[name] = stage
+        return stage
+
+
+    def key(self, name):
+        """Cache key of a stage's output"""
+        stage = self.stages[name]
+        if stage.inputs:
+            source = [self.key(upstream) for upstream in stage.inputs]
+        else:
+            source = self.source
+        return self.cache.key(name, stage.params, source=source)
+
+
+    def run(self, targets=None, processes=None):
+        """Brings targets (default every stage) up to date
+
+        Only stages needed by the targets and missing from the cache
+        are executed, up to `processes` at a time (default one per
+        cpu).
+
+        OUTPUT:
+            dict    | {target: DataFrame}
+        """
+        if targets is None:
+            targets = list(self.stages)
+        needed = self._upstream(targets)
+        keys = {name: self.key(name) for name in needed}
+
+        done = set(name for name in needed
+                   if self.cache.exists(keys[name]))
+        pending = [name for name in self.stages
+                   if name in needed and name not in done]
+        self.ran = []
+        METRICS.count('pipeline.cache_hits', len(done))
+
+        if pending:
+            pool = ThreadPool(processes or cpu_count())
+            finished = Queue()
+            running = set()
+            try:
+                while pending or running:
+                    ready = [name for name in pending
+                             if all(upstream in done for upstream
+                                    in self.stages[name].inputs)]
+                    for name in ready:
+                        pending.remove(name)
+                        running.add(name)
+                        pool.apply_async(self._run_stage, (name, keys),
+                                         callback=finished.put)
+
+                    name, error = finished.get()
+                    running.discard(name)
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    done.add(name)
+                    self.ran.append(name)
+            finally:
+                pool.close()
+                pool.join()
+
+        return {name: self.cache.load(keys[name]) for name in targets}
+
+
+    def _run_stage(self, name, keys):
+        """Runs one stage from its cached inputs and caches its output,
+        returns (name, exc_info or None)"""
+        try:
+            stage = self.stages[name]
+            with METRICS.timer('pipeline.cache_load', stage=name):
+                frames = [self.cache.load(keys[upstream])
+                          for upstream in stage.inputs]
+            with METRICS.timer('pipeline.stage', stage=name) as timing:
+                output = stage.func(*frames, **stage.params)
+                if isinstance(output, pd.DataFrame):
+                    timing.rows = len(output)
+            if not isinstance(output, pd.DataFrame):
+                raise TypeError("Stage {} returned {}, not a DataFrame".
+                                format(name, type(output).__name__))
+            with METRICS.timer('pipeline.cache_save', stage=name) as timing:
+                self.cache.save(keys[name], output, params=stage.params)
+                timing.rows = len(output)
+            return name, None
+        except Exception:
+            return name, sys.exc_info()
+
+
+    def _upstream(self, targets):
+        """targets and every stage they depend on"""
+        needed = set()
+        stack = list(targets)
+        while stack:
+            name = stack.pop()
+            if name not in self.stages:
+                raise KeyError("Unknown stage {}".format(name))
+            if name not in needed:
+                needed.add(name)
+                stack.extend(self.stages[name].inputs)
+        return needed
@@ -0,0 +1,184 @@
+"""Elevation to volume/area rating curves for the Highland Lakes.
+
+Each table in tables/ (ft-MSL, acres, acre-feet at 0.1 ft steps) is
+loaded once into sorted NumPy arrays. Levels are converted by linear
+interpolation between the two surrounding rows, found with
+searchsorted, so readings between grid points get a volume instead
+of dropping out. Levels outside the table give NaN.
+
+The shipped tables are the rating_table entries of the gauge
+registry (gauge_list.csv). Curves are registered by gauge id and dam
+name:
+
+    curve = get_curve('3963')           # or get_curve('Mansfield Dam')
+    acre_feet = curve.volume(levels)
+    df = convert_levels(df)             # every registered lake column
+
+optional arguments:
+python rating_curves.py gauge level [level ...]
+"""
+
+import os
+from threading import Lock
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+from gauge_registry import rating_tables
+
+
+TABLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         os.pardir, 'tables')
+
+_CURVES = {}
+_CURVES_LOCK = Lock()
+
+
+class RatingCurve(object):
+    """
+    Elevation (ft-MSL) to storage (acre-feet) and surface area (acres)
+    """
+
+    def __init__(self, elevation, volume, area=None, gauge=None,
+                 name=None):
+        order = np.argsort(elevation, kind='mergesort')
+        self.elevation = np.asarray(elevation, dtype=np.float64)[order]
+        self.volume_af = np.asarray(volume, dtype=np.float64)[order]
+        self.area_acres = None
+        if area is not None:
+            self.area_acres = np.asarray(area, dtype=np.float64)[order]
+        if (self.elevation.shape[0] < 2 or
+                (np.diff(self.elevation) <= 0).any()):
+            raise ValueError("A rating curve needs two or more distinct "
+                             "elevations")
+        self.gauge = gauge
+        self.name = name
+
+
+    @classmethod
+    def from_table(cls, path, gauge=None, name=None):
+        """Reads a tables/ style csv: ft-MSL, acres, acre-feet"""
+        table = pd.read_csv(path)
+        area = table['acres'].values if 'acres' in table else None
+        return cls(table['ft-MSL'].values, table['acre-feet'].values,
+                   area=area, gauge=gauge, name=name)
+
+
+    def volume(self, levels):
+        """Storage in acre-feet at each level"""
+        return _interpolate(levels, self.elevation, self.volume_af)
+
+
+    def area(self, levels):
+        """Surface area in acres at each level"""
+        if self.area_acres is None:
+            raise ValueError("No area column for {}".format(self.name))
+        return _interpolate(levels, self.elevation, self.area_acres)
+
+
+    def level(self, volumes):
+        """Inverse of volume, the lowest level holding each volume"""
+        # Flat stretches of the table repeat volumes. A volume on a
+        # flat stretch takes its first elevation, one between two
+        # stretches rises from the last elevation of the lower one.
+        volume, first = np.unique(self.volume_af, return_index=True)
+        last = np.append(first[1:] - 1, self.volume_af.shape[0] - 1)
+        volumes = np.asarray(volumes, dtype=np.float64)
+        i = np.searchsorted(volume, volumes, side='right') - 1
+        i = np.clip(i, 0, volume.shape[0] - 2)
+        frac = (volumes - volume[i]) / (volume[i + 1] - volume[i])
+        lower = self.elevation[last[i]]
+        out = lower + frac * (self.elevation[first[i + 1]] - lower)
+        out = np.where(volumes == volume[i], self.elevation[first[i]], out)
+        with np.errstate(invalid='ignore'):
+            return np.where((volumes >= volume[0]) & (volumes <= volume[-1]),
+                            out, np.nan)
+
+
+def register_curve(curve, gauge=None, name=None):
+    """Makes a curve available to get_curve by gauge id and name"""
+    gauge = gauge or curve.gauge
+    name = name or curve.name
+    with _CURVES_LOCK:
+        for key in (gauge, name):
+            if key is not None:
+                _CURVES[str(key)] = curve
+
+
+def get_curve(key):
+    """Curve for a gauge id or dam name, None if there is none.
+    The shipped tables are loaded on first use."""
+    key = str(key)
+    if key not in _CURVES:
+        _load_default(key)
+    return _CURVES.get(key)
+
+
+def convert_levels(df, columns=None, quantity='volume'):
+    """Converts lake level columns of df to volume or area
+
+    columns  - columns to convert, default every column whose name,
+               less a _min/_max suffix, has a registered curve
+               (gauge id like '3963_max' or name like 'Mansfield Dam')
+    quantity - 'volume' (acre-feet) or 'area' (acres)
+
+    Works on any frame of levels, storm min/max or a full time series
+    with one column per gauge. Returns a converted copy.
+    """
+    df = df.copy()
+    if columns is None:
+        columns = [c for c in df if _column_curve(c) is not None]
+    for column in columns:
+        curve = _column_curve(column)
+        if curve is None:
+            raise KeyError("No rating curve for {}".format(column))
+        df[column] = getattr(curve, quantity)(df[column].values)
+    return df
+
+
+def _column_curve(column):
+    if not isinstance(column, basestring):
+        return None
+    base = column
+    for suffix in ('_min', '_max'):
+        if column.endswith(suffix):
+            base = column[:-len(suffix)]
+    return get_curve(base)
+
+
+def _load_default(key):
+    for gauge, (name, filename) in rating_tables().items():
+        if key in (gauge, name):
+            curve = RatingCurve.from_table(os.path.join(TABLE_DIR, filename),
+                                           gauge=gauge, name=name)
+            register_curve(curve)
+
+
+def _interpolate(x, xp, fp):
+    """np.interp with NaN outside [xp[0], xp[-1]] instead of clamping"""
+    x = np.asarray(x, dtype=np.float64)
+    # Row at or below each x, the last interval takes x == xp[-1]
+    i = np.searchsorted(xp, x, side='right') - 1
+    i = np.clip(i, 0, xp.shape[0] - 2)
+    frac = (x - xp[i]) / (xp[i + 1] - xp[i])
+    out = fp[i] + frac * (fp[i + 1] - fp[i])
+    with np.errstate(invalid='ignore'):
+        return np.where((x >= xp[0]) & (x <= xp[-1]), out, np.nan)
+
+
+if __name__ == "__main__":
+    gauge = '3963'
+    levels = [681.0, 681.05, 700.0]
+
+    if len(argv) > 1:
+        gauge = argv[1]
+
+    if len(argv) > 2:
+        levels = [float(level) for level in argv[2:]]
+
+    curve = get_curve(gauge)
+    for level, volume, area in zip(levels, curve.volume(levels),
+                                   curve.area(levels)):
+        print "{} {:8.2f} ft-MSL | {:12.0f} acre-feet | {:8.0f} acres".\
+            format(curve.name, level, volume, area)
@@ -0,0 +1,192 @@
+"""Checks HLFormScraper against HLScraper's original table parsing.
+
+Serves a directory of recorded chronhist pages with ReplayServer,
+scrapes them with HLFormScraper and compares its readings with what
+HLScraper._parse_table, as first written for the Selenium scraper,
+makes of every recorded result page. The recordings must come from
+a run with the same dates and gauges and fixed window lengths
+(adaptive=False), so the scraper asks for the same windows.
+
+../recordings holds a small set: Mansfield Dam (a one column and a
+two column sensor, hourly, with missing readings) and Driftwood 4
+SSE (rain, 15 minutes) for 01/01/2015 to 01/10/2016. Each pair has
+one window with readings and one without, which ends its walk.
+
+optional arguments:
+python replay_check.py record_dir start_date end_date [gauge ...]
+"""
+
+from bs4 import BeautifulSoup
+from sys import argv
+from tempfile import mkdtemp
+import shutil
+import os
+import re
+
+import pandas as pd
+
+from gauge_registry import gauge_name
+from hl_http_scraping import HLFormScraper
+from replay_server import ReplayServer
+
+
+RECORD_DIR = os.path.join(os.pardir, 'recordings')
+START_DATE = '01/01/2015'
+END_DATE = '01/10/2016'
+GAUGES = ['3963', '4594']
+
+
+class ReplayScraper(HLFormScraper):
+    """HLFormScraper keeping its readings instead of loading them"""
+
+    def __init__(self, *args, **kwargs):
+        HLFormScraper.__init__(self, *args, **kwargs)
+        self.readings = []
+
+
+    def _sql_entry(self, inserts, on_commit=None, on_error=None):
+        self.readings.extend(inserts)
+        if on_commit is not None:
+            on_commit()
+
+
+def legacy_parse_table(page_source, gauge):
+    """HLScraper._parse_table as originally written, on the page
+    source of a browser. None if the page has no tbody.
+
+    The header row and every data row drop their first and last
+    children, the whitespace around the cells, and the last child of
+    the tbody, the whitespace before </table>, is dropped as a row.
+    Timestamps are left as the page's strings.
+    """
+    soup = BeautifulSoup(page_source, 'lxml')
+    tbody = soup.find("tbody")
+    if tbody is None:
+        return None
+
+    rows = tbody.children
+    headers = [header.string for header
+                  in rows.next().children][1:-1]
+
+    inserts = []
+    for row in list(rows)[:-1]:
+        values = [v.string for v in row.children][1:-1]
+
+        for val, head in zip(values[1:], headers[1:]):
+            if val.string == u'\xa0':
+                insval = None
+            else:
+                insval = float(val)
+            inserts.append((values[0], str(gauge), head, insval))
+    return inserts
+
+
+def browser_source(page):
+    """A recorded (server) page as a browser's page_source has it:
+    the rows of the result table inside a tbody, which takes the
+    whitespace left before </table>"""
+    match = re.search(r'<table[^>]*id="GridView1"[^>]*>', page)
+    if match is None:
+        return page
+    first_row = page.index('<tr', match.end())
+    end = page.index('</table>', first_row)
+    return (page[:first_row] + '<tbody>' + page[first_row:end] +
+            '</tbody>' + page[end:])
+
+
+def recorded_readings(record_dir):
+    """legacy_parse_table readings of every recorded result page,
+    gauges read from the selected DropDownList1 option"""
+    readings = []
+    for name in sorted(os.listdir(record_dir)):
+        if not name.endswith('.html'):
+            continue
+        with open(os.path.join(record_dir, name), 'rb') as f:
+            page = f.read().decode('utf-8')
+        if 'id="GridView1"' not in page:
+            continue
+        soup = BeautifulSoup(page, 'lxml')
+        gauge = soup.find("select", attrs={'name': 'DropDownList1'}).\
+            find("option", selected=True).get('value')
+        readings.extend(legacy_parse_table(browser_source(page), gauge))
+    return readings
+
+
+def compare(scraped, legacy):
+    """Differences between the two sets of readings
+
+    OUTPUT:
+        DataFrame   | readings only one side has (side 'scraped' or
+                      'legacy') or with different values (side
+                      'both'), [collection_time | gauge | sensor |
+                      value_scraped | value_legacy | side]. Empty
+                      when they agree.
+    """
+    columns = ['collection_time', 'gauge', 'sensor', 'value']
+    new = pd.DataFrame(scraped, columns=columns)
+    old = pd.DataFrame(legacy, columns=columns)
+    old['collection_time'] = pd.to_datetime(old['collection_time'],
+                                            format='%m/%d/%Y %H:%M')
+    for df in (new, old):
+        df['sensor'] = df['sensor'].astype(unicode)
+        df['value'] = df['value'].astype(float)
+
+    # A reading listed twice on one side would pair up more than once
+    for side, df in (('scraped', new), ('legacy', old)):
+        if df.duplicated(columns[:3]).any():
+            raise ValueError("Duplicate {} readings".format(side))
+
+    merged = new.merge(old, on=columns[:3], how='outer',
+                       suffixes=('_scraped', '_legacy'), indicator='side')
+    same = ((merged['value_scraped'] == merged['value_legacy']) |
+            (merged['value_scraped'].isnull() &
+             merged['value_legacy'].isnull()))
+    differ = merged[(merged['side'] != 'both') | ~same].copy()
+    differ['side'] = differ['side'].astype(str).replace(
+        {'left_only': 'scraped', 'right_only': 'legacy'})
+    return differ
+
+
+def check(record_dir=RECORD_DIR, start_date=START_DATE, end_date=END_DATE,
+          gauges=GAUGES):
+    """Scrapes the recordings and compares, returns compare output and
+    the number of readings scraped"""
+    server = ReplayServer(record_dir)
+    server.start()
+    logdir = mkdtemp()
+    try:
+        scraper = ReplayScraper(url=server.url,
+                                start_date=start_date,
+                                end_date=end_date,
+                                concurrency=4,
+                                logname=os.path.join(logdir, 'replay'),
+                                adaptive=False,
+                                probe=False)
+        scraper.start([(gauge, gauge_name(gauge)) for gauge in gauges])
+        scraper.quit()
+    finally:
+        server.shutdown()
+        shutil.rmtree(logdir)
+
+    return (compare(scraper.readings, recorded_readings(record_dir)),
+            len(scraper.readings))
+
+
+if __name__ == "__main__":
+    record_dir, start_date, end_date, gauges = (RECORD_DIR, START_DATE,
+                                                END_DATE, GAUGES)
+    if len(argv) > 1:
+        record_dir = argv[1]
+
+    if len(argv) > 3:
+        start_date, end_date = argv[2], argv[3]
+
+    if len(argv) > 4:
+        gauges = argv[4:]
+
+    differ, n_readings = check(record_dir, start_date, end_date, gauges)
+    if len(differ):
+        print "{} of {} readings differ".format(len(differ), n_readings)
+        print differ.head(20).to_string()
+        raise SystemExit(1)
+    print "{} readings, same as the original parser".format(n_readings)
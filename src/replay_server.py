@@ -0,0 +1,85 @@
+"""Local stand-in for the lcra chronhist form.
+
+Serves pages recorded by HLFormScraper (record_dir) so the HTTP
+backend can be run without touching the live site. Requests are
+matched to recordings by recording_key, unknown requests get a 404.
+
+optional arguments:
+python replay_server.py record_dir port
+"""
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from threading import Thread
+from urlparse import parse_qs
+from sys import argv
+import os
+
+from hl_http_scraping import recording_key
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Answers GET/POST requests from the recordings directory"""
+
+    def do_GET(self):
+        self._reply(recording_key('GET', {}))
+
+    def do_POST(self):
+        length = int(self.headers.getheader('content-length', 0))
+        form = parse_qs(self.rfile.read(length), keep_blank_values=True)
+        fields = {name: values[0] for name, values in form.items()}
+        self._reply(recording_key('POST', fields))
+
+    def _reply(self, key):
+        path = os.path.join(self.server.record_dir, key)
+        if not os.path.exists(path):
+            self.send_error(404, "No recording for this request")
+            return
+
+        with open(path, 'rb') as f:
+            page = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    """Threaded server so concurrent scraper requests overlap"""
+
+    daemon_threads = True
+
+    def __init__(self, record_dir, port=0):
+        HTTPServer.__init__(self, ('localhost', port), ReplayHandler)
+        self.record_dir = record_dir
+
+    @property
+    def url(self):
+        return "http://localhost:{}/chronhist.aspx".format(
+            self.server_address[1])
+
+    def start(self):
+        """Serves from a background thread, returns the thread"""
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    record_dir = 'recordings'
+    port = 8000
+
+    if len(argv) > 1:
+        record_dir = argv[1]
+
+    if len(argv) > 2:
+        port = int(argv[2])
+
+    server = ReplayServer(record_dir, port)
+    print "serving {} at {}".format(record_dir, server.url)
+    server.serve_forever()
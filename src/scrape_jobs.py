@@ -0,0 +1,409 @@
+"""Resumable work queue for scraping the lcra hydromet site.
+
+Every (gauge, sensor, date window) is a job row in a small local
+SQLite database. Workers lease jobs, failed jobs are retried with
+exponential backoff, and finished jobs are never run again, so a
+crashed or repeated run only scrapes the windows still missing.
+
+Gauge jobs (empty sensor) discover the sensors of a gauge and add a
+window job for each sensor and 179 day window, back to the start of
+the sensor's history when it is probed (find_history_start).
+
+WindowSizer adapts window lengths for the scrapers that walk back
+one window at a time.
+
+optional arguments:
+python scrape_jobs.py dbpath start_date end_date concurrency incremental
+set end date to 'none' if not desired
+"""
+
+import sqlite3
+from threading import local
+from datetime import date, timedelta
+from time import time
+from sys import argv
+
+
+# Longest date window the site serves, as days before the end date
+MAX_WINDOW_DAYS = 179
+
+
+def date_windows(start_date, end_date, days=MAX_WINDOW_DAYS):
+    """Date windows of `days` + 1 days covering start_date to end_date
+
+    Windows are laid out forward from start_date so they line up
+    between runs, only the last one is cut short at end_date.
+
+    OUTPUT:
+        list    | [(window start, window end), ...] newest first
+    """
+    windows = []
+    cur_start_date = start_date
+    while cur_start_date <= end_date:
+        cur_end_date = min(cur_start_date + timedelta(days=days), end_date)
+        windows.append((cur_start_date, cur_end_date))
+        cur_start_date = cur_end_date + timedelta(1) #inclusive
+    return windows[::-1]
+
+
+class WindowSizer(object):
+    """
+    Length of the next date window of one gauge/sensor pair
+
+    The readings per day of each window set the next length so pages
+    hold about target_readings: sparse daily sensors get long windows,
+    dense 15 minute ones shorter pages. A response slower than
+    target_seconds shrinks the next window in proportion. Lengths
+    change by at most a factor of two per window and stay within
+    min_days..max_days, max_days being the site's ceiling.
+
+    Lengths are in days before the window end, as for date_windows.
+    """
+
+    def __init__(self, days=MAX_WINDOW_DAYS, min_days=7,
+                 max_days=MAX_WINDOW_DAYS, target_readings=10000,
+                 target_seconds=30.):
+        self.min_days = min_days
+        self.max_days = max_days
+        self.target_readings = target_readings
+        self.target_seconds = target_seconds
+        self.days = min(max(days, min_days), max_days)
+
+
+    def window(self, end_date, start_date):
+        """(window start, window end) ending at end_date, cut short
+        at start_date, None once end_date is before start_date"""
+        if end_date < start_date:
+            return None
+        return (max(end_date - timedelta(days=self.days), start_date),
+                end_date)
+
+
+    def update(self, days, readings, seconds=None):
+        """Sizes the next window from one that spanned `days` and
+        returned `readings` in `seconds`, returns the new length"""
+        days = max(days, 1)
+        want = float(self.max_days)
+        if readings:
+            want = self.target_readings * days / float(readings)
+        if seconds and self.target_seconds and seconds > self.target_seconds:
+            want = min(want, days * self.target_seconds / seconds)
+        want = min(max(want, days / 2.), days * 2.)
+        self.days = int(min(max(want, self.min_days), self.max_days))
+        return self.days
+
+
+def find_history_start(has_data, start_date, end_date,
+                       days=MAX_WINDOW_DAYS, probe_days=30):
+    """Oldest window of a gauge/sensor history worth walking back to
+
+    Probes windows 1, 2, 4, ... windows back from end_date until one
+    comes back empty or start_date is reached, then binary searches
+    between the last window with data and the first empty one. Takes
+    about 2 log2(n) requests for n windows between start_date and
+    end_date, instead of walking through every empty one.
+
+    INPUT:
+        has_data    | has_data(start, end) True if the site returns
+                      readings for the window
+        days        | window length, as for date_windows
+        probe_days  | each probe first asks for the last probe_days
+                      of its window so probe pages stay small. An
+                      empty probe is confirmed with the whole window
+                      before the window counts as empty, so an outage
+                      at the end of a window does not cut the history
+                      there.
+
+    OUTPUT:
+        date    | start of the oldest window found with data, or
+                  start_date if the history reaches it. Assumes the
+                  history has no empty window between its start and
+                  end_date, as the walk back itself does: a gap of a
+                  whole window or more truncates the history at the
+                  gap. Gaps shorter than a window only cost an extra
+                  request.
+    """
+    step = timedelta(days=days + 1)
+    n = (end_date - start_date).days // (days + 1) + 1
+
+    def window_start(k):
+        return max(end_date - k * step - timedelta(days=days), start_date)
+
+    def probe(k):
+        end = end_date - k * step
+        start = window_start(k)
+        short = max(start, end - timedelta(days=probe_days))
+        if has_data(short, end):
+            return True
+        return short > start and has_data(start, end)
+
+    # Window 0 is the first window of the walk itself
+    lo, hi = 0, None
+    k = 1
+    while k < n:
+        if not probe(k):
+            hi = k
+            break
+        lo = k
+        k *= 2
+    if hi is None:
+        if lo == n - 1 or n == 1:
+            return start_date
+        if probe(n - 1):
+            return start_date
+        hi = n - 1
+
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if probe(mid):
+            lo = mid
+        else:
+            hi = mid
+    return window_start(lo)
+
+
+def parse_window_date(text):
+    """Date from a stored window_start/window_end"""
+    y, m, d = [int(part) for part in text.split('-')]
+    return date(y, m, d)
+
+
+class ScrapeJobQueue(object):
+    """
+    SQLite backed queue of scrape jobs
+
+    States: pending -> leased -> done | empty | failed
+            a window with no table marks older pending windows of
+            the same gauge/sensor as skipped
+    """
+
+    def __init__(self,
+                 path='scrape_jobs.db',
+                 lease_seconds=600,
+                 max_attempts=5,
+                 backoff_seconds=30):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+
+        self._local = local()
+
+
+    @property
+    def conn(self):
+        """One connection per thread, transactions are managed by
+        hand (BEGIN IMMEDIATE) to make leasing atomic"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60,
+                                   isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+
+    def create_table(self):
+        """Create the job table if it does not exist"""
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS scrape_jobs
+                             (job_id INTEGER PRIMARY KEY,
+                              gauge TEXT NOT NULL,
+                              sensor TEXT NOT NULL DEFAULT '',
+                              window_start TEXT NOT NULL DEFAULT '',
+                              window_end TEXT NOT NULL DEFAULT '',
+                              state TEXT NOT NULL DEFAULT 'pending',
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              next_attempt REAL NOT NULL DEFAULT 0,
+                              lease_until REAL,
+                              worker TEXT,
+                              rows INTEGER,
+                              error TEXT,
+                              UNIQUE (gauge, sensor,
+                                      window_start, window_end)
+                             );
+                          ''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS scrape_jobs_ready
+                             ON scrape_jobs (state, next_attempt)''')
+
+
+    def add_gauges(self, gauges, refresh=False):
+        """Queue sensor discovery for each gauge, known gauges are
+        left as they are unless refresh is set, which runs their
+        discovery again to add windows up to a later end date"""
+        self.conn.executemany('''INSERT OR IGNORE INTO scrape_jobs
+                                 (gauge) VALUES (?)''',
+                              [(str(gauge),) for gauge in gauges])
+        if refresh:
+            self.conn.executemany('''UPDATE scrape_jobs
+                                     SET state = 'pending', attempts = 0,
+                                         next_attempt = 0
+                                     WHERE gauge = ? AND sensor = ''
+                                       AND state != 'leased' ''',
+                                  [(str(gauge),) for gauge in gauges])
+
+
+    def add_windows(self, gauge, sensor, windows):
+        """Queue date windows [(start date, end date), ...] for a
+        gauge/sensor, windows already queued are left as they are"""
+        self.conn.executemany('''INSERT OR IGNORE INTO scrape_jobs
+                                 (gauge, sensor, window_start, window_end)
+                                 VALUES (?, ?, ?, ?)''',
+                              [(str(gauge), sensor, start.isoformat(),
+                                end.isoformat())
+                               for start, end in windows])
+
+
+    def lease(self, worker):
+        """Claims the next ready job
+
+        Ready jobs are pending jobs past their backoff and leased jobs
+        whose worker let the lease expire. Gauge jobs come first, then
+        the most recent windows.
+
+        OUTPUT:
+            tuple   | (job_id, gauge, sensor, window_start, window_end)
+                      None if no job is ready
+        """
+        now = time()
+        conn = self.conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute('''SELECT job_id, gauge, sensor,
+                                         window_start, window_end
+                                  FROM scrape_jobs
+                                  WHERE (state = 'pending'
+                                         AND next_attempt <= ?)
+                                     OR (state = 'leased'
+                                         AND lease_until < ?)
+                                  ORDER BY sensor != '', window_end DESC
+                                  LIMIT 1''',
+                               (now, now)).fetchone()
+            if row:
+                conn.execute('''UPDATE scrape_jobs
+                                SET state = 'leased', lease_until = ?,
+                                    worker = ?
+                                WHERE job_id = ?''',
+                             (now + self.lease_seconds, worker, row[0]))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row
+
+
+    def complete(self, job_id, rows=None):
+        self._finish(job_id, 'done', rows)
+
+
+    def mark_empty(self, job_id):
+        """The window had no table, older windows of the same
+        gauge/sensor are skipped as HLScraper stops there"""
+        self._finish(job_id, 'empty', 0)
+        self.conn.execute('''UPDATE scrape_jobs SET state = 'skipped'
+                             WHERE state = 'pending'
+                               AND (gauge, sensor) IN
+                                   (SELECT gauge, sensor FROM scrape_jobs
+                                    WHERE job_id = ?)
+                               AND window_end <
+                                   (SELECT window_end FROM scrape_jobs
+                                    WHERE job_id = ?)''',
+                          (job_id, job_id))
+
+
+    def fail(self, job_id, error):
+        """Returns a job to the queue with backoff, or marks it
+        failed after max_attempts"""
+        attempts = self.conn.execute('''SELECT attempts FROM scrape_jobs
+                                        WHERE job_id = ?''',
+                                     (job_id,)).fetchone()[0] + 1
+        if attempts >= self.max_attempts:
+            state = 'failed'
+        else:
+            state = 'pending'
+        delay = self.backoff_seconds * 2 ** (attempts - 1)
+        self.conn.execute('''UPDATE scrape_jobs
+                             SET state = ?, attempts = ?, next_attempt = ?,
+                                 lease_until = NULL, error = ?
+                             WHERE job_id = ?''',
+                          (state, attempts, time() + delay, repr(error),
+                           job_id))
+
+
+    def release_leases(self):
+        """Returns every leased job to the queue. Only call this when
+        no other process is working the same queue, e.g. after a
+        crash"""
+        self.conn.execute('''UPDATE scrape_jobs
+                             SET state = 'pending', lease_until = NULL
+                             WHERE state = 'leased' ''')
+
+
+    def reset_failed(self):
+        """Gives failed jobs a fresh set of attempts"""
+        self.conn.execute('''UPDATE scrape_jobs
+                             SET state = 'pending', attempts = 0,
+                                 next_attempt = 0
+                             WHERE state = 'failed' ''')
+
+
+    def has_unfinished(self):
+        """True while any job is pending or leased"""
+        return bool(self.conn.execute('''SELECT COUNT(*) FROM scrape_jobs
+                                         WHERE state IN ('pending',
+                                                         'leased')'''
+                                      ).fetchone()[0])
+
+
+    def counts(self):
+        """Returns {state: number of jobs}"""
+        return dict(self.conn.execute('''SELECT state, COUNT(*)
+                                         FROM scrape_jobs
+                                         GROUP BY state'''))
+
+
+    def _finish(self, job_id, state, rows):
+        self.conn.execute('''UPDATE scrape_jobs
+                             SET state = ?, rows = ?, lease_until = NULL
+                             WHERE job_id = ?''',
+                          (state, rows, job_id))
+
+
+if __name__ == "__main__":
+    from hl_http_scraping import HLFormScraper
+
+    path = 'scrape_jobs.db'
+    start_date = '01/01/1950'
+    end_date = None
+    concurrency = 8
+    incremental = False
+
+    if len(argv) > 1:
+        path = argv[1]
+
+    if len(argv) > 2:
+        start_date = argv[2]
+
+    if len(argv) > 3:
+        if argv[3] != "none":
+            end_date = argv[3]
+
+    if len(argv) > 4:
+        concurrency = int(argv[4])
+
+    if len(argv) > 5:
+        incremental = argv[5] == "incremental"
+
+    queue = ScrapeJobQueue(path)
+    queue.create_table()
+    queue.release_leases()
+
+    hls = HLFormScraper(start_date=start_date,
+                        end_date=end_date,
+                        concurrency=concurrency,
+                        localhostdb=False,
+                        logname='defaultjobs',
+                        incremental=incremental)
+    queue.add_gauges([val for val, name in hls._get_gauge_list()],
+                     refresh=incremental)
+    hls.run_jobs(queue)
+
+    print queue.counts()
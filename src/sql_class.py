@@ -1,16 +1,87 @@
 """
-Contains class ManipulateDatabase
+Contains classes ManipulateDatabase, HydrometLoader, ConnectionPool
 
 ManipulateDatabase can be used to connect to SQL server and insert
 rows.
 
+ConnectionPool shares connections between ManipulateDatabase objects
+in the scrapers, the pipeline and its worker processes. get_pool
+returns one pool per process so credentials are read once.
+
+HydrometLoader buffers readings across many parsed tables and bulk
+loads them with COPY FROM STDIN.
+
 __main__ block is used for testing
 """
 
 import psycopg2
-from psycopg2 import sql
+from psycopg2 import sql, extensions
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
+from contextlib import contextmanager
+from threading import Lock, BoundedSemaphore
+from datetime import datetime, timedelta
+from time import time
+from io import BytesIO
+from uuid import uuid4
+import struct
+import json
 import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from metrics import METRICS
+
+
+# Natural key, one reading per time/gauge/sensor
+NATURAL_KEY_INDEX = '''CREATE UNIQUE INDEX IF NOT EXISTS
+                           hydromet_natural_key
+                       ON hydromet (collection_time, gauge, sensor)'''
+
+# Dictionary encoded layout (see migrate_encoding): readings live in
+# hydromet_facts with smallint gauge/sensor ids into two lookup
+# tables, and hydromet becomes a view with the names joined back
+FACTS_TABLE = 'hydromet_facts'
+ENCODED_NATURAL_KEY_INDEX = '''CREATE UNIQUE INDEX IF NOT EXISTS
+                                   hydromet_natural_key
+                               ON hydromet_facts
+                                  (collection_time, gauge_id, sensor_id)'''
+HYDROMET_VIEW = '''CREATE VIEW hydromet AS
+                   SELECT f.observation_id, f.collection_time,
+                          g.gauge, s.sensor, f.value
+                   FROM hydromet_facts f
+                   LEFT JOIN hydromet_gauges g ON g.gauge_id = f.gauge_id
+                   LEFT JOIN hydromet_sensors s
+                          ON s.sensor_id = f.sensor_id'''
+
+# Tables holding readings, partitions are hydromet_y<year> and
+# hydromet_default in either layout
+READINGS_RELATION = re.compile(r'^hydromet(_facts|_y\d{4}|_default)?$')
+
+# Postgres binary COPY framing
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('>h', -1)
+PG_EPOCH = datetime(2000, 1, 1)
+
+# TCP keepalives so idle connections survive NAT/load balancer
+# timeouts in front of the AWS database during long backfills
+KEEPALIVES = {'keepalives': 1,
+              'keepalives_idle': 60,
+              'keepalives_interval': 10,
+              'keepalives_count': 5}
+
+# Errors meaning the connection itself is gone
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+# A sensor this many days behind the newest sensor of its gauge has
+# stopped reporting, see get_latest_gauge_dates
+STALE_SENSOR_DAYS = 30
+
+# Process wide pools for get_pool, keyed by server/local
+_POOLS = {}
+_POOLS_LOCK = Lock()
 
 
 class ManipulateDatabase(object):
@@ -22,23 +93,115 @@ class ManipulateDatabase(object):
                  user='tyler',
                  password='',
                  db='highland_lakes',
-                 host='localhost'):
+                 host='localhost',
+                 pool=None,
+                 check_seconds=30):
         self.user = user
         self.password = password
         self.db = db
         self.host = host
+        # Connections come from pool instead of psycopg2.connect
+        self.pool = pool
+        # Idle time before ensure_connection runs a health check
+        self.check_seconds = check_seconds
 
         self.conn = None
+        self._pid = None
+        self._last_check = 0.
+        # Cached by is_encoded and encode_names
+        self._encoded = None
+        self._ids = None
+
+
+    def __enter__(self):
+        if self.conn is None:
+            self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
 
     def connect(self):
-        """Creates database connection"""
-        self.conn = psycopg2.connect(
-            dbname=self.db,
-            user=self.user,
-            host=self.host,
-            password=self.password
-           )
+        """Creates database connection, or takes one from the pool"""
+        if self.pool is not None:
+            self.conn = self.pool.getconn()
+        else:
+            self.conn = psycopg2.connect(
+                dbname=self.db,
+                user=self.user,
+                host=self.host,
+                password=self.password,
+                **KEEPALIVES
+               )
+        self._pid = os.getpid()
+        self._last_check = time()
+
+    def close(self):
+        """Returns the connection to the pool or closes it"""
+        if self.conn is None:
+            return
+        if self._pid != os.getpid():
+            # Inherited through fork, closing would end the parent's
+            # session
+            pass
+        elif self.pool is not None:
+            self.pool.putconn(self.conn)
+        elif not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    def ensure_connection(self):
+        """Reconnects if the connection was dropped, was inherited
+        from a parent process or fails a SELECT 1 health check after
+        check_seconds idle. Call between transactions only, a
+        connection inside a transaction is left alone."""
+        if self.conn is None or self._pid != os.getpid():
+            self.conn = None
+            self.connect()
+            return
+        if not self.conn.closed:
+            if (self.conn.get_transaction_status() !=
+                    extensions.TRANSACTION_STATUS_IDLE):
+                return
+            if time() - self._last_check < self.check_seconds:
+                return
+            try:
+                cur = self.conn.cursor()
+                cur.execute("SELECT 1")
+                cur.close()
+                self.conn.rollback()
+                self._last_check = time()
+                return
+            except CONNECTION_ERRORS:
+                pass
+
+        if self.pool is not None:
+            self.pool.putconn(self.conn, close=True)
+        self.conn = None
+        self.connect()
+
+    @contextmanager
+    def session(self):
+        """Cursor in its own transaction on a live connection
+
+        Commits when the block ends, rolls back if it raises
+
+        with md.session() as cur:
+            cur.execute(...)
+        """
+        self.ensure_connection()
+        cur = self.conn.cursor()
+        try:
+            yield cur
+            self.conn.commit()
+        except Exception:
+            if not self.conn.closed:
+                self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self._last_check = time()
 
     def load_dbinfo_server(self):
         """Loads credentials from ~/.aws/hldb.txt"""
@@ -65,10 +228,559 @@ class ManipulateDatabase(object):
                               );
                     '''
                    )
+        cur.execute(NATURAL_KEY_INDEX)
+        self.conn.commit()
+        cur.close()
+
+
+    def migrate_natural_key(self):
+        """Adds the (collection_time, gauge, sensor) unique index to
+        an existing hydromet table, removing duplicates first
+
+        Returns the number of duplicate rows deleted
+        """
+        removed = self.dedupe_hydromet()
+        cur = self.conn.cursor()
+        if self.is_encoded():
+            cur.execute(ENCODED_NATURAL_KEY_INDEX)
+        else:
+            cur.execute(NATURAL_KEY_INDEX)
+        self.conn.commit()
+        cur.close()
+        return removed
+
+
+    @METRICS.timed('sql.dedupe_hydromet')
+    def dedupe_hydromet(self, start_time=None, end_time=None):
+        """One-off removal of repeated (collection_time, gauge, sensor)
+        readings, keeping the most recently inserted one
+
+        start_time/end_time limit the pass to a time range so a large
+        table can be cleaned a piece at a time
+
+        Deletes are not seen by refresh_rollups, rebuild the rollups
+        with refresh_rollups(full=True) afterwards
+
+        Returns the number of rows deleted
+        """
+        cur = self.conn.cursor()
+        cur.execute(sql.SQL('''DELETE FROM {}
+                       WHERE observation_id IN
+                           (SELECT observation_id
+                            FROM (SELECT observation_id,
+                                         ROW_NUMBER() OVER
+                                             (PARTITION BY collection_time,
+                                                           gauge, sensor
+                                              ORDER BY observation_id DESC)
+                                         AS copy
+                                  FROM hydromet
+                                  WHERE (%(start)s::timestamp IS NULL OR
+                                         collection_time >= %(start)s)
+                                    AND (%(end)s::timestamp IS NULL OR
+                                         collection_time <= %(end)s)
+                                 ) numbered
+                            WHERE copy > 1)''').format(self._fact_table()),
+                    {'start': start_time, 'end': end_time}
+                   )
+        removed = cur.rowcount
+        self.conn.commit()
+        cur.close()
+        return removed
+
+
+    def has_natural_key(self):
+        """True if hydromet has the natural key unique index"""
+        table = FACTS_TABLE if self.is_encoded() else 'hydromet'
+        with self.session() as cur:
+            cur.execute('''SELECT 1
+                           FROM pg_indexes
+                           WHERE tablename = %s
+                             AND indexname = 'hydromet_natural_key' ''',
+                        (table,)
+                       )
+            return bool(cur.fetchone())
+
+
+    def migrate_layout(self, partition=True, brin=False,
+                       start_year=1950, end_year=None):
+        """Creates or migrates hydromet to the layout the storm
+        queries need
+
+        partition   - yearly range partitions on collection_time
+        brin        - also add a BRIN index on collection_time
+        start_year/end_year - partitions to create, end_year defaults
+                      to next year. Other years go to a default
+                      partition.
+
+        A plain hydromet table is copied into the partitioned one and
+        kept as hydromet_unpartitioned until dropped by hand.
+        Partition before migrate_encoding, an encoded table is not
+        repartitioned.
+        """
+        if not self._check_table_existence():
+            if partition:
+                self.create_partitioned_table(start_year, end_year)
+            else:
+                self.create_table()
+        elif partition and not self.is_partitioned():
+            if self.is_encoded():
+                raise RuntimeWarning("hydromet is encoded, partition it "
+                                     "before migrate_encoding")
+            self.migrate_to_partitioned(start_year, end_year)
+
+        self.create_indexes(brin=brin)
+
+
+    def is_partitioned(self):
+        """True if hydromet is a partitioned table"""
+        table = FACTS_TABLE if self.is_encoded() else 'hydromet'
+        with self.session() as cur:
+            cur.execute('''SELECT relkind
+                           FROM pg_class
+                           WHERE relname = %s''',
+                        (table,)
+                       )
+            row = cur.fetchone()
+        return bool(row) and row[0] == 'p'
+
+
+    def create_partitioned_table(self, start_year=1950, end_year=None):
+        """Create hydromet from scratch, range partitioned by year"""
+
+        if self._check_table_existence():
+            raise RuntimeWarning("Table exists! Drop it first!")
+        cur = self.conn.cursor()
+        cur.execute('''CREATE TABLE hydromet
+                              (observation_id SERIAL,
+                               collection_time TIMESTAMP NOT NULL,
+                               gauge TEXT,
+                               sensor TEXT,
+                               value REAL,
+                               PRIMARY KEY (observation_id, collection_time)
+                              ) PARTITION BY RANGE (collection_time);
+                    '''
+                   )
+        cur.execute('''CREATE TABLE hydromet_default
+                       PARTITION OF hydromet DEFAULT''')
+        self.conn.commit()
+        cur.close()
+
+        self.add_year_partitions(start_year, end_year)
+        cur = self.conn.cursor()
+        cur.execute(NATURAL_KEY_INDEX)
+        self.conn.commit()
+        cur.close()
+
+
+    def add_year_partitions(self, start_year, end_year=None):
+        """Adds any missing yearly partitions, end_year defaults to
+        next year so new readings never land in the default partition
+
+        Readings already in the default partition for one of these
+        years make postgres refuse the partition
+        """
+        if end_year is None:
+            end_year = datetime.now().year + 1
+
+        table = self._fact_table()
+        cur = self.conn.cursor()
+        for year in xrange(start_year, end_year + 1):
+            cur.execute(sql.SQL('''CREATE TABLE IF NOT EXISTS {}
+                                   PARTITION OF {}
+                                   FOR VALUES FROM (%s) TO (%s)''').format(
+                            sql.Identifier('hydromet_y{}'.format(year)),
+                            table),
+                        (datetime(year, 1, 1), datetime(year + 1, 1, 1)))
+        self.conn.commit()
+        cur.close()
+
+
+    def migrate_to_partitioned(self, start_year=1950, end_year=None):
+        """Moves a plain hydromet table into a partitioned one
+
+        The old table is renamed hydromet_unpartitioned and left in
+        place, observation ids are kept
+        """
+        cur = self.conn.cursor()
+        cur.execute("ALTER TABLE hydromet RENAME TO hydromet_unpartitioned")
+        # Free the index names for the new table
+        cur.execute('''SELECT indexname
+                       FROM pg_indexes
+                       WHERE tablename = 'hydromet_unpartitioned'
+                         AND indexname LIKE 'hydromet%%' '''
+                   )
+        for (index,) in cur.fetchall():
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(index),
+                sql.Identifier(index.replace('hydromet',
+                                             'hydromet_unpartitioned', 1))))
+        self.conn.commit()
+        cur.close()
+
+        self.create_partitioned_table(start_year, end_year)
+        cur = self.conn.cursor()
+        cur.execute('''INSERT INTO hydromet
+                           (observation_id, collection_time, gauge,
+                            sensor, value)
+                       SELECT observation_id, collection_time, gauge,
+                              sensor, value
+                       FROM hydromet_unpartitioned''')
+        cur.execute('''SELECT setval(pg_get_serial_sequence('hydromet',
+                                                            'observation_id'),
+                                     COALESCE(MAX(observation_id), 0) + 1,
+                                     false)
+                       FROM hydromet''')
+        self.conn.commit()
+        cur.close()
+
+
+    def create_indexes(self, brin=False):
+        """Indexes matching the storm queries, which filter on sensor
+        and a collection_time range and group by gauge. value is
+        included so sums can come from the index alone."""
+        encoded = self.is_encoded()
+        table = self._fact_table()
+        cur = self.conn.cursor()
+        if encoded:
+            cur.execute('''CREATE INDEX IF NOT EXISTS hydromet_sensor_time_gauge
+                           ON hydromet_facts
+                              (sensor_id, collection_time, gauge_id)
+                           INCLUDE (value)''')
+        else:
+            cur.execute('''CREATE INDEX IF NOT EXISTS hydromet_sensor_time_gauge
+                           ON hydromet (sensor, collection_time, gauge)
+                           INCLUDE (value)''')
+        if brin:
+            cur.execute(sql.SQL('''CREATE INDEX IF NOT EXISTS hydromet_time_brin
+                                   ON {} USING BRIN (collection_time)''').
+                        format(table))
+        cur.execute(sql.SQL("ANALYZE {}").format(table))
+        self.conn.commit()
+        cur.close()
+
+
+    def migrate_encoding(self, rewrite=True):
+        """Dictionary encodes the gauge and sensor columns
+
+        The repeated TEXT names are replaced by smallint ids into
+        hydromet_gauges and hydromet_sensors, the table is renamed
+        hydromet_facts and hydromet becomes a view joining the names
+        back, so queries on hydromet keep working. Rows and the
+        natural key and storm indexes shrink by about half.
+
+        rewrite - VACUUM FULL afterwards to return the space of the
+                  dropped columns, locks the table while it runs
+
+        Partition first (migrate_layout), then encode.
+        """
+        if self.is_encoded():
+            return
+        cur = self.conn.cursor()
+        cur.execute('''CREATE TABLE IF NOT EXISTS hydromet_gauges
+                       (gauge_id SMALLSERIAL PRIMARY KEY,
+                        gauge TEXT NOT NULL UNIQUE)''')
+        cur.execute('''CREATE TABLE IF NOT EXISTS hydromet_sensors
+                       (sensor_id SMALLSERIAL PRIMARY KEY,
+                        sensor TEXT NOT NULL UNIQUE)''')
+        cur.execute('''INSERT INTO hydromet_gauges (gauge)
+                       SELECT DISTINCT gauge FROM hydromet
+                       WHERE gauge IS NOT NULL
+                       ORDER BY gauge
+                       ON CONFLICT DO NOTHING''')
+        cur.execute('''INSERT INTO hydromet_sensors (sensor)
+                       SELECT DISTINCT sensor FROM hydromet
+                       WHERE sensor IS NOT NULL
+                       ORDER BY sensor
+                       ON CONFLICT DO NOTHING''')
+
+        cur.execute('''ALTER TABLE hydromet
+                       ADD COLUMN gauge_id SMALLINT
+                           REFERENCES hydromet_gauges,
+                       ADD COLUMN sensor_id SMALLINT
+                           REFERENCES hydromet_sensors''')
+        cur.execute('''UPDATE hydromet h
+                       SET gauge_id = (SELECT gauge_id FROM hydromet_gauges g
+                                       WHERE g.gauge = h.gauge),
+                           sensor_id = (SELECT sensor_id
+                                        FROM hydromet_sensors s
+                                        WHERE s.sensor = h.sensor)''')
+        # Drops the indexes on the text columns with them
+        cur.execute('''ALTER TABLE hydromet
+                       DROP COLUMN gauge,
+                       DROP COLUMN sensor''')
+        cur.execute("ALTER TABLE hydromet RENAME TO hydromet_facts")
+        cur.execute(ENCODED_NATURAL_KEY_INDEX)
+        cur.execute(HYDROMET_VIEW)
+        self.conn.commit()
+        cur.close()
+        self._encoded = True
+
+        self.create_indexes()
+        if rewrite:
+            self.conn.autocommit = True
+            try:
+                cur = self.conn.cursor()
+                cur.execute("VACUUM FULL ANALYZE hydromet_facts")
+                cur.close()
+            finally:
+                self.conn.autocommit = False
+
+
+    def is_encoded(self):
+        """True once migrate_encoding has run"""
+        if self._encoded is None:
+            with self.session() as cur:
+                cur.execute('''SELECT 1
+                               FROM pg_class
+                               WHERE relname = %s''',
+                            (FACTS_TABLE,)
+                           )
+                self._encoded = bool(cur.fetchone())
+        return self._encoded
+
+
+    def encode_names(self, gauges=(), sensors=()):
+        """Lookup ids of gauge and sensor names, adding new names to
+        the lookup tables. Ids are cached on this object.
+
+        OUTPUT:
+            dict    | {gauge: gauge_id}
+            dict    | {sensor: sensor_id}
+        """
+        if self._ids is None:
+            self._ids = self._lookup_ids()
+        gauge_ids, sensor_ids = self._ids
+        new_gauges = [g for g in set(gauges)
+                      if g is not None and g not in gauge_ids]
+        new_sensors = [s for s in set(sensors)
+                       if s is not None and s not in sensor_ids]
+        if new_gauges or new_sensors:
+            cur = self.conn.cursor()
+            cur.execute('''INSERT INTO hydromet_gauges (gauge)
+                           SELECT unnest(%s::text[])
+                           ON CONFLICT DO NOTHING''', (new_gauges,))
+            cur.execute('''INSERT INTO hydromet_sensors (sensor)
+                           SELECT unnest(%s::text[])
+                           ON CONFLICT DO NOTHING''', (new_sensors,))
+            cur.close()
+            self._ids = gauge_ids, sensor_ids = self._lookup_ids()
+        return gauge_ids, sensor_ids
+
+
+    def get_encoding(self):
+        """Names of the lookup ids, for decoding hydromet_facts
+
+        OUTPUT:
+            dict    | {gauge_id: gauge}
+            dict    | {sensor_id: sensor}
+        """
+        with self.session() as cur:
+            cur.execute("SELECT gauge_id, gauge FROM hydromet_gauges")
+            gauges = dict(cur.fetchall())
+            cur.execute("SELECT sensor_id, sensor FROM hydromet_sensors")
+            sensors = dict(cur.fetchall())
+        return gauges, sensors
+
+
+    def _lookup_ids(self):
+        """Reads both lookup tables in the current transaction"""
+        cur = self.conn.cursor()
+        cur.execute("SELECT gauge, gauge_id FROM hydromet_gauges")
+        gauge_ids = dict(cur.fetchall())
+        cur.execute("SELECT sensor, sensor_id FROM hydromet_sensors")
+        sensor_ids = dict(cur.fetchall())
+        cur.close()
+        return gauge_ids, sensor_ids
+
+
+    def _fact_table(self):
+        """Identifier of the table holding the readings"""
+        return sql.Identifier(FACTS_TABLE if self.is_encoded()
+                              else 'hydromet')
+
+
+    def explain_storm_queries(self, start_time, end_time):
+        """Checks how the storm queries are planned for a window
+
+        OUTPUT:
+            dict    | {query name: {'scans': [(node type, relation,
+                                              index), ...],
+                                    'uses_index': bool}}
+
+        uses_index is False if any hydromet scan in the plan reads the
+        table without an index
+        """
+        queries = {
+            'get_storm_rainfall': ("""
+                SELECT gauge, SUM(value)
+                FROM hydromet
+                WHERE (collection_time BETWEEN %s AND %s) AND
+                      (sensor = 'Rain (inches)')
+                GROUP BY gauge""", (start_time, end_time)),
+            'get_max_min_lakes': ("""
+                SELECT DISTINCT gauge, MIN(value), MAX(value)
+                FROM hydromet
+                WHERE (collection_time BETWEEN %s AND %s) AND
+                      (sensor = 'Lake Level (ft above MSL)')
+                GROUP BY gauge""", (start_time, end_time)),
+            }
+
+        report = {}
+        cur = self.conn.cursor()
+        for name, (q, params) in queries.items():
+            cur.execute("EXPLAIN (FORMAT JSON) " + q, params)
+            plan = cur.fetchone()[0]
+            if not isinstance(plan, list):
+                plan = json.loads(plan)
+            scans = _plan_scans(plan[0]['Plan'])
+            report[name] = {
+                'scans': scans,
+                'uses_index': bool(scans) and
+                              all(index for _, _, index in scans)
+                }
+        self.conn.rollback()
+        cur.close()
+        return report
+
+
+    def create_rollup_tables(self):
+        """Creates hydromet_hourly and hydromet_daily, per gauge/sensor
+        sum, max, min and count of readings for each hour/day bucket,
+        and fills them from hydromet"""
+        cur = self.conn.cursor()
+        for table in ('hydromet_hourly', 'hydromet_daily'):
+            cur.execute(sql.SQL('''CREATE TABLE IF NOT EXISTS {}
+                                   (bucket TIMESTAMP NOT NULL,
+                                    gauge TEXT NOT NULL,
+                                    sensor TEXT NOT NULL,
+                                    value_sum DOUBLE PRECISION,
+                                    value_max REAL,
+                                    value_min REAL,
+                                    readings INTEGER,
+                                    PRIMARY KEY (sensor, bucket, gauge)
+                                   )''').format(sql.Identifier(table)))
+        # Highest observation_id already rolled up
+        cur.execute('''CREATE TABLE IF NOT EXISTS hydromet_rollup_state
+                       (watermark BIGINT NOT NULL)''')
+        cur.execute('''INSERT INTO hydromet_rollup_state (watermark)
+                       SELECT -1
+                       WHERE NOT EXISTS
+                           (SELECT 1 FROM hydromet_rollup_state)''')
         self.conn.commit()
         cur.close()
 
+        self.refresh_rollups(full=True)
+
+
+    def has_rollups(self):
+        """True if the rollup tables exist"""
+        with self.session() as cur:
+            cur.execute('''SELECT 1
+                           FROM information_schema.tables
+                           WHERE table_name = 'hydromet_rollup_state' '''
+                       )
+            return bool(cur.fetchone())
+
+
+    @METRICS.timed('sql.refresh_rollups')
+    def refresh_rollups(self, full=False):
+        """Brings the rollups up to date with hydromet
+
+        Only the hour/day buckets holding readings inserted or
+        changed since the last refresh are recomputed. full rebuilds
+        every bucket, e.g. after dedupe_hydromet or deletes, which
+        the watermark does not see.
+
+        Run from one loader at a time, ids handed out to a
+        transaction that commits after the refresh are skipped.
+
+        Returns the number of hourly buckets recomputed
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT watermark FROM hydromet_rollup_state")
+        mark = cur.fetchone()[0]
+        cur.execute("SELECT MAX(observation_id) FROM hydromet")
+        new_mark = cur.fetchone()[0]
+        if new_mark is None:
+            new_mark = -1
+        if new_mark <= mark and not full:
+            self.conn.commit()
+            cur.close()
+            return 0
 
+        if full:
+            cur.execute("TRUNCATE hydromet_hourly, hydromet_daily")
+            cur.execute('''INSERT INTO hydromet_hourly
+                           SELECT date_trunc('hour', collection_time),
+                                  gauge, sensor,
+                                  SUM(value::DOUBLE PRECISION),
+                                  MAX(value), MIN(value), COUNT(value)
+                           FROM hydromet
+                           WHERE gauge IS NOT NULL AND sensor IS NOT NULL
+                           GROUP BY 1, 2, 3''')
+            touched = cur.rowcount
+            cur.execute('''INSERT INTO hydromet_daily
+                           SELECT date_trunc('day', bucket), gauge, sensor,
+                                  SUM(value_sum), MAX(value_max),
+                                  MIN(value_min), SUM(readings)
+                           FROM hydromet_hourly
+                           GROUP BY 1, 2, 3''')
+        else:
+            cur.execute('''CREATE TEMPORARY TABLE rollup_touched
+                           ON COMMIT DROP AS
+                           SELECT DISTINCT
+                                  date_trunc('hour', collection_time)
+                                  AS bucket, gauge, sensor
+                           FROM hydromet
+                           WHERE observation_id > %s
+                             AND observation_id <= %s
+                             AND gauge IS NOT NULL AND sensor IS NOT NULL''',
+                        (mark, new_mark))
+            touched = cur.rowcount
+            cur.execute('''DELETE FROM hydromet_hourly r
+                           USING rollup_touched t
+                           WHERE r.sensor = t.sensor AND r.bucket = t.bucket
+                             AND r.gauge = t.gauge''')
+            cur.execute('''INSERT INTO hydromet_hourly
+                           SELECT t.bucket, t.gauge, t.sensor,
+                                  SUM(h.value::DOUBLE PRECISION),
+                                  MAX(h.value), MIN(h.value), COUNT(h.value)
+                           FROM rollup_touched t
+                           JOIN hydromet h
+                             ON h.sensor = t.sensor AND h.gauge = t.gauge
+                            AND h.collection_time >= t.bucket
+                            AND h.collection_time <
+                                t.bucket + interval '1 hour'
+                           GROUP BY t.bucket, t.gauge, t.sensor''')
+
+            cur.execute('''CREATE TEMPORARY TABLE rollup_touched_days
+                           ON COMMIT DROP AS
+                           SELECT DISTINCT date_trunc('day', bucket)
+                                  AS bucket, gauge, sensor
+                           FROM rollup_touched''')
+            cur.execute('''DELETE FROM hydromet_daily r
+                           USING rollup_touched_days t
+                           WHERE r.sensor = t.sensor AND r.bucket = t.bucket
+                             AND r.gauge = t.gauge''')
+            cur.execute('''INSERT INTO hydromet_daily
+                           SELECT t.bucket, t.gauge, t.sensor,
+                                  SUM(r.value_sum), MAX(r.value_max),
+                                  MIN(r.value_min), SUM(r.readings)
+                           FROM rollup_touched_days t
+                           JOIN hydromet_hourly r
+                             ON r.sensor = t.sensor AND r.gauge = t.gauge
+                            AND r.bucket >= t.bucket
+                            AND r.bucket < t.bucket + interval '1 day'
+                           GROUP BY t.bucket, t.gauge, t.sensor''')
+
+        cur.execute("UPDATE hydromet_rollup_state SET watermark = %s",
+                    (new_mark,))
+        self.conn.commit()
+        cur.close()
+        return touched
+
+
+    @METRICS.timed('sql.insert_gauge_readings')
     def insert_gauge_readings(self, obs):
         """Insert a single reading or multiple readings
          from an observation tuple
@@ -81,6 +793,10 @@ class ManipulateDatabase(object):
 
         Table name is hard-coded for parameterization
         """
+        if self.is_encoded():
+            self.copy_gauge_readings([obs] if isinstance(obs, tuple)
+                                     else obs)
+            return
         cur = self.conn.cursor()
         q = '''INSERT INTO hydromet
                (collection_time, gauge, sensor, value)
@@ -96,50 +812,253 @@ class ManipulateDatabase(object):
         cur.close()
 
 
-    def _check_table_existence(self):
-        """Checks if the database exists in PostgresSQl"""
+    def copy_gauge_readings(self, obs, binary=False, commit=True,
+                            upsert=False):
+        """Bulk load readings with COPY FROM STDIN
+
+        Format: [(timestamp, gauge, sensor, value), ...] as for
+        insert_gauge_readings
+
+        binary - send postgres binary COPY format instead of text,
+                 timestamps are parsed client side (month first)
+        upsert - COPY into a staging table and merge on the natural
+                 key, so re-scraped readings replace instead of
+                 duplicate. Needs migrate_natural_key.
+
+        On an encoded table (migrate_encoding) names are sent as
+        their lookup ids
+
+        Returns the number of bytes sent
+        """
+        if self.is_encoded():
+            return self._copy_encoded_readings(obs, binary, commit, upsert)
+
+        table = 'hydromet'
         cur = self.conn.cursor()
-        cur.execute('''SELECT *
-                       FROM information_schema.tables
-                       WHERE table_name=%s''',
-                   ('hydromet',)
-                   )
+        if upsert:
+            table = 'hydromet_staging'
+            cur.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS
+                               hydromet_staging
+                               (collection_time TIMESTAMP,
+                                gauge TEXT,
+                                sensor TEXT,
+                                value REAL
+                               ) ON COMMIT DELETE ROWS''')
+
+        if binary:
+            buf = _binary_copy_buffer(obs)
+            q = '''COPY {} (collection_time, gauge, sensor, value)
+                   FROM STDIN WITH (FORMAT binary)'''
+        else:
+            buf = _text_copy_buffer(obs)
+            q = '''COPY {} (collection_time, gauge, sensor, value)
+                   FROM STDIN'''
+        cur.copy_expert(q.format(table), buf)
+
+        if upsert:
+            # A batch may hold the same reading twice, the last wins.
+            # Changed readings take a new id so refresh_rollups sees
+            # them.
+            cur.execute('''INSERT INTO hydromet
+                               (collection_time, gauge, sensor, value)
+                           SELECT DISTINCT ON (collection_time, gauge, sensor)
+                                  collection_time, gauge, sensor, value
+                           FROM hydromet_staging
+                           ORDER BY collection_time, gauge, sensor,
+                                    ctid DESC
+                           ON CONFLICT (collection_time, gauge, sensor)
+                           DO UPDATE SET value = EXCLUDED.value,
+                                         observation_id = DEFAULT
+                           WHERE hydromet.value IS DISTINCT FROM
+                                 EXCLUDED.value''')
+            cur.execute("TRUNCATE hydromet_staging")
+
+        if commit:
+            self.conn.commit()
         cur.close()
-        return bool(cur.rowcount)
+        return len(buf.getvalue())
 
 
-    def query_max_precip(self):
+    def _copy_encoded_readings(self, obs, binary, commit, upsert):
+        """copy_gauge_readings into hydromet_facts"""
+        try:
+            gauge_ids, sensor_ids = self.encode_names(
+                [row[1] for row in obs], [row[2] for row in obs])
+            rows = [(collection_time, gauge_ids.get(gauge),
+                     sensor_ids.get(sensor), value)
+                    for collection_time, gauge, sensor, value in obs]
 
-        cur = self.conn.cursor()
-        cur.execute('''SELECT collection_time, MAX(value)
-                       FROM hydromet
-                       WHERE sensor=%s
-                       GROUP BY collection_time''',
-                   ('Rain (inches)',)
-                   )
-        data = cur.fetchall()
+            table = FACTS_TABLE
+            cur = self.conn.cursor()
+            if upsert:
+                table = 'hydromet_facts_staging'
+                cur.execute('''CREATE TEMPORARY TABLE IF NOT EXISTS
+                                   hydromet_facts_staging
+                                   (collection_time TIMESTAMP,
+                                    gauge_id SMALLINT,
+                                    sensor_id SMALLINT,
+                                    value REAL
+                                   ) ON COMMIT DELETE ROWS''')
+
+            if binary:
+                buf = _binary_copy_buffer(rows, encoded=True)
+                q = '''COPY {} (collection_time, gauge_id, sensor_id, value)
+                       FROM STDIN WITH (FORMAT binary)'''
+            else:
+                buf = _text_copy_buffer(rows)
+                q = '''COPY {} (collection_time, gauge_id, sensor_id, value)
+                       FROM STDIN'''
+            cur.copy_expert(q.format(table), buf)
+
+            if upsert:
+                cur.execute('''INSERT INTO hydromet_facts
+                                   (collection_time, gauge_id, sensor_id,
+                                    value)
+                               SELECT DISTINCT ON (collection_time, gauge_id,
+                                                   sensor_id)
+                                      collection_time, gauge_id, sensor_id,
+                                      value
+                               FROM hydromet_facts_staging
+                               ORDER BY collection_time, gauge_id, sensor_id,
+                                        ctid DESC
+                               ON CONFLICT (collection_time, gauge_id,
+                                            sensor_id)
+                               DO UPDATE SET value = EXCLUDED.value,
+                                             observation_id = DEFAULT
+                               WHERE hydromet_facts.value IS DISTINCT FROM
+                                     EXCLUDED.value''')
+                cur.execute("TRUNCATE hydromet_facts_staging")
+        except Exception:
+            # Ids of names added in a rolled back transaction are gone
+            self._ids = None
+            raise
 
+        if commit:
+            self.conn.commit()
         cur.close()
-        return data
+        return len(buf.getvalue())
+
+
+    def _check_table_existence(self):
+        """Checks if the database exists in PostgresSQl"""
+        with self.session() as cur:
+            cur.execute('''SELECT *
+                           FROM information_schema.tables
+                           WHERE table_name=%s''',
+                       ('hydromet',)
+                       )
+            return bool(cur.rowcount)
+
 
+    @METRICS.timed('sql.query_max_precip')
+    def query_max_precip(self, resolution='raw'):
+        """Highest rain reading across gauges at each time, ordered
+        by time
+
+        resolution - 'raw' for every collection_time, 'hour' reads
+                     the highest hourly gauge total from
+                     hydromet_hourly instead (see create_rollup_tables)
+
+        For the full history use iter_max_precip, which does not hold
+        every row in memory at once
+        """
+        with self.session() as cur:
+            cur.execute(_max_precip_query(resolution), ('Rain (inches)',))
+            return cur.fetchall()
+
+    def iter_max_precip(self, resolution='raw', itersize=100000):
+        """query_max_precip as a stream of DataFrames
+
+        OUTPUT:
+            generator   | DataFrames [collection_time | Rain (inches)]
+                          of up to itersize rows, ordered by time
+        """
+        return self.iter_query(_max_precip_query(resolution),
+                               ('Rain (inches)',),
+                               columns=['collection_time', 'Rain (inches)'],
+                               dtypes={'Rain (inches)': np.float64},
+                               itersize=itersize,
+                               name='sql.iter_max_precip')
+
+    def iter_sensor_readings(self, gauge, sensor, start_time=None,
+                             end_time=None, itersize=100000):
+        """One gauge/sensor series as a stream of DataFrames
+
+        OUTPUT:
+            generator   | DataFrames [collection_time | value] ordered
+                          by time
+        """
+        q = '''SELECT collection_time, value
+               FROM hydromet
+               WHERE gauge = %(gauge)s AND sensor = %(sensor)s
+                 AND (%(start)s::timestamp IS NULL OR
+                      collection_time >= %(start)s)
+                 AND (%(end)s::timestamp IS NULL OR
+                      collection_time <= %(end)s)
+               ORDER BY collection_time'''
+        return self.iter_query(q, {'gauge': str(gauge), 'sensor': sensor,
+                                   'start': start_time, 'end': end_time},
+                               columns=['collection_time', 'value'],
+                               dtypes={'value': np.float64},
+                               itersize=itersize,
+                               name='sql.iter_sensor_readings')
+
+    def iter_query(self, q, params=None, columns=None, dtypes=None,
+                   itersize=100000, name='sql.iter_query'):
+        """Runs q on a named (server side) cursor and yields the
+        result itersize rows at a time
+
+        columns - DataFrame column names, defaults to the query's
+        dtypes  - {column: dtype} casts applied to every chunk so
+                  NULLs and empty chunks keep a fixed type
+        name    - metric the fetch time and rows are recorded under,
+                  time spent by the consumer between chunks is not
+                  counted
+
+        The cursor lives in a transaction that is committed once the
+        generator is exhausted or closed
+        """
+        cur = self.conn.cursor(name='stream_{}'.format(uuid4().hex))
+        cur.itersize = itersize
+        seconds = 0.
+        n_rows = 0
+        try:
+            start = time()
+            cur.execute(q, params)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                if columns is None:
+                    columns = [desc[0] for desc in cur.description]
+                chunk = pd.DataFrame.from_records(rows, columns=columns)
+                if dtypes:
+                    chunk = chunk.astype(dtypes)
+                seconds += time() - start
+                n_rows += len(chunk)
+                yield chunk
+                start = time()
+        finally:
+            cur.close()
+            self.conn.commit()
+            METRICS.record(name, seconds, rows=n_rows)
+
+    @METRICS.timed('sql.get_storm_rainfall')
     def get_storm_rainfall(self, start_time, end_time):
 
-        cur = self.conn.cursor()
         q = """
         SELECT gauge, SUM(value)
         FROM hydromet
         WHERE (collection_time BETWEEN %s AND %s) AND (sensor = 'Rain (inches)')
         GROUP BY gauge;
         """
-        cur.execute(q, (start_time, end_time))
-
-        data = cur.fetchall()
-        cur.close()
-        return data
+        with self.session() as cur:
+            cur.execute(q, (start_time, end_time))
+            return cur.fetchall()
 
+    @METRICS.timed('sql.get_max_min_lakes')
     def get_max_min_lakes(self, start_time, end_time):
 
-        cur = self.conn.cursor()
         q = """
         SELECT DISTINCT gauge, MIN(value), MAX(value)
         FROM hydromet
@@ -147,11 +1066,607 @@ class ManipulateDatabase(object):
               (sensor = 'Lake Level (ft above MSL)')
         GROUP BY gauge
         """
-        cur.execute(q, (start_time, end_time))
+        with self.session() as cur:
+            cur.execute(q, (start_time, end_time))
+            return cur.fetchall()
+
+    @METRICS.timed('sql.get_latest_observations')
+    def get_latest_observations(self):
+        """Latest collection_time for every gauge/sensor
+
+        OUTPUT:
+            dict    | {(gauge, sensor): datetime}
+        """
+        with self.session() as cur:
+            cur.execute('''SELECT gauge, sensor, MAX(collection_time)
+                           FROM hydromet
+                           GROUP BY gauge, sensor'''
+                       )
+            data = cur.fetchall()
+        return {(gauge, sensor): latest for gauge, sensor, latest in data}
+
+    def get_latest_gauge_dates(self, stale_days=STALE_SENSOR_DAYS):
+        """Date to resume scraping each gauge from
+
+        Scraped sensor names are table headers, not the DropDownList2
+        options, so a gauge resumes from the oldest of its sensors'
+        latest observations to make sure no sensor is left behind.
+        Sensors more than stale_days behind the gauge's newest
+        observation have stopped reporting and are left out, otherwise
+        one retired sensor would have every run rescrape the gauge
+        from the day it stopped.
+
+        OUTPUT:
+            dict    | {gauge: date}
+        """
+        sensors = {}
+        for (gauge, sensor), latest in \
+                self.get_latest_observations().items():
+            if latest is not None:
+                sensors.setdefault(gauge, []).append(latest)
+
+        resume = {}
+        for gauge, times in sensors.items():
+            cutoff = max(times) - timedelta(days=stale_days)
+            resume[gauge] = min(latest for latest in times
+                                if latest >= cutoff)
+        return {gauge: latest.date() for gauge, latest in resume.items()}
+
+    @METRICS.timed('sql.data_version')
+    def data_version(self):
+        """Changes whenever readings are added, revised or deleted,
+        for keying caches of results computed from hydromet
+
+        OUTPUT:
+            str     | 'max observation_id:row count'
+        """
+        with self.session() as cur:
+            cur.execute('''SELECT MAX(observation_id), COUNT(*)
+                           FROM hydromet''')
+            return '{}:{}'.format(*cur.fetchone())
 
-        data = cur.fetchall()
+    @METRICS.timed('sql.get_storm_aggregates')
+    def get_storm_aggregates(self, stormlist, use_rollups=False):
+        """Rain sums and lake min/max for every storm at once
+
+        Loads the storms into a temporary table of inclusive time
+        ranges and answers both aggregates with one join each
+        instead of two queries per storm.
+
+        use_rollups reads the whole hours of each storm from
+        hydromet_hourly and only the partial hours at either end
+        from hydromet
+
+        INPUT:
+            list    | [(start time, end time), ...]
+
+        OUTPUT:
+            list    | [(storm index, gauge, rain sum), ...]
+            list    | [(storm index, gauge, lake min, lake max), ...]
+
+        Storm index is the position of the storm in stormlist
+        """
+        if use_rollups:
+            return self._get_storm_aggregates_rollup(stormlist)
+
+        cur = self.conn.cursor()
+        cur.execute("""
+        CREATE TEMPORARY TABLE storm_windows
+            (storm_id INTEGER,
+             period TSRANGE
+            ) ON COMMIT DROP;
+        """)
+        windows = [(i, start, end) for i, (start, end)
+                   in enumerate(stormlist)]
+        execute_values(cur,
+                       "INSERT INTO storm_windows (storm_id, period) VALUES %s",
+                       windows,
+                       template="(%s, tsrange(%s, %s, '[]'))",
+                       page_size=999)
+        cur.execute("CREATE INDEX ON storm_windows USING GIST (period);")
+        cur.execute("ANALYZE storm_windows;")
+
+        q = """
+        SELECT s.storm_id, h.gauge, SUM(h.value)
+        FROM hydromet h
+        JOIN storm_windows s ON s.period @> h.collection_time
+        WHERE h.sensor = 'Rain (inches)'
+        GROUP BY s.storm_id, h.gauge;
+        """
+        cur.execute(q)
+        raindata = cur.fetchall()
+
+        q = """
+        SELECT s.storm_id, h.gauge, MIN(h.value), MAX(h.value)
+        FROM hydromet h
+        JOIN storm_windows s ON s.period @> h.collection_time
+        WHERE h.sensor = 'Lake Level (ft above MSL)'
+        GROUP BY s.storm_id, h.gauge;
+        """
+        cur.execute(q)
+        lakedata = cur.fetchall()
+
+        self.conn.commit()
         cur.close()
-        return data
+        return raindata, lakedata
+
+    def _get_storm_aggregates_rollup(self, stormlist):
+        """get_storm_aggregates from hydromet_hourly plus the raw
+        readings of the partial hours at the ends of each storm"""
+        hours = []
+        edges = []
+        for i, (start, end) in enumerate(stormlist):
+            full, storm_edges = _split_hours(pd.Timestamp(start),
+                                             pd.Timestamp(end))
+            if full:
+                hours.append((i,) + full)
+            edges.extend((i,) + edge for edge in storm_edges)
+
+        cur = self.conn.cursor()
+        # Whole hour buckets [first, last) and raw edges [lo, hi]
+        cur.execute("""
+        CREATE TEMPORARY TABLE storm_hours
+            (storm_id INTEGER,
+             first_bucket TIMESTAMP,
+             last_bucket TIMESTAMP
+            ) ON COMMIT DROP;
+        CREATE TEMPORARY TABLE storm_edges
+            (storm_id INTEGER,
+             lo TIMESTAMP,
+             hi TIMESTAMP
+            ) ON COMMIT DROP;
+        """)
+        execute_values(cur,
+                       "INSERT INTO storm_hours VALUES %s",
+                       hours, page_size=999)
+        execute_values(cur,
+                       "INSERT INTO storm_edges VALUES %s",
+                       edges, page_size=999)
+        cur.execute("ANALYZE storm_hours; ANALYZE storm_edges;")
+
+        pieces = """
+        SELECT s.storm_id, r.gauge, r.value_sum AS total,
+               r.value_min AS low, r.value_max AS high
+        FROM storm_hours s
+        JOIN hydromet_hourly r
+          ON r.sensor = %(sensor)s
+         AND r.bucket >= s.first_bucket AND r.bucket < s.last_bucket
+        UNION ALL
+        SELECT s.storm_id, h.gauge, h.value, h.value, h.value
+        FROM storm_edges s
+        JOIN hydromet h
+          ON h.sensor = %(sensor)s
+         AND h.collection_time BETWEEN s.lo AND s.hi
+        """
+
+        cur.execute("""
+        SELECT storm_id, gauge, SUM(total)
+        FROM ({}) pieces
+        GROUP BY storm_id, gauge;
+        """.format(pieces), {'sensor': 'Rain (inches)'})
+        raindata = cur.fetchall()
+
+        cur.execute("""
+        SELECT storm_id, gauge, MIN(low), MAX(high)
+        FROM ({}) pieces
+        GROUP BY storm_id, gauge;
+        """.format(pieces), {'sensor': 'Lake Level (ft above MSL)'})
+        lakedata = cur.fetchall()
+
+        self.conn.commit()
+        cur.close()
+        return raindata, lakedata
+
+
+class HydrometLoader(object):
+    """
+    Batches readings across many parsed tables into COPY loads
+
+    batch_rows     - rows buffered before a COPY is sent
+    commit_rows    - rows loaded between commits
+    commit_seconds - also commit when this long has passed since the
+                     last commit (None to only commit by rows)
+    binary         - use binary instead of text COPY format
+    upsert         - merge on the natural key instead of appending,
+                     None uses it when the natural key index exists
+    rollups        - refresh the hourly/daily rollups after each
+                     commit, None does so when the rollup tables exist
+
+    on_commit callbacks passed to add() run once the rows they came
+    with are committed, e.g. to mark scrape jobs done. If a COPY or
+    commit fails the transaction is rolled back, every row since the
+    last commit is dropped and the on_error callbacks of those rows
+    run with the error instead, before it is raised. The loader can
+    be used again afterwards.
+    """
+
+    def __init__(self, md, batch_rows=50000, commit_rows=500000,
+                 commit_seconds=None, binary=False, upsert=None,
+                 rollups=None):
+        self.md = md
+        self.batch_rows = batch_rows
+        self.commit_rows = commit_rows
+        self.commit_seconds = commit_seconds
+        self.binary = binary
+        self.upsert = upsert
+        self.rollups = rollups
+        self.last_commit = time()
+
+        self.buffer = []
+        self.callbacks = []
+        self.uncommitted = 0
+        self.rows = 0
+        self.bytes = 0
+        self.seconds = 0.
+
+
+    def add(self, obs, on_commit=None, on_error=None):
+        """Buffers readings, loading and committing when the batch
+        and commit sizes are reached"""
+        self.buffer.extend(obs)
+        if on_commit is not None or on_error is not None:
+            self.callbacks.append((on_commit, on_error))
+        if (len(self.buffer) >= self.batch_rows or
+           self._commit_due()):
+            self.flush()
+
+
+    def flush(self):
+        """Sends buffered rows with COPY, commits if commit_rows have
+        been loaded or commit_seconds passed since the last commit"""
+        if self.buffer:
+            try:
+                if not self.uncommitted:
+                    # Between transactions, replace a connection
+                    # dropped while idle
+                    self.md.ensure_connection()
+                if self.upsert is None:
+                    self.upsert = self.md.has_natural_key()
+                with METRICS.timer('db.copy') as timing:
+                    timing.bytes = self.md.copy_gauge_readings(
+                        self.buffer, binary=self.binary, commit=False,
+                        upsert=self.upsert)
+                    timing.rows = len(self.buffer)
+            except Exception as e:
+                self._discard(e)
+                raise
+            self.seconds += timing.seconds
+            self.bytes += timing.bytes
+            self.rows += len(self.buffer)
+            self.uncommitted += len(self.buffer)
+            self.buffer = []
+        if self.uncommitted >= self.commit_rows or self._commit_due():
+            self.commit()
+
+
+    def commit(self):
+        try:
+            with METRICS.timer('db.commit') as timing:
+                timing.rows = self.uncommitted
+                self.md.conn.commit()
+        except Exception as e:
+            self._discard(e)
+            raise
+        self.seconds += timing.seconds
+        loaded, self.uncommitted = self.uncommitted, 0
+        self.last_commit = time()
+
+        callbacks, self.callbacks = self.callbacks, []
+        for on_commit, _ in callbacks:
+            if on_commit is not None:
+                on_commit()
+
+        # The rows are committed whether or not this succeeds
+        if self.rollups is None:
+            self.rollups = self.md.has_rollups()
+        if self.rollups and loaded:
+            self.md.refresh_rollups()
+
+
+    def _discard(self, error):
+        """Rolls back the rows sent since the last commit, drops the
+        buffer and runs the on_error callbacks of both"""
+        if not self.md.conn.closed:
+            try:
+                self.md.conn.rollback()
+            except CONNECTION_ERRORS:
+                pass
+        self.rows -= self.uncommitted
+        self.uncommitted = 0
+        self.buffer = []
+
+        callbacks, self.callbacks = self.callbacks, []
+        for _, on_error in callbacks:
+            if on_error is not None:
+                on_error(error)
+
+
+    def close(self):
+        """Loads and commits everything still buffered"""
+        self.flush()
+        self.commit()
+
+
+    def _commit_due(self):
+        return (self.commit_seconds is not None and
+                time() - self.last_commit >= self.commit_seconds)
+
+
+    @property
+    def rows_per_second(self):
+        if not self.seconds:
+            return 0.
+        return self.rows / self.seconds
+
+
+class ConnectionPool(object):
+    """
+    Thread and fork safe pool of database connections
+
+    Wraps psycopg2's ThreadedConnectionPool. getconn blocks while all
+    maxconn connections are out instead of raising, connections that
+    fail a SELECT 1 check are replaced, and a forked child builds its
+    own pool instead of sharing the parent's sockets.
+
+    with pool.connection() as conn:
+        ...
+    """
+
+    def __init__(self,
+                 user='tyler',
+                 password='',
+                 db='highland_lakes',
+                 host='localhost',
+                 minconn=1,
+                 maxconn=8):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.kwargs = dict(dbname=db, user=user, host=host,
+                           password=password, **KEEPALIVES)
+
+        self._lock = Lock()
+        self._pool = None
+        self._slots = None
+        self._pid = None
+        # ids of the connections getconn has handed out and putconn
+        # not yet taken back, in this process
+        self._out = set()
+        # Pools inherited through fork, kept referenced so garbage
+        # collection never closes the parent's connections
+        self._orphans = []
+
+
+    def _get_pool(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    if self._pool is not None:
+                        self._orphans.append(self._pool)
+                    self._pool = ThreadedConnectionPool(self.minconn,
+                                                        self.maxconn,
+                                                        **self.kwargs)
+                    self._slots = BoundedSemaphore(self.maxconn)
+                    self._out = set()
+                    self._pid = os.getpid()
+        return self._pool
+
+
+    def getconn(self):
+        """Takes a live connection from the pool"""
+        pool = self._get_pool()
+        self._slots.acquire()
+        try:
+            conn = pool.getconn()
+            if not _healthy(conn):
+                pool.putconn(conn, close=True)
+                conn = pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._out.add(id(conn))
+        return conn
+
+
+    def putconn(self, conn, close=False):
+        """Returns a connection, rolling back anything uncommitted.
+        Closed connections are discarded, connections this pool did
+        not hand out (a previous process's, or already returned) are
+        left alone."""
+        pool = self._get_pool()
+        # A forked child must not roll back its parent's connection,
+        # and of two threads returning one connection only the first
+        # takes it back
+        with self._lock:
+            if id(conn) not in self._out:
+                return
+            self._out.discard(id(conn))
+        if conn.closed:
+            close = True
+        elif not close:
+            try:
+                conn.rollback()
+            except CONNECTION_ERRORS:
+                close = True
+        pool.putconn(conn, close=close)
+        self._slots.release()
+
+
+    @contextmanager
+    def connection(self):
+        """Connection that is committed and returned when the block
+        ends, rolled back if it raises"""
+        conn = self.getconn()
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            self.putconn(conn)
+
+
+    def closeall(self):
+        if self._pool is not None and self._pid == os.getpid():
+            self._pool.closeall()
+        self._pool = None
+        self._pid = None
+        self._out = set()
+
+
+def get_pool(server=True, minconn=1, maxconn=8):
+    """Pool shared by everything in this process
+
+    server - credentials from ~/.aws/hldb.txt, otherwise the local
+             defaults of ManipulateDatabase
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(server)
+        if pool is None:
+            md = ManipulateDatabase()
+            if server:
+                md.load_dbinfo_server()
+            pool = ConnectionPool(md.user, md.password, md.db, md.host,
+                                  minconn=minconn, maxconn=maxconn)
+            _POOLS[server] = pool
+    return pool
+
+
+def set_pool(pool, server=True):
+    """Makes get_pool(server) return pool, e.g. to point the pipeline
+    at a scratch database. Returns the pool it replaces, if any."""
+    with _POOLS_LOCK:
+        previous = _POOLS.get(server)
+        _POOLS[server] = pool
+    return previous
+
+
+def _healthy(conn):
+    """SELECT 1 round trip on an idle connection"""
+    if conn.closed:
+        return False
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except CONNECTION_ERRORS:
+        return False
+
+
+def _max_precip_query(resolution):
+    if resolution == 'hour':
+        return '''SELECT bucket, MAX(value_sum)
+                  FROM hydromet_hourly
+                  WHERE sensor=%s
+                  GROUP BY bucket
+                  ORDER BY bucket'''
+    elif resolution != 'raw':
+        raise ValueError("Unknown resolution: {}".format(resolution))
+    return '''SELECT collection_time, MAX(value)
+              FROM hydromet
+              WHERE sensor=%s
+              GROUP BY collection_time
+              ORDER BY collection_time'''
+
+
+def _split_hours(start, end):
+    """Splits the inclusive window [start, end] into whole hour
+    buckets and raw edges
+
+    OUTPUT:
+        tuple   | (first bucket, last bucket) buckets first <= b < last
+                  lie wholly inside the window, None if there are none
+        list    | [(lo, hi), ...] inclusive raw ranges left over
+    """
+    first = start.floor('H')
+    if first < start:
+        first += pd.Timedelta(hours=1)
+    last = end.floor('H')
+    if first >= last:
+        return None, [(start.to_pydatetime(), end.to_pydatetime())]
+
+    edges = [(last.to_pydatetime(), end.to_pydatetime())]
+    if start < first:
+        # Timestamps are stored to the microsecond
+        edges.append((start.to_pydatetime(),
+                      (first - pd.Timedelta(microseconds=1)).to_pydatetime()))
+    return (first.to_pydatetime(), last.to_pydatetime()), edges
+
+
+def _plan_scans(node):
+    """(node type, relation, index) for every scan of the readings
+    (hydromet, hydromet_facts or their partitions) in an EXPLAIN JSON
+    plan. The gauge/sensor lookup tables and rollups are left out."""
+    scans = []
+    relation = node.get('Relation Name', '')
+    if READINGS_RELATION.match(relation):
+        index = node.get('Index Name')
+        if node['Node Type'] == 'Bitmap Heap Scan':
+            # The indexes sit in the Bitmap Index Scan children
+            index = ', '.join(_plan_indexes(node)) or None
+        scans.append((node['Node Type'], relation, index))
+    for child in node.get('Plans', []):
+        scans.extend(_plan_scans(child))
+    return scans
+
+
+def _plan_indexes(node):
+    indexes = []
+    for child in node.get('Plans', []):
+        if 'Index Name' in child:
+            indexes.append(child['Index Name'])
+        indexes.extend(_plan_indexes(child))
+    return indexes
+
+
+def _copy_text(value):
+    """Escapes one field for the COPY text format"""
+    if value is None:
+        return u'\\N'
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    return (value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+                 .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
+def _text_copy_buffer(obs):
+    lines = [u'\t'.join([_copy_text(field) for field in row])
+             for row in obs]
+    lines.append(u'')
+    return BytesIO(u'\n'.join(lines).encode('utf-8'))
+
+
+def _binary_copy_buffer(obs, encoded=False):
+    """encoded - gauge and sensor are smallint lookup ids"""
+    times = pd.to_datetime([row[0] for row in obs])
+    micros = (times - PG_EPOCH).values.astype('timedelta64[us]')
+    micros = micros.astype('int64')
+
+    parts = [PGCOPY_HEADER]
+    row_head = struct.Struct('>hiq')
+    real = struct.Struct('>if')
+    smallint = struct.Struct('>ih')
+    null = struct.pack('>i', -1)
+    for (_, gauge, sensor, value), micro in zip(obs, micros):
+        parts.append(row_head.pack(4, 8, micro))
+        for text in (gauge, sensor):
+            if text is None:
+                parts.append(null)
+            elif encoded:
+                parts.append(smallint.pack(2, text))
+            else:
+                text = unicode(text).encode('utf-8')
+                parts.append(struct.pack('>i', len(text)) + text)
+        if value is None:
+            parts.append(null)
+        else:
+            parts.append(real.pack(4, value))
+    parts.append(PGCOPY_TRAILER)
+    return BytesIO(b''.join(parts))
 
 
 #  observation_id |   collection_time   | gauge | sensor | value
@@ -171,10 +1686,29 @@ if __name__ == "__main__":
     md.load_dbinfo_server()
     md.connect()
 
+# Pooled connections, returned to the pool when the block ends
+    # with ManipulateDatabase(pool=get_pool()) as pooled:
+    #     print pooled.has_natural_key()
+
 
 # TEST Table Creation, TEST _check_table_existence() - OK
     # md.create_table()
 
+# One-off natural key migration, removes duplicate readings first
+    # print md.migrate_natural_key()
+
+# Partitioning and indexes, then check the storm queries use them
+    # md.migrate_layout(partition=True, brin=True)
+    # print md.explain_storm_queries('2015-05-23', '2015-05-27')
+
+# Dictionary encoded gauge/sensor ids, hydromet stays queryable as a view
+    # md.migrate_encoding()
+    # print md.get_encoding()
+
+# Hourly/daily rollups, kept current by HydrometLoader afterwards
+    # md.create_rollup_tables()
+    # print len(md.query_max_precip(resolution='hour'))
+
 # TEST insert_gauge_readings single and multi - OK
 # TEST multiple commits to ensure connection stays open - OK
 # SQL time format: `1999-12-31 23:59:59.99'
@@ -1,14 +1,25 @@
 """
 Python scripts for storm event discovery and aggregation
 """
-from sql_class import ManipulateDatabase
+from sql_class import ManipulateDatabase, get_pool
 import numpy as np
 import pandas as pd
 import datetime
 from collections import defaultdict
+from pipeline_dag import PipelineDAG
+from metrics import METRICS
+from rating_curves import convert_levels
+from inflow import load_inflow, window_inflow
+from window_index import WindowIndex, RAIN_SENSOR, LAKE_SENSOR
+from gauge_registry import (rain_gauges, lake_gauges, gauge_name,
+                            rename_columns, LAKE_SUFFIXES)
 
 
-def aggregate_rain_data_by_storm(stormlist):
+# Sensors of window_readings_stage, in code order
+WINDOW_SENSORS = (RAIN_SENSOR, LAKE_SENSOR)
+
+
+def aggregate_rain_data_by_storm(stormlist, method='bulk', index=None):
     """Aggregates sensor data for the given sensor
     Sums all value columns. Grouped by gauge, sensor.
 
@@ -16,49 +27,112 @@ def aggregate_rain_data_by_storm(stormlist):
     from the stormlist, and the values data comes from
     dataframe.
 
+    method - 'bulk' (default) sends the whole stormlist to the
+             database and pivots two result sets, 'loop' runs two
+             queries per storm as originally written, 'rollup' is
+             'bulk' reading whole hours from hydromet_hourly,
+             'index' answers every storm from a WindowIndex (index,
+             or one loaded for the span of the storms)
+
 
     Returns X, y as dataframes. y has multiple lakes to choose
     Result |start time| end time| gauge_1| gauge_2| gauge 3... etc
     Result |start time| end time| lake_1 | lake_2|... etc
 
+    Gauges and their order come from the gauge registry
+    (gauge_list.csv)
+
     """
-    ### THIS ENTIRE FUNCTION CAN BE REWRITTEN TO UTILIZED
-    # TWO CROSSTAB (PIVOT) TABLES IN POSTGRESQL WHICH RETURN
-    # SUM OF VALUES GROUPED BY COLLECTION TIME ACROSS ALL
-    # GAUGES
+    mainlakelist = lake_gauges()
+    mainrainlist = rain_gauges()
+
+    lakes = (['start_time', 'end_time'] +
+             [gauge + suffix for suffix in LAKE_SUFFIXES
+              for gauge in mainlakelist])
+    rain = ['start_time', 'end_time'] + mainrainlist
+
+    if method not in ('loop', 'bulk', 'rollup', 'index'):
+        raise ValueError("Unknown aggregation method: {}".format(method))
+
+    with METRICS.timer('storms.aggregate', method=method) as timing:
+        timing.rows = len(stormlist)
+        if method == 'index':
+            if index is None:
+                index = _storm_window_index(stormlist,
+                                            mainrainlist + mainlakelist)
+            raindata, lakedata = index.storm_aggregates(
+                stormlist, mainrainlist, mainlakelist)
+            df = _pivot_storm_aggregates(stormlist, raindata, lakedata,
+                                         mainrainlist, mainlakelist)
+            return df.loc[:, rain], df.loc[:, lakes]
+
+        # Pooled so repeated calls in one process reuse a connection
+        with ManipulateDatabase(pool=get_pool()) as md:
+            if method == 'loop':
+                df = _aggregate_storms_loop(md, stormlist,
+                                            mainrainlist, mainlakelist)
+            else:
+                df = _aggregate_storms_bulk(md, stormlist,
+                                            mainrainlist, mainlakelist,
+                                            use_rollups=method == 'rollup')
 
+    return df.loc[:, rain], df.loc[:, lakes]
 
 
-    md = ManipulateDatabase()
-    md.load_dbinfo_server()
-    md.connect()
-    df = pd.DataFrame()
+def _aggregate_storms_bulk(md, stormlist, mainrainlist, mainlakelist,
+                           use_rollups=False):
+    """Two set-based queries for all storms, pivoted to one row
+    per storm"""
+    raindata, lakedata = md.get_storm_aggregates(stormlist,
+                                                 use_rollups=use_rollups)
+    return _pivot_storm_aggregates(stormlist, raindata, lakedata,
+                                   mainrainlist, mainlakelist)
+
+
+def _pivot_storm_aggregates(stormlist, raindata, lakedata, mainrainlist,
+                            mainlakelist):
+    """One row per storm from get_storm_aggregates style results"""
+    storm_ids = range(len(stormlist))
+
+    df = pd.DataFrame(index=storm_ids)
+    df['start_time'] = [storm_start for storm_start, _ in stormlist]
+    df['end_time'] = [storm_end for _, storm_end in stormlist]
+
+    rain = pd.DataFrame(raindata, columns=['storm', 'gauge', 'value'])
+    rain = rain.pivot(index='storm', columns='gauge', values='value')
+    rain = rain.reindex(index=storm_ids, columns=mainrainlist)
+
+    lake = pd.DataFrame(lakedata, columns=['storm', 'gauge', 'min', 'max'])
+    lakemax = lake.pivot(index='storm', columns='gauge', values='max')
+    lakemax = lakemax.reindex(index=storm_ids, columns=mainlakelist)
+    lakemin = lake.pivot(index='storm', columns='gauge', values='min')
+    lakemin = lakemin.reindex(index=storm_ids, columns=mainlakelist)
+
+    for gauge in mainrainlist:
+        df[gauge] = rain[gauge]
+    for gauge in mainlakelist:
+        df[str(gauge) + "_max"] = lakemax[gauge]
+    for gauge in mainlakelist:
+        df[str(gauge) + "_min"] = lakemin[gauge]
+
+    return df.reset_index(drop=True)
+
+
+def _storm_window_index(stormlist, gauges):
+    """WindowIndex of the rain and lake readings of gauges over the
+    span of the storms"""
+    if not stormlist:
+        return WindowIndex()
+    with ManipulateDatabase(pool=get_pool()) as md:
+        return WindowIndex.from_database(
+            md, gauges=gauges,
+            start_time=min(start for start, _ in stormlist),
+            end_time=max(end for _, end in stormlist))
+
 
-    mainlakelist = [
-        str(3999), str(3963), str(1995), str(2958), str(2999), str(1999)
-                   ]
-
-    lakes = [
-        'start_time', 'end_time', str(3999) + "_max",
-        str(3963) + "_max", str(1995) + "_max", str(2958) + "_max",
-        str(2999) + "_max", str(1999) + "_max", str(3999) + "_min",
-        str(3963) + "_min", str(1995) + "_min", str(2958) + "_min",
-        str(2999) + "_min", str(1999) + "_min"
-            ]
-
-    mainrainlist = [
-        str(4594), str(3991), str(3948),
-        str(3448), str(3237), str(3015), str(2634), str(2348),
-        str(2140), str(2248), str(1921), str(1405), str(1090),
-        str(1307), str(1197)
-                   ]
-
-    rain = [
-        'start_time', 'end_time', str(4594), str(3991), str(3948),
-        str(3448), str(3237), str(3015), str(2634), str(2348),
-        str(2140), str(2248), str(1921), str(1405), str(1090),
-        str(1307), str(1197)
-           ]
+def _aggregate_storms_loop(md, stormlist, mainrainlist, mainlakelist):
+    """Original path, two queries per storm"""
+    df = pd.DataFrame()
 
     startlist = []
     endlist = []
@@ -66,12 +140,7 @@ def aggregate_rain_data_by_storm(stormlist):
     maxdict = defaultdict(list)
     mindict = defaultdict(list)
 
-    i = 0
     for storm_start, storm_end in stormlist:
-        i += 1
-        if i % 50 == 0:
-            print "starting loop {}".format(i)
-
         raindata = md.get_storm_rainfall(storm_start, storm_end)
         startlist.append(storm_start)
         endlist.append(storm_end)
@@ -100,32 +169,151 @@ def aggregate_rain_data_by_storm(stormlist):
         label = str(gauge) + "_min"
         df[label] = mindict[gauge]
 
-    return df.loc[:, rain], df.loc[:, lakes]
+    return df
 
 
-def create_moving_sum(df, leading_hours, trailing_hours):
+def create_moving_sum(df, leading_hours, trailing_hours,
+                      engine='searchsorted'):
     """Leading Hours - Hours after event
     trailing hours - Hours before event
+
+    engine - 'searchsorted' (default) computes every window from a
+             cumulative sum in one vectorized pass, 'iterrows' is the
+             original row-by-row loop kept for comparison
     """
 
     # Clean out zero rain values
     rain_greater_than_zero = df.iloc[:, 1] >= 0
     rainclean = df.iloc[:, 1][rain_greater_than_zero]
-    rainclean.shape
     df['Rain (inches)'] = rainclean
 
     # Set collection time to index
     df.sort_values(["collection_time"], inplace=True)
     df.set_index("collection_time", drop=True, inplace=True)
 
+    if engine not in ('iterrows', 'searchsorted'):
+        raise ValueError("Unknown moving sum engine: {}".format(engine))
+
+    with METRICS.timer('storms.moving_sum', engine=engine) as timing:
+        timing.rows = len(df)
+        if engine == 'iterrows':
+            return _create_moving_sum_iterrows(df, leading_hours,
+                                               trailing_hours)
+        return moving_window_sum(df.index.values,
+                                 df['Rain (inches)'].values,
+                                 leading_hours, trailing_hours)
+
+
+def moving_window_sum(times, values, leading_hours, trailing_hours):
+    """Sum of values in [t - trailing_hours, t + leading_hours]
+    for every timestamp t.
+
+    INPUT:
+        times   | sorted datetime64 array
+        values  | float array, NaN is treated as no rain
+
+    OUTPUT:
+        float64 array aligned with times
+
+    Window edges are inclusive on both ends, matching the label
+    slicing df[start:end] used by the iterrows engine.
+    """
+    times = np.asarray(times)
+    values = np.asarray(values, dtype=np.float64)
+    return _window_sums(times, values, 0, times.shape[0],
+                        _hours(leading_hours), _hours(trailing_hours))
+
+
+def stream_moving_sum(chunks, leading_hours, trailing_hours):
+    """create_moving_sum over a stream of time ordered chunks, such
+    as ManipulateDatabase.iter_max_precip
+
+    A row is summed once the stream has passed t + leading_hours,
+    the rows still needed as window context are carried over to the
+    next chunk. Memory is bounded by one chunk plus one window.
+
+    INPUT:
+        iterable    | DataFrames [collection_time | Rain (inches)],
+                      ordered by time with no time repeated
+
+    OUTPUT:
+        generator   | DataFrames [collection_time | Rain (inches) |
+                      moving_rain_sum], rain cleaned as in
+                      create_moving_sum
+    """
+    lead_delta = _hours(leading_hours)
+    trail_delta = _hours(trailing_hours)
+
+    times = np.empty(0, dtype='datetime64[ns]')
+    values = np.empty(0, dtype=np.float64)
+    # Rows at the front of the buffer already yielded, kept as
+    # context for the windows of later rows
+    done = 0
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        # Clean out negative rain values
+        rain = chunk.iloc[:, 1].astype(np.float64)
+        chunk_values = rain.where(rain >= 0).values
+        times = np.concatenate([times, chunk.iloc[:, 0].values])
+        values = np.concatenate([values, chunk_values])
+
+        ready = np.searchsorted(times, times[-1] - lead_delta, side='right')
+        if ready > done:
+            yield _moving_sum_frame(times, values, done, ready,
+                                    lead_delta, trail_delta)
+            done = ready
+
+        # Later windows start after the next row's time - trailing
+        first_needed = times[min(done, times.shape[0] - 1)] - trail_delta
+        keep = np.searchsorted(times, first_needed, side='left')
+        times = times[keep:]
+        values = values[keep:]
+        done -= keep
+
+    if times.shape[0] > done:
+        yield _moving_sum_frame(times, values, done, times.shape[0],
+                                lead_delta, trail_delta)
+
+
+def _moving_sum_frame(times, values, lo, hi, lead_delta, trail_delta):
+    return pd.DataFrame(
+        {'collection_time': times[lo:hi],
+         'Rain (inches)': values[lo:hi],
+         'moving_rain_sum': _window_sums(times, values, lo, hi,
+                                         lead_delta, trail_delta)},
+        columns=['collection_time', 'Rain (inches)', 'moving_rain_sum'])
+
+
+def _window_sums(times, values, lo, hi, lead_delta, trail_delta):
+    """moving_window_sum for rows lo:hi, windows may reach any row
+    of times/values"""
+    # Index of the first row inside each window and one past the last
+    starts = np.searchsorted(times, times[lo:hi] - trail_delta, side='left')
+    ends = np.searchsorted(times, times[lo:hi] + lead_delta, side='right')
+
+    cumulative = np.empty(values.shape[0] + 1, dtype=np.float64)
+    cumulative[0] = 0.
+    np.cumsum(np.where(np.isnan(values), 0., values), out=cumulative[1:])
+
+    # Rain is never negative, so anything below zero is rounding error
+    return np.maximum(cumulative[ends] - cumulative[starts], 0.)
+
+
+def _hours(hours):
+    return np.timedelta64(datetime.timedelta(hours=hours))
+
+
+def _create_moving_sum_iterrows(df, leading_hours, trailing_hours):
+    """Original O(n*w) engine, expects the frame prepared by
+    create_moving_sum"""
+
     #Create List
     lead_delta = datetime.timedelta(hours=leading_hours)
     trail_delta = datetime.timedelta(hours=trailing_hours)
 
     moving_sum_list = []
-    i = 0
     for row in df.iterrows():
-        i += 1
     #     print row[1][0] #time itself
     #     print row[1][0] - trail_delta #begin of window
     #     print row[1][0] + lead_delta # end of window
@@ -137,160 +325,401 @@ def create_moving_sum(df, leading_hours, trailing_hours):
         # window = df[(df['collection_time'] > start) & (df['collection_time'] < end)]
         window = df[start:end]
         moving_sum_list.append(window["Rain (inches)"].sum())
-        if i % 100000 == 0:
-            print "appended row {}".format(i)
 
     return moving_sum_list
 
 
-def define_storm_events(df, threshold=2):
+def define_storm_events(df, threshold=2, min_duration_hours=None,
+                        merge_gap_hours=None, keep_open=True):
     """
     INPUT - DataFrame [collection_time | Rain | moving_rain_sum]
     OUTPUT - [(start storm, end storm), ....] as datetimes
     Threshold is only based on maximum inches from any gauge...
     not a good indicator of actual inches fallen - but helps
     define when storms are anywhere in the system
+
+    min_duration_hours - drop storms shorter than this
+    merge_gap_hours    - join storms separated by this or less
+    keep_open          - storms already running on the first row or
+                         still running on the last row start/end
+                         there, False drops them
     """
-    df.reset_index(drop=False, inplace=True)
-    df.sort_values(["collection_time"], inplace=True)
+    times, values = _storm_frame_arrays(df)
+    starts, ends = threshold_crossings(values, [threshold],
+                                       keep_open=keep_open)[0]
+    starts, ends = filter_storm_windows(times, starts, ends,
+                                        min_duration_hours,
+                                        merge_gap_hours)
 
-    dfmrs = df['moving_rain_sum']
+    return [(pd.Timestamp(times[start]), pd.Timestamp(times[end]))
+            for start, end in zip(starts, ends)]
 
-    stormlist = []
 
-    for i in xrange(1, df.shape[0]):
-        if ((dfmrs[i] > threshold) and
-           (dfmrs[i - 1] < threshold)):
+def threshold_crossings(values, thresholds, keep_open=True):
+    """Storm edges for several thresholds in one pass
 
-            storm_start = df['collection_time'][i]
+    INPUT:
+        values      | moving rain sum array, sorted by time
+        thresholds  | list of thresholds
 
-        elif ((dfmrs[i] < threshold) and
-            (dfmrs[i - 1] > threshold)):
+    OUTPUT:
+        list of (start indices, end indices) per threshold
 
-            storm_end = df['collection_time'][i]
-            stormlist.append((storm_start, storm_end))
+    A storm starts on the first row at or above the threshold and
+    ends on the first row back below it. A storm running on the
+    first row starts there and one still running on the last row
+    ends there, unless keep_open is False in which case both are
+    dropped.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    n = values.shape[0]
+
+    # Pad with a dry row either side so every storm has both edges
+    above = np.zeros((n + 2, len(thresholds)), dtype=np.int8)
+    # A NaN row is below every threshold
+    with np.errstate(invalid='ignore'):
+        above[1:-1] = values[:, np.newaxis] >= \
+            np.asarray(thresholds)[np.newaxis, :]
+    edges = np.diff(above, axis=0)
+
+    crossings = []
+    for col in xrange(edges.shape[1]):
+        starts = np.flatnonzero(edges[:, col] == 1)
+        ends = np.flatnonzero(edges[:, col] == -1)
+        if not keep_open:
+            closed = (starts > 0) & (ends < n)
+            starts, ends = starts[closed], ends[closed]
+        crossings.append((starts, np.minimum(ends, n - 1)))
+    return crossings
+
+
+def filter_storm_windows(times, starts, ends, min_duration_hours=None,
+                         merge_gap_hours=None):
+    """Merges close storms, then drops short ones
+
+    INPUT:
+        times       | sorted datetime64 array
+        starts/ends | row indices from threshold_crossings
+
+    OUTPUT:
+        (starts, ends) index arrays
+    """
+    if merge_gap_hours is not None and starts.size > 1:
+        gap = np.timedelta64(datetime.timedelta(hours=merge_gap_hours))
+        merge = (times[starts[1:]] - times[ends[:-1]]) <= gap
+        starts = starts[np.concatenate(([True], ~merge))]
+        ends = ends[np.concatenate((~merge, [True]))]
 
-        if i % 100000 == 0:
-            print "Now at {}".format(i)
+    if min_duration_hours is not None:
+        duration = np.timedelta64(
+            datetime.timedelta(hours=min_duration_hours))
+        longer = (times[ends] - times[starts]) >= duration
+        starts, ends = starts[longer], ends[longer]
 
-    return stormlist
+    return starts, ends
 
 
-def column_ids_to_names(df):
+def _storm_frame_arrays(df):
+    """Sorted collection times and moving sums from a frame with
+    collection_time as a column or as the index"""
+    if 'collection_time' in df.columns:
+        times = df['collection_time']
+    else:
+        times = df.index.to_series()
 
-    gauge_dict = {
-    "3999_min": 'Tom Miller Dam_min',
-    "3999_max": 'Tom Miller Dam_max',
-    "4594": 'Driftwood 4 SSE',
-    "3991": 'Jollyville 2 SW',
-    "3963_min": 'Mansfield Dam_min',
-    "3963_max": 'Mansfield Dam_max',
-    "3948": 'Lakeway 2 E',
-    "3448": 'Blanco 5 NNE',
-    "3237": 'Harper 4 SSW',
-    "3015": 'Burnet 1 WSW',
-    "2634": 'Cherokee 4 SSE',
-    "2348": 'Menard 12 SSE',
-    "2140": 'Sonora 14 SE',
-    "2248": 'Rocksprings 12 NE',
-    "1995_min": 'Buchanan Dam_min',
-    "1995_max": 'Buchanan Dam_max',
-    "1921": 'Lometa 2 WNW',
-    "1405": 'Eldorado 2 E',
-    "1090": 'Millersview 7 WSW',
-    "1307": 'Clyde 6 S',
-    "1197": 'Rochelle 5 NNW',
-    "2958_min": 'Wirtz Dam_min',
-    "2958_max": 'Wirtz Dam_max',
-    "2999_min": 'Starcke Dam_min',
-    "2999_max": 'Starcke Dam_max',
-    "1999_min": 'Inks Dam_min',
-    "1999_max": 'Inks Dam_max'
-             }
-
-    return df.rename(columns=gauge_dict).copy()
+    if not times.is_monotonic_increasing:
+        order = np.argsort(times.values, kind='mergesort')
+        return (times.values[order],
+                df['moving_rain_sum'].values[order])
+    return times.values, df['moving_rain_sum'].values
 
 
-def convert_lake_levels_to_volumes(df):
-    """One-off script to convert lake levels to volumes"""
+def sweep_storm_thresholds(df, thresholds, method='index', index=None,
+                           min_duration_hours=None, merge_gap_hours=None,
+                           keep_open=True):
+    """Storm features for every threshold from one moving sum
 
-    df = df.round(1)
-    for column in df:
-        if ((column == "Mansfield Dam_min") or
-           (column == "Mansfield Dam_max")):
-            table = pd.read_csv("tables/Travis.txt")
-            table.set_index(['ft-MSL'], inplace=True)
-            elevdict = table.to_dict()['acre-feet']
-            df[column] = df[column].map(elevdict)
+    INPUT - DataFrame [collection_time | Rain | moving_rain_sum]
+            as saved to movingsumcomplete.pkl
+    OUTPUT - {threshold: (X, y_all)} as from aggregate_rain_data_by_storm
+
+    Crossings for all thresholds are found in one vectorized pass.
+    The distinct storm windows of all thresholds are aggregated in a
+    single aggregate_rain_data_by_storm call and every threshold
+    takes its rows, so a window shared between thresholds is
+    aggregated once. With method='index' (default) that call loads
+    one WindowIndex over the span of the windows, or uses index, and
+    answers every window from its prefix sums and min/max tables.
+
+    There is no parallel per-threshold aggregation and no process
+    pool. Thresholds share one aggregation call in this process.
+
+    min_duration_hours, merge_gap_hours and keep_open are applied to
+    every threshold as in define_storm_events
+    """
+    times, values = _storm_frame_arrays(df)
 
-        elif ((column == "Buchanan Dam_min") or
-             (column == "Buchanan Dam_max")):
-            table = pd.read_csv("tables/Buchanan.txt")
-            table.set_index(['ft-MSL'], inplace=True)
-            elevdict = table.to_dict()['acre-feet']
-            df[column] = df[column].map(elevdict)
+    crossings = [filter_storm_windows(times, starts, ends,
+                                      min_duration_hours,
+                                      merge_gap_hours)
+                 for starts, ends in threshold_crossings(
+                     values, thresholds, keep_open=keep_open)]
 
+    windows = {}
+    for starts, ends in crossings:
+        for window in zip(starts, ends):
+            windows.setdefault(window, len(windows))
+    unique = sorted(windows, key=windows.get)
+    stormlist = [(pd.Timestamp(times[start]), pd.Timestamp(times[end]))
+                 for start, end in unique]
 
-    remove =['Wirtz Dam_min', 'Wirtz Dam_max', 'Starcke Dam_min',
-             'Starcke Dam_max', 'Inks Dam_min', 'Inks Dam_max',
-             'Tom Miller Dam_max', 'Tom Miller Dam_min']
+    X, y_all = aggregate_rain_data_by_storm(stormlist, method=method,
+                                            index=index)
 
-    for item in remove:
-        del df[item]
+    results = {}
+    for threshold, (starts, ends) in zip(thresholds, crossings):
+        rows = [windows[window] for window in zip(starts, ends)]
+        results[threshold] = (X.iloc[rows].reset_index(drop=True),
+                              y_all.iloc[rows].reset_index(drop=True))
+    return results
 
-    return df
 
-if __name__ == "__main__":
-    import datetime
-    from src.sql_class import ManipulateDatabase
-    import pandas as pd
+def column_ids_to_names(df):
+    """Gauge id columns to gauge names, see gauge_registry"""
+    return rename_columns(df)
+
+
+def convert_lake_levels_to_volumes(df):
+    """Converts the min/max levels of the dams with rating tables
+    (Mansfield and Buchanan) to acre-feet and drops the other dams"""
+
+    def lake_columns(rated):
+        return [gauge_name(gauge) + suffix
+                for gauge in lake_gauges(rated=rated)
+                for suffix in LAKE_SUFFIXES
+                if gauge_name(gauge) + suffix in df]
 
-    md = ManipulateDatabase()
-    md.load_dbinfo_server()
-    md.connect()
-    data = md.query_max_precip()
-    print 'max precip done'
-    df = pd.DataFrame(data, columns=["collection_time", "Rain (inches)"])## LIMIT
-    print 'df built'
-    df['moving_rain_sum'] = create_moving_sum(df, leading_hours=10, trailing_hours=24)
+    df = convert_levels(df, columns=lake_columns(True))
+    return df.drop(lake_columns(False), axis=1)
 
-    df.to_pickle('../pickled_files/movingsumcomplete.pkl')
+def moving_sum_stage(leading_hours, trailing_hours, itersize=100000):
+    """Pipeline stage: moving rain sum of the max precip series,
+    streamed from the database
+
+    OUTPUT:
+        DataFrame   | index collection_time,
+                      [Rain (inches) | moving_rain_sum]
+    """
+    with ManipulateDatabase(pool=get_pool()) as md:
+        chunks = stream_moving_sum(md.iter_max_precip(itersize=itersize),
+                                   leading_hours, trailing_hours)
+        df = pd.concat(list(chunks), ignore_index=True)
+    df.set_index("collection_time", drop=True, inplace=True)
+    return df
 
 
+def storm_events_stage(moving_sum, threshold, min_duration_hours=None,
+                       merge_gap_hours=None):
+    """Pipeline stage: define_storm_events as a frame
 
-    # Aggregate data including SQL queries (Can have improvement using
-    # pivottables
+    OUTPUT:
+        DataFrame   | [start_time | end_time]
+    """
+    storms = define_storm_events(moving_sum, threshold=threshold,
+                                 min_duration_hours=min_duration_hours,
+                                 merge_gap_hours=merge_gap_hours)
+    return pd.DataFrame(storms, columns=['start_time', 'end_time'])
 
-    df = pd.read_pickle('pickled_files/movingsumcomplete.pkl')
 
-    thresholds = [0.25, 0.5, 1.5, 2.5, 1]
-    for current_thres in thresholds:
-        df = pd.read_pickle('pickled_files/movingsumcomplete.pkl')
-        storms = define_storm_events(df, threshold=current_thres)
-        X, y_all = aggregate_rain_data_by_storm(storms)
+def window_readings_stage(gauges):
+    """Pipeline stage: the rain and lake readings of gauges that the
+    index aggregation answers storms from, read once for every
+    threshold
 
-        xlabel = "pickled_files/X_10_24_thres" + str(current_thres) + ".pkl"
-        ylabel = "pickled_files/y_all_10_24_thres" + str(current_thres) + ".pkl"
+    OUTPUT:
+        DataFrame   | [gauge | sensor | collection_time | value],
+                      gauge the position in gauges and sensor in
+                      WINDOW_SENSORS so no column holds strings
+    """
+    with ManipulateDatabase(pool=get_pool()) as md:
+        index = WindowIndex.from_database(md, gauges=gauges,
+                                          sensors=WINDOW_SENSORS)
+    parts = []
+    for (gauge, sensor), series in sorted(index.series.items()):
+        n = series.times.shape[0]
+        parts.append(pd.DataFrame(
+            {'gauge': np.full(n, gauges.index(gauge), dtype=np.int16),
+             'sensor': np.full(n, WINDOW_SENSORS.index(sensor),
+                               dtype=np.int16),
+             'collection_time': series.times,
+             'value': series.values},
+            columns=['gauge', 'sensor', 'collection_time', 'value']))
+    if not parts:
+        return pd.DataFrame(columns=['gauge', 'sensor', 'collection_time',
+                                     'value'])
+    return pd.concat(parts, ignore_index=True)
+
+
+def storm_aggregates_stage(storms, readings=None, method='bulk',
+                           gauges=None):
+    """Pipeline stage: aggregate_rain_data_by_storm, X and y_all side
+    by side. With method='index' the storms are answered from
+    readings (window_readings_stage of gauges).
+
+    OUTPUT:
+        DataFrame   | [start_time | end_time | rain gauges... |
+                       lake _max... | lake _min...]
+    """
+    stormlist = list(zip(storms['start_time'], storms['end_time']))
+    index = None
+    if readings is not None:
+        index = _readings_index(readings, gauges)
+    X, y_all = aggregate_rain_data_by_storm(stormlist, method=method,
+                                            index=index)
+    return pd.concat([X, y_all.iloc[:, 2:]], axis=1)
+
+
+def _readings_index(readings, gauges):
+    """WindowIndex of a window_readings_stage frame"""
+    index = WindowIndex()
+    codes = (readings['gauge'].values.astype(np.int64) *
+             len(WINDOW_SENSORS) + readings['sensor'].values)
+    # Rows come grouped by gauge and sensor
+    bounds = np.flatnonzero(np.diff(codes)) + 1
+    for lo, hi in zip(np.concatenate([[0], bounds]),
+                      np.concatenate([bounds, [codes.shape[0]]])):
+        if lo == hi:
+            continue
+        gauge, sensor = divmod(codes[lo], len(WINDOW_SENSORS))
+        index.add_series(gauges[gauge], WINDOW_SENSORS[sensor],
+                         readings['collection_time'].values[lo:hi],
+                         readings['value'].values[lo:hi])
+    return index
+
+
+def named_rain_stage(aggregates):
+    """Pipeline stage: rain columns of the aggregates, named"""
+    lake = _lake_columns(aggregates)
+    return column_ids_to_names(
+        aggregates.loc[:, [c for c in aggregates if c not in lake]])
+
+
+def lake_volume_stage(aggregates):
+    """Pipeline stage: lake columns of the aggregates, named and
+    converted to volumes"""
+    columns = ['start_time', 'end_time'] + _lake_columns(aggregates)
+    return convert_lake_levels_to_volumes(
+        column_ids_to_names(aggregates.loc[:, columns]))
+
+
+def inflow_stage(gauge, smooth_readings=13, max_gap_hours=2):
+    """Pipeline stage: continuous storage and net inflow series of a
+    dam, see inflow.derive_inflow"""
+    with ManipulateDatabase(pool=get_pool()) as md:
+        return load_inflow(md, gauge, smooth_readings=smooth_readings,
+                           max_gap_hours=max_gap_hours)
+
+
+def storm_inflow_stage(storms, *inflows, **params):
+    """Pipeline stage: net inflow (acre-feet) of each storm window
+    from precomputed inflow series, one column per gauge
+
+    params: gauges        - gauge ids in the order of the inflow frames
+            max_gap_hours - as for the inflow frames
+    """
+    df = storms.loc[:, ['start_time', 'end_time']].copy()
+    for gauge, series in zip(params['gauges'], inflows):
+        df[str(gauge) + '_inflow'] = window_inflow(
+            series, df['start_time'], df['end_time'],
+            max_gap_hours=params['max_gap_hours'])
+    return df
 
-        X.to_pickle(xlabel)
-        y_all.to_pickle(ylabel)
 
+def _lake_columns(df):
+    return [c for c in df if c.endswith('_max') or c.endswith('_min')]
 
-        # CONVERT NAMED AND LAKE VOLUMES
 
-    pickledX = ["X_10_24_thres0.25.pkl", "X_10_24_thres0.5.pkl",
-               "X_10_24_thres1.pkl", "X_10_24_thres1.5.pkl", "X_10_24_thres2.5.pkl"]
+def build_storm_dag(cache, source, thresholds, leading_hours=10,
+                    trailing_hours=24, method='index',
+                    inflow_gauges=('3963', '1995'), max_gap_hours=2):
+    """The storm pipeline as a PipelineDAG
+
+    moving_sum -> storms_thresT -> aggregates_thresT -> final_X_thresT
+    window_readings -------------^                   -> final_y_all_thresT
+    inflow_G --------------------------------------> storm_inflow_thresT
+    for every threshold T and inflow gauge G. Every stage of a
+    threshold is keyed by that threshold alone, so adding one only
+    runs its own stages. window_readings (method='index' only) reads
+    the readings once for all thresholds. source identifies the
+    hydromet data, e.g. ManipulateDatabase.data_version().
+    max_gap_hours is the longest gap in lake levels the inflows
+    bridge, see inflow.derive_inflow.
+    """
+    dag = PipelineDAG(cache, source=source)
+    dag.add('moving_sum', moving_sum_stage,
+            params={'leading_hours': leading_hours,
+                    'trailing_hours': trailing_hours})
+    if method == 'index':
+        gauges = rain_gauges() + lake_gauges()
+        dag.add('window_readings', window_readings_stage,
+                params={'gauges': gauges})
+    inflows = ['inflow_' + str(gauge) for gauge in inflow_gauges]
+    for gauge, name in zip(inflow_gauges, inflows):
+        dag.add(name, inflow_stage, params={'gauge': str(gauge),
+                                            'max_gap_hours': max_gap_hours})
+    for threshold in thresholds:
+        suffix = '_thres' + str(threshold)
+        dag.add('storms' + suffix, storm_events_stage, ['moving_sum'],
+                {'threshold': threshold})
+        if method == 'index':
+            dag.add('aggregates' + suffix, storm_aggregates_stage,
+                    ['storms' + suffix, 'window_readings'],
+                    {'method': method, 'gauges': gauges})
+        else:
+            dag.add('aggregates' + suffix, storm_aggregates_stage,
+                    ['storms' + suffix], {'method': method})
+        dag.add('final_X' + suffix, named_rain_stage,
+                ['aggregates' + suffix])
+        dag.add('final_y_all' + suffix, lake_volume_stage,
+                ['aggregates' + suffix])
+        if inflows:
+            dag.add('storm_inflow' + suffix, storm_inflow_stage,
+                    ['storms' + suffix] + inflows,
+                    {'gauges': [str(gauge) for gauge in inflow_gauges],
+                     'max_gap_hours': max_gap_hours})
+    return dag
 
-    pickledy = ["y_all_10_24_thres0.25.pkl", "y_all_10_24_thres0.5.pkl",
-               "y_all_10_24_thres1.pkl", "y_all_10_24_thres1.5.pkl", "y_all_10_24_thres2.5.pkl"]
 
-    pickledX.extend(pickledy)
-    for filename in pickledX:
-        direc = "pickled_files/" + filename
-        df = pd.read_pickle(direc)
-        df = column_ids_to_names(df)
-        if filename[0] == 'y':
-            df = convert_lake_levels_to_volumes(df)
+if __name__ == "__main__":
+    from columnar_cache import ColumnarCache
+
+    # Stage outputs are cached by parameters and the state of
+    # hydromet, so re-runs only redo the stages a change affects.
+    # Thresholds run one after another in this process, there is no
+    # parallel per-threshold aggregation. Each threshold aggregates
+    # its own storms, from a window index over readings read once
+    # for all of them by default, method='bulk' for the bulk pivot
+    # queries, method='loop' for the per-storm queries,
+    # method='rollup' once md.create_rollup_tables() has been run
+    # Per-stage timings, python metrics.py report for the breakdown
+    METRICS.configure('../metrics/pipeline.metrics.jsonl')
+    with ManipulateDatabase(pool=get_pool()) as md:
+        source = md.data_version()
 
-        direc = "pickled_files/final_" + filename
-        df.to_pickle(direc)
+    thresholds = [0.25, 0.5, 1.5, 2.5, 1]
+    dag = build_storm_dag(ColumnarCache('../cache'), source, thresholds,
+                          leading_hours=10, trailing_hours=24)
+    finals = dag.run([name for name in dag.stages
+                      if name.startswith('final_') or
+                      name.startswith('storm_inflow')])
+    print 'ran stages: {}'.format(', '.join(dag.ran) or 'none')
+    print METRICS.summary().to_string(float_format='{:.3f}'.format)
+
+    # The notebooks read the final frames as pickles, named after the
+    # moving sum hours, e.g. final_X_10_24_thres0.5.pkl
+    hours = dag.stages['moving_sum'].params
+    window = '_{}_{}_thres'.format(hours['leading_hours'],
+                                   hours['trailing_hours'])
+    for name, df in finals.items():
+        df.to_pickle("../pickled_files/" +
+                     name.replace('_thres', window) + ".pkl")
@@ -0,0 +1,299 @@
+"""Synthetic hydromet readings for benchmarks and local development.
+
+Generates the 15 minute rain and lake-level series of the registry's
+gauges for any time range, reproducible from a seed, so the pipeline
+can be run and timed without the AWS database.
+
+Rain comes from regional storms, more of them in the wet months
+(May/June, October). Every rain gauge the storm reaches gets its own
+depth and a burst-shaped 15 minute profile, a little earlier or
+later than its neighbours. Lake levels follow their watershed's rain:
+rated lakes route runoff into storage and release a little every
+interval, with levels read back off their rating curve so they stay
+within the table; the constant level lakes only rise briefly around
+their normal operating level.
+
+    synthetic = SyntheticHydromet('2012-01-01', '2013-01-01', seed=0)
+    for readings in synthetic.readings(chunk_days=30):
+        loader.add(readings)
+
+optional arguments:
+python synthetic_hydromet.py start_date end_date [seed]
+prints a summary of the readings instead of loading them
+"""
+
+from sys import argv
+
+import numpy as np
+import pandas as pd
+
+from gauge_registry import rain_gauges, lake_gauges, load_registry
+from rating_curves import get_curve
+from window_index import RAIN_SENSOR, LAKE_SENSOR
+
+
+INTERVAL = np.timedelta64(15, 'm')
+INTERVALS_PER_DAY = 96
+
+# Relative storm frequency by month, after Austin's monthly normals
+MONTH_WEIGHTS = np.array([2.2, 2.0, 2.8, 2.1, 4.4, 4.3,
+                          1.9, 2.3, 2.9, 3.9, 2.8, 2.6])
+
+# Normal operating levels (ft-MSL) of the lakes kept near constant,
+# which have no rating table. Lakes missing here sit at DEFAULT_LEVEL.
+CONSTANT_LEVELS = {'3999': 492.8,   # Lake Austin
+                   '2958': 825.0,   # Lake LBJ
+                   '2999': 737.8,   # Lake Marble Falls
+                   '1999': 888.0}   # Inks Lake
+DEFAULT_LEVEL = 700.
+
+# Runoff reaches the lakes over a few days, an exponential unit
+# hydrograph with a one day time constant, cut at five days
+RUNOFF_KERNEL = np.exp(-np.arange(5 * INTERVALS_PER_DAY) /
+                       float(INTERVALS_PER_DAY))
+RUNOFF_KERNEL /= RUNOFF_KERNEL.sum()
+
+# Storage gained per inch of watershed runoff, as a fraction of the
+# rating table's capacity, and storage released every interval
+RUNOFF_FRACTION = 0.01
+RELEASE_RATE = 4e-6
+
+# Feet a constant level lake rises per inch/interval of runoff, and
+# the most it rises
+CONSTANT_RISE_FT = 40.
+CONSTANT_MAX_RISE_FT = 4.
+
+
+class SyntheticHydromet(object):
+    """
+    Reproducible rain and lake-level readings for [start, end]
+
+    rain/lakes       - gauge ids, default the registry's rain and lake
+                       gauges
+    storms_per_year  - mean number of regional storms
+    missing          - fraction of readings left out, like the gaps
+                       in scraped data
+    seed             - the same seed and chunk_days give the same
+                       readings
+    """
+
+    def __init__(self, start, end, rain=None, lakes=None,
+                 storms_per_year=45, missing=0.001, seed=0):
+        self.start = pd.Timestamp(start).floor('15min')
+        end = pd.Timestamp(end)
+        self.n_intervals = int((end - self.start) / pd.Timedelta('15min')) + 1
+        self.rain = [str(gauge) for gauge in (rain or rain_gauges())]
+        self.lakes = [str(gauge) for gauge in (lakes or lake_gauges())]
+        self.storms_per_year = storms_per_year
+        self.missing = missing
+        self.seed = seed
+
+        rng = np.random.RandomState(seed)
+        self.storms = self._plan_storms(rng)
+        self._gauge_rain = self._plan_gauge_rain(rng)
+
+
+    @property
+    def n_readings(self):
+        """Readings before gaps are taken out"""
+        return self.n_intervals * (len(self.rain) + len(self.lakes))
+
+
+    def frames(self, chunk_days=30):
+        """Readings as DataFrames of chunk_days at a time
+
+        OUTPUT:
+            generator   | DataFrames [collection_time | gauge | sensor |
+                          value], one block per gauge, in time order
+                          across chunks
+        """
+        step = chunk_days * INTERVALS_PER_DAY
+        basins = self._basin_gauges()
+        tails = {lake: np.zeros(RUNOFF_KERNEL.shape[0] - 1)
+                 for lake in self.lakes}
+        storage = self._initial_storage()
+
+        for lo in range(0, self.n_intervals, step):
+            hi = min(lo + step, self.n_intervals)
+            rng = np.random.RandomState([self.seed, lo])
+            times = (np.datetime64(self.start, 'ns') +
+                     np.arange(lo, hi) * INTERVAL)
+            rain = {gauge: self._chunk_rain(gauge, lo, hi)
+                    for gauge in self.rain}
+
+            parts = []
+            for gauge in self.rain:
+                parts.append(self._frame(times, gauge, RAIN_SENSOR,
+                                         rain[gauge], rng))
+            for lake in self.lakes:
+                gauges = basins[lake]
+                if gauges:
+                    basin = np.mean([rain[gauge] for gauge in gauges],
+                                    axis=0)
+                else:
+                    basin = np.zeros(hi - lo)
+                runoff, tails[lake] = _route_runoff(basin, tails[lake])
+                levels, storage[lake] = self._lake_levels(
+                    lake, runoff, storage[lake], rng)
+                parts.append(self._frame(times, lake, LAKE_SENSOR, levels,
+                                         rng))
+            yield pd.concat(parts, ignore_index=True)
+
+
+    def readings(self, chunk_days=30):
+        """frames as lists of (collection_time, gauge, sensor, value)
+        tuples, the format HydrometLoader and the scrapers use"""
+        for df in self.frames(chunk_days):
+            yield list(zip(df['collection_time'].dt.to_pydatetime(),
+                           df['gauge'], df['sensor'],
+                           df['value'].astype(float)))
+
+
+    def _plan_storms(self, rng):
+        """[(first interval, intervals, mean depth in inches), ...]
+        in time order"""
+        years = self.n_intervals / (365.25 * INTERVALS_PER_DAY)
+        n_storms = rng.poisson(self.storms_per_year * years)
+
+        # Storm starts weighted by month, by rejection
+        starts = []
+        weights = MONTH_WEIGHTS / MONTH_WEIGHTS.max()
+        while len(starts) < n_storms:
+            candidates = rng.randint(0, self.n_intervals, 2 * n_storms + 10)
+            months = (self.start + pd.to_timedelta(candidates * 15,
+                                                   unit='m')).month
+            keep = rng.random_sample(candidates.shape[0]) < \
+                weights[np.asarray(months) - 1]
+            starts.extend(candidates[keep][:n_storms - len(starts)])
+        starts = np.sort(np.asarray(starts, dtype=np.int64))
+
+        hours = np.clip(rng.gamma(2., 4., n_storms), 1., 48.)
+        lengths = np.maximum((hours * 4).astype(np.int64), 1)
+        depths = np.clip(rng.lognormal(np.log(0.5), 0.9, n_storms),
+                         0.01, 12.)
+        return list(zip(starts, lengths, depths))
+
+
+    def _plan_gauge_rain(self, rng):
+        """{gauge: (sorted interval indexes, inches)} of the rainy
+        intervals of every rain gauge"""
+        indexes = {gauge: [] for gauge in self.rain}
+        values = {gauge: [] for gauge in self.rain}
+        for start, length, depth in self.storms:
+            for gauge in self.rain:
+                if rng.random_sample() > 0.7:
+                    continue
+                gauge_depth = depth * rng.lognormal(0., 0.5)
+                # Bursty profile, most of the rain in a few intervals
+                profile = rng.gamma(0.6, 1., length)
+                profile /= profile.sum()
+                inches = np.round(gauge_depth * profile, 2)
+                offset = start + rng.randint(-8, 9)
+                index = offset + np.arange(length)
+                keep = ((inches > 0) & (index >= 0) &
+                        (index < self.n_intervals))
+                indexes[gauge].append(index[keep])
+                values[gauge].append(inches[keep])
+
+        planned = {}
+        for gauge in self.rain:
+            index = np.concatenate(indexes[gauge] + [np.empty(0, np.int64)])
+            inches = np.concatenate(values[gauge] + [np.empty(0)])
+            order = np.argsort(index, kind='mergesort')
+            planned[gauge] = (index[order], inches[order])
+        return planned
+
+
+    def _chunk_rain(self, gauge, lo, hi):
+        index, inches = self._gauge_rain[gauge]
+        first, last = np.searchsorted(index, [lo, hi])
+        rain = np.zeros(hi - lo)
+        # Overlapping storms add up
+        np.add.at(rain, index[first:last] - lo, inches[first:last])
+        return rain
+
+
+    def _basin_gauges(self):
+        """{lake: rain gauges of its watershed}, every rain gauge for
+        watersheds without one of their own"""
+        registry = load_registry()
+        basins = {}
+        for lake in self.lakes:
+            watershed = (registry.at[lake, 'watershed']
+                         if lake in registry.index else None)
+            gauges = [gauge for gauge in self.rain
+                      if gauge in registry.index and
+                      registry.at[gauge, 'watershed'] == watershed]
+            basins[lake] = gauges or list(self.rain)
+        return basins
+
+
+    def _initial_storage(self):
+        """Rated lakes start 50-80% of the way up their rating table"""
+        rng = np.random.RandomState([self.seed, 1])
+        storage = {}
+        for lake in self.lakes:
+            curve = get_curve(lake)
+            if curve is None:
+                storage[lake] = None
+                continue
+            low, high = curve.elevation[0], curve.elevation[-1]
+            level = low + rng.uniform(0.5, 0.8) * (high - low)
+            storage[lake] = float(curve.volume([level])[0])
+        return storage
+
+
+    def _lake_levels(self, lake, runoff, storage, rng):
+        """Levels of one chunk and the storage at its end"""
+        curve = get_curve(lake)
+        noise = rng.normal(0., 0.01, runoff.shape[0])
+        if curve is None:
+            rise = np.minimum(CONSTANT_RISE_FT * runoff,
+                              CONSTANT_MAX_RISE_FT)
+            level = CONSTANT_LEVELS.get(lake, DEFAULT_LEVEL)
+            return np.round(level + rise + noise, 2), None
+
+        capacity = curve.volume_af[-1]
+        floor = float(curve.volume([curve.elevation[0] + 0.3 *
+                                    (curve.elevation[-1] -
+                                     curve.elevation[0])])[0])
+        # Release from the storage at the start of the chunk
+        change = (runoff * RUNOFF_FRACTION * capacity -
+                  storage * RELEASE_RATE)
+        volume = np.clip(storage + np.cumsum(change), floor, capacity)
+        levels = curve.level(volume)
+        return np.round(levels + noise, 2), float(volume[-1])
+
+
+    def _frame(self, times, gauge, sensor, values, rng):
+        keep = rng.random_sample(values.shape[0]) >= self.missing
+        return pd.DataFrame({'collection_time': times[keep],
+                             'gauge': gauge,
+                             'sensor': sensor,
+                             'value': values[keep]},
+                            columns=['collection_time', 'gauge', 'sensor',
+                                     'value'])
+
+
+def _route_runoff(basin, tail):
+    """Basin rain of a chunk convolved with RUNOFF_KERNEL, tail is
+    the rain of the intervals before the chunk. Returns the runoff
+    and the tail for the next chunk."""
+    full = np.concatenate([tail, basin])
+    runoff = np.convolve(full, RUNOFF_KERNEL)[:full.shape[0]]
+    return runoff[tail.shape[0]:], full[-tail.shape[0]:]
+
+
+if __name__ == "__main__":
+    start, end, seed = '2012-01-01', '2013-01-01', 0
+    if len(argv) > 2:
+        start, end = argv[1], argv[2]
+    if len(argv) > 3:
+        seed = int(argv[3])
+
+    synthetic = SyntheticHydromet(start, end, seed=seed)
+    df = pd.concat(synthetic.frames(), ignore_index=True)
+    print "{} readings, {} storms".format(len(df), len(synthetic.storms))
+    summary = df.groupby(['sensor', 'gauge'])['value'].agg(
+        ['count', 'sum', 'min', 'max'])
+    print summary.to_string(float_format='{:.2f}'.format)
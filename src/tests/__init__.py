@@ -0,0 +1,6 @@
+"""Unit tests of the numeric cores, each checked against a plain
+Python reference on small deterministic inputs.
+
+Run from src/:
+python -m unittest discover -s tests -t .
+"""
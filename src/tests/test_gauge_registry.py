@@ -0,0 +1,57 @@
+"""rename_columns against a per column reference"""
+
+import unittest
+
+import pandas as pd
+
+from gauge_registry import (rename_columns, load_registry, gauge_name,
+                            LAKE_SUFFIXES)
+
+
+def brute_name(column, registry):
+    """Registry name of a gauge id column, suffix kept"""
+    column = str(column)
+    for suffix in LAKE_SUFFIXES + ('',):
+        base = column[:len(column) - len(suffix)]
+        if column.endswith(suffix) and base in registry.index:
+            return registry.loc[base, 'name'] + suffix
+    return column
+
+
+class RenameColumnsTest(unittest.TestCase):
+
+    def test_to_name_and_back(self):
+        registry = load_registry()
+        columns = (['start_time', 'end_time', 'Rain (inches)', '_max',
+                    '9999', '9999_max', '3963_mean'] +
+                   list(registry.index) +
+                   [gauge + suffix for suffix in LAKE_SUFFIXES
+                    for gauge in registry.index])
+        df = pd.DataFrame([range(len(columns))], columns=columns)
+
+        named = rename_columns(df)
+        self.assertEqual(list(named.columns),
+                         [brute_name(c, registry) for c in columns])
+        self.assertEqual(list(named.iloc[0]), list(df.iloc[0]))
+        self.assertEqual(list(df.columns), columns)
+        self.assertEqual(list(rename_columns(named, to='id').columns),
+                         columns)
+
+    def test_known_gauges(self):
+        df = pd.DataFrame(columns=['3963', '3963_max', '3963_min', '4594'])
+        self.assertEqual(list(rename_columns(df).columns),
+                         ['Mansfield Dam', 'Mansfield Dam_max',
+                          'Mansfield Dam_min', 'Driftwood 4 SSE'])
+        self.assertEqual(gauge_name('3963'), 'Mansfield Dam')
+
+    def test_non_string_columns(self):
+        df = pd.DataFrame([[1, 2]], columns=[0, 3963])
+        self.assertEqual(list(rename_columns(df).columns), [0, 'Mansfield Dam'])
+
+    def test_unknown_target(self):
+        self.assertRaises(ValueError, rename_columns, pd.DataFrame(),
+                          to='catalog')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""Storage interpolation and window inflow across gaps"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from inflow import derive_inflow, storage_at, window_inflow
+from rating_curves import RatingCurve
+
+
+def readings():
+    """Hourly levels with a three hour and a five hour gap"""
+    hours = np.array([0, 1, 2, 5, 6, 11, 12], dtype=np.float64)
+    times = (pd.Timestamp('2012-01-01') +
+             pd.to_timedelta(hours, unit='h')).values
+    levels = 600. + hours / 10.
+    return times, levels
+
+
+class StorageAtTest(unittest.TestCase):
+
+    def setUp(self):
+        # Volume 100 af per foot, so storage is linear in time
+        self.curve = RatingCurve([590., 610.], [0., 2000.])
+        self.times, self.levels = readings()
+        self.series = derive_inflow(self.times, self.levels, self.curve,
+                                    smooth_readings=1, max_gap_hours=2)
+
+    def at(self, hours, max_gap_hours=2):
+        times = pd.Timestamp('2012-01-01') + pd.to_timedelta(hours, unit='h')
+        return storage_at(self.series, times, max_gap_hours)
+
+    def test_matches_rate_gaps(self):
+        hours = np.arange(-1, 13.5, 0.5)
+        volume = 1000. + hours * 10.
+        rate_known = self.series['inflow'].notnull().values
+        readings = (self.times - self.times[0]) / np.timedelta64(1, 'h')
+        for max_gap_hours in (2, 3, 5):
+            # Interpolated where the rate is known or on a reading
+            expected = []
+            for hour, value in zip(hours, volume):
+                later = np.searchsorted(readings, hour)
+                on_reading = (later < readings.shape[0] and
+                              readings[later] == hour)
+                inside = 0 < later < readings.shape[0]
+                bridged = (inside and readings[later] -
+                           readings[later - 1] <= max_gap_hours)
+                expected.append(value if on_reading or bridged else np.nan)
+            np.testing.assert_allclose(self.at(hours, max_gap_hours),
+                                       expected, err_msg=str(max_gap_hours))
+        # The derive_inflow rate of the same series agrees
+        self.assertEqual(list(rate_known),
+                         [False, True, True, False, True, False, True])
+
+    def test_window_inflow(self):
+        starts = (pd.Timestamp('2012-01-01') +
+                  pd.to_timedelta([0, 0.5, 3, 5, 0, 7], unit='h'))
+        ends = (pd.Timestamp('2012-01-01') +
+                pd.to_timedelta([2, 1.5, 6, 6, 12, 12], unit='h'))
+        np.testing.assert_allclose(
+            window_inflow(self.series, starts, ends),
+            [20., 10., np.nan, 10., 120., np.nan])
+        np.testing.assert_allclose(
+            window_inflow(self.series, starts, ends, max_gap_hours=5),
+            [20., 10., 30., 10., 120., 50.])
+
+    def test_unknown_volumes_are_gaps(self):
+        # A level off the curve drops out like a missing reading,
+        # leaving two hours between its neighbours
+        levels = self.levels.copy()
+        levels[1] = 700.
+        series = derive_inflow(self.times, levels, self.curve,
+                               smooth_readings=1)
+        times = pd.Timestamp('2012-01-01') + pd.to_timedelta([0.5, 1.5],
+                                                             unit='h')
+        self.assertTrue(np.isnan(storage_at(series, times, 1)).all())
+        np.testing.assert_allclose(storage_at(series, times, 2),
+                                   [1005., 1015.])
+        self.assertTrue(np.isnan(series['inflow'].values[1:3]).all())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Rating curve interpolation against brute force references"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from rating_curves import RatingCurve, get_curve, convert_levels
+
+
+def brute_interpolate(x, xp, fp):
+    """Linear interpolation between the two table rows around x,
+    found by walking the table, NaN outside it"""
+    for i in xrange(len(xp) - 1):
+        if xp[i] <= x <= xp[i + 1]:
+            return fp[i] + (x - xp[i]) * (fp[i + 1] - fp[i]) / \
+                (xp[i + 1] - xp[i])
+    return np.nan
+
+
+def brute_level(v, elevation, volume):
+    """Lowest elevation holding volume v, walking up the table"""
+    for i in xrange(len(elevation) - 1):
+        if volume[i] <= v <= volume[i + 1]:
+            if volume[i] == v:
+                return elevation[i]
+            return brute_interpolate(v, volume[i:i + 2], elevation[i:i + 2])
+    return np.nan
+
+
+class RatingCurveTest(unittest.TestCase):
+
+    def setUp(self):
+        # Unsorted rows, flat at the bottom like the shipped tables
+        self.elevation = [620., 600., 605., 610.]
+        self.volume = [400., 0., 0., 100.]
+        self.area = [30., 0., 5., 20.]
+        self.curve = RatingCurve(self.elevation, self.volume, area=self.area)
+
+    def test_volume_and_area(self):
+        levels = [599.9, 600., 602.5, 605., 607.3, 610., 615.55, 620.,
+                  620.1, np.nan]
+        xp = sorted(self.elevation)
+        for values, table in ((self.curve.volume(levels), [0., 0., 100., 400.]),
+                              (self.curve.area(levels), [0., 5., 20., 30.])):
+            np.testing.assert_allclose(
+                values, [brute_interpolate(x, xp, table) for x in levels])
+
+    def test_level_takes_lowest_elevation(self):
+        volumes = [-1., 0., 50., 100., 250., 400., 401.]
+        np.testing.assert_allclose(
+            self.curve.level(volumes),
+            [np.nan, 600., 607.5, 610., 615., 620., np.nan])
+
+    def test_level_inverts_volume(self):
+        # Above the flat bottom every level is the lowest for its volume
+        levels = np.linspace(605.5, 620., 30)
+        np.testing.assert_allclose(
+            self.curve.level(self.curve.volume(levels)), levels)
+
+    def test_level_of_shipped_table(self):
+        # Buchanan's table has flat stretches above its bottom row
+        curve = get_curve('Buchanan Dam')
+        rng = np.random.RandomState(1)
+        volumes = np.concatenate([
+            rng.uniform(curve.volume_af[0], curve.volume_af[-1], 200),
+            curve.volume_af[::50], [curve.volume_af[-1]]])
+        np.testing.assert_allclose(
+            curve.level(volumes),
+            [brute_level(v, curve.elevation, curve.volume_af)
+             for v in volumes])
+
+    def test_needs_distinct_elevations(self):
+        self.assertRaises(ValueError, RatingCurve, [600.], [0.])
+        self.assertRaises(ValueError, RatingCurve, [600., 600.], [0., 1.])
+
+    def test_shipped_table(self):
+        curve = get_curve('3963')
+        self.assertIs(get_curve('Mansfield Dam'), curve)
+        rng = np.random.RandomState(0)
+        levels = rng.uniform(curve.elevation[0], curve.elevation[-1], 200)
+        np.testing.assert_allclose(
+            curve.volume(levels),
+            np.interp(levels, curve.elevation, curve.volume_af))
+        # Between two rows, not snapped to either
+        mid = (curve.elevation[100] + curve.elevation[101]) / 2
+        self.assertAlmostEqual(
+            curve.volume([mid])[0],
+            (curve.volume_af[100] + curve.volume_af[101]) / 2)
+
+    def test_convert_levels(self):
+        curve = get_curve('3963')
+        level = curve.elevation[50]
+        df = pd.DataFrame({'3963_max': [level, 2000.], 'other': [1., 2.]})
+        out = convert_levels(df)
+        self.assertEqual(out['3963_max'].iloc[0], curve.volume_af[50])
+        self.assertTrue(np.isnan(out['3963_max'].iloc[1]))
+        self.assertEqual(list(out['other']), [1., 2.])
+        self.assertEqual(df['3963_max'].iloc[0], level)
+
+
+if __name__ == '__main__':
+    unittest.main()
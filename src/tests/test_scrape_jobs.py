@@ -0,0 +1,92 @@
+"""find_history_start against a walk back one window at a time"""
+
+import unittest
+from datetime import date, timedelta
+
+from scrape_jobs import find_history_start, date_windows
+
+
+class History(object):
+    """has_data of a site whose readings run from first to last,
+    counting the requests made"""
+
+    def __init__(self, first, last, outages=()):
+        self.first = first
+        self.last = last
+        self.outages = outages
+        self.requests = 0
+
+    def __call__(self, start, end):
+        self.requests += 1
+        days = [start + timedelta(days=d)
+                for d in xrange((end - start).days + 1)]
+        return any(self.first <= day <= self.last and
+                   not any(lo <= day <= hi for lo, hi in self.outages)
+                   for day in days)
+
+
+def walk_back(has_data, start_date, end_date, days):
+    """Start of the oldest window reached walking back from end_date
+    until a window is empty"""
+    step = timedelta(days=days + 1)
+    oldest = max(end_date - timedelta(days=days), start_date)
+    k = 1
+    while end_date - k * step >= start_date:
+        end = end_date - k * step
+        start = max(end - timedelta(days=days), start_date)
+        if not has_data(start, end):
+            break
+        oldest = start
+        k += 1
+    return oldest
+
+
+class FindHistoryStartTest(unittest.TestCase):
+
+    START = date(2000, 1, 1)
+    END = date(2016, 6, 30)
+
+    def test_matches_walk_back(self):
+        for days in (179, 30, 7):
+            for offset in (0, 1, days, days + 1, 400, 2000, 4000, 6000,
+                           (self.END - self.START).days):
+                first = self.END - timedelta(days=offset)
+                history = History(first, self.END)
+                found = find_history_start(history, self.START, self.END,
+                                           days=days)
+                self.assertEqual(
+                    found, walk_back(history, self.START, self.END, days),
+                    (days, offset))
+                self.assertLessEqual(found, first)
+                self.assertGreater(found + timedelta(days=days + 1), first)
+
+    def test_history_before_start_date(self):
+        history = History(date(1990, 1, 1), self.END)
+        self.assertEqual(find_history_start(history, self.START, self.END),
+                         self.START)
+
+    def test_request_count(self):
+        history = History(date(2003, 3, 3), self.END)
+        find_history_start(history, self.START, self.END)
+        windows = len(date_windows(self.START, self.END))
+        # Two requests per probe at most, about 2 log2(n) probes
+        self.assertLess(history.requests, 4 * windows.bit_length())
+        self.assertLess(history.requests, windows)
+
+    def test_outage_at_window_end(self):
+        # The last 30 days of a window are empty, the window is not
+        first = date(2010, 1, 1)
+        end = self.END - timedelta(days=10 * 180)
+        history = History(first, self.END,
+                          outages=[(end - timedelta(days=40), end)])
+        self.assertEqual(find_history_start(history, self.START, self.END),
+                         walk_back(history, self.START, self.END, 179))
+
+    def test_single_window(self):
+        history = History(self.END, self.END)
+        start = self.END - timedelta(days=100)
+        self.assertEqual(find_history_start(history, start, self.END), start)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Moving sums and storm edges against brute force references"""
+
+import datetime
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from storm_pipeline import (create_moving_sum, stream_moving_sum,
+                            threshold_crossings, define_storm_events)
+
+
+def rain_frame(n=300, seed=0):
+    """Irregularly spaced rain readings with negative (bad) readings
+    and NaNs, in shuffled order"""
+    rng = np.random.RandomState(seed)
+    minutes = np.cumsum(rng.choice([15, 15, 30, 60, 180, 600], n))
+    times = pd.Timestamp('2012-01-01') + pd.to_timedelta(minutes, unit='m')
+    values = rng.choice([0., 0., 0., 0.01, 0.1, 0.5, 1.2, -1., np.nan], n)
+    order = rng.permutation(n)
+    return pd.DataFrame({'collection_time': times[order],
+                         'Rain (inches)': values[order]},
+                        columns=['collection_time', 'Rain (inches)'])
+
+
+def brute_moving_sum(df, leading_hours, trailing_hours):
+    """Sum of the rain (negative readings dropped) in
+    [t - trailing_hours, t + leading_hours] for each time, sorted"""
+    rows = sorted(zip(df['collection_time'], df['Rain (inches)']))
+    lead = datetime.timedelta(hours=leading_hours)
+    trail = datetime.timedelta(hours=trailing_hours)
+    sums = []
+    for time, _ in rows:
+        sums.append(sum(value for other, value in rows
+                        if time - trail <= other <= time + lead and
+                        value >= 0))
+    return np.array(sums)
+
+
+def brute_storms(values, threshold, keep_open=True):
+    """(start, end) rows of each run at or above threshold, walking
+    the rows one at a time. A run still going on the last row ends
+    there."""
+    storms = []
+    start = None
+    for i, value in enumerate(values):
+        if value >= threshold and start is None:
+            start = i
+        elif not value >= threshold and start is not None:
+            storms.append((start, i))
+            start = None
+    if start is not None:
+        if keep_open:
+            storms.append((start, len(values) - 1))
+    if not keep_open:
+        storms = [(start, end) for start, end in storms if start > 0]
+    return storms
+
+
+class MovingSumTest(unittest.TestCase):
+
+    def test_searchsorted_matches_brute_force(self):
+        df = rain_frame()
+        for leading, trailing in ((10, 24), (0, 0), (1, 0), (0, 5)):
+            expected = brute_moving_sum(df, leading, trailing)
+            sums = create_moving_sum(df.copy(), leading, trailing)
+            np.testing.assert_allclose(sums, expected, atol=1e-9)
+
+    def test_searchsorted_matches_iterrows(self):
+        df = rain_frame(n=120, seed=1)
+        sums = create_moving_sum(df.copy(), 10, 24)
+        original = create_moving_sum(df.copy(), 10, 24, engine='iterrows')
+        np.testing.assert_allclose(sums, original, atol=1e-9)
+
+    def test_window_edges_are_inclusive(self):
+        times = pd.to_datetime(['2012-01-01 00:00', '2012-01-01 02:00',
+                                '2012-01-01 03:00', '2012-01-01 05:00'])
+        df = pd.DataFrame({'collection_time': times,
+                           'Rain (inches)': [1., 2., 4., 8.]},
+                          columns=['collection_time', 'Rain (inches)'])
+        # 02:00 reaches back to 00:00 and forward to 05:00 exactly
+        sums = create_moving_sum(df, 3, 2)
+        np.testing.assert_allclose(sums, [7., 15., 14., 12.])
+
+    def test_empty_frame(self):
+        df = pd.DataFrame({'collection_time': pd.to_datetime([]),
+                           'Rain (inches)': np.array([], dtype=float)},
+                          columns=['collection_time', 'Rain (inches)'])
+        self.assertEqual(len(create_moving_sum(df, 10, 24)), 0)
+
+    def test_stream_matches_whole_frame(self):
+        df = rain_frame(seed=2)
+        df = df.sort_values('collection_time').reset_index(drop=True)
+        expected = brute_moving_sum(df, 10, 24)
+        for size in (1, 7, 50, len(df)):
+            chunks = [df.iloc[i:i + size] for i in xrange(0, len(df), size)]
+            streamed = pd.concat(list(stream_moving_sum(chunks, 10, 24)))
+            np.testing.assert_array_equal(streamed['collection_time'].values,
+                                          df['collection_time'].values)
+            np.testing.assert_allclose(streamed['moving_rain_sum'].values,
+                                       expected, atol=1e-9)
+
+
+class StormEdgeTest(unittest.TestCase):
+
+    CASES = [
+        [],
+        [0.],
+        [3.],
+        [0., 1., 0.],
+        [3., 3., 0., 0.],               # open at the start
+        [0., 0., 3., 3.],               # open at the end
+        [3., 0., 3.],                   # open at both ends
+        [3., 3., 3.],                   # one storm over the whole series
+        [0., 2., 0., 2., 2., 0., 5.],   # at the threshold counts
+        [0., 3., np.nan, 3., 0.],       # NaN ends a storm
+        [0., 2., 1.99, 0.],
+    ]
+
+    def test_cases_match_brute_force(self):
+        for values in self.CASES:
+            for keep_open in (True, False):
+                starts, ends = threshold_crossings(values, [2],
+                                                   keep_open=keep_open)[0]
+                self.assertEqual(zip(starts, ends),
+                                 brute_storms(values, 2, keep_open),
+                                 (values, keep_open))
+
+    def test_random_series_match_brute_force(self):
+        rng = np.random.RandomState(3)
+        thresholds = [0.5, 1., 2., 4.]
+        for _ in xrange(20):
+            values = rng.exponential(1.5, rng.randint(1, 80))
+            crossings = threshold_crossings(values, thresholds)
+            for threshold, (starts, ends) in zip(thresholds, crossings):
+                self.assertEqual(zip(starts, ends),
+                                 brute_storms(values, threshold))
+
+    def test_define_storm_events_edges(self):
+        times = pd.date_range('2012-01-01', periods=8, freq='H')
+        df = pd.DataFrame({'collection_time': times,
+                           'moving_rain_sum': [3., 0., 0., 3., 3., 0., 0., 3.]})
+        storms = [(times[0], times[1]), (times[3], times[5]),
+                  (times[7], times[7])]
+        self.assertEqual(define_storm_events(df, threshold=2), storms)
+        self.assertEqual(define_storm_events(df, threshold=2,
+                                             keep_open=False),
+                         storms[1:2])
+        # Out of order rows, times as the index
+        shuffled = df.iloc[[4, 0, 7, 2, 1, 6, 3, 5]].set_index(
+            'collection_time')
+        self.assertEqual(define_storm_events(shuffled, threshold=2), storms)
+
+    def test_define_storm_events_merge_and_duration(self):
+        times = pd.date_range('2012-01-01', periods=8, freq='H')
+        df = pd.DataFrame({'collection_time': times,
+                           'moving_rain_sum': [0., 3., 0., 3., 3., 0., 0., 0.]})
+        # Storms 01:00-02:00 and 03:00-05:00, an hour apart
+        self.assertEqual(define_storm_events(df, threshold=2,
+                                             merge_gap_hours=1),
+                         [(times[1], times[5])])
+        self.assertEqual(define_storm_events(df, threshold=2,
+                                             min_duration_hours=2),
+                         [(times[3], times[5])])
+        self.assertEqual(define_storm_events(df, threshold=10), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+"""SeriesIndex window aggregates against brute force references"""
+
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from window_index import SeriesIndex, BLOCK_SIZE
+
+
+def brute(times, values, starts, ends, how):
+    """np.nanmin/nanmax/nansum of the readings in each inclusive
+    window, NaN if the window has no reading"""
+    out = []
+    for start, end in zip(starts, ends):
+        inside = values[(times >= start) & (times <= end)]
+        inside = inside[~np.isnan(inside)]
+        out.append(how(inside) if inside.size else np.nan)
+    return np.array(out)
+
+
+def lake_series(n, seed=0):
+    """Lake levels every 15 minutes, with scattered NaNs, a NaN run
+    longer than a block and shuffled rows"""
+    rng = np.random.RandomState(seed)
+    times = (pd.Timestamp('2012-01-01') +
+             pd.to_timedelta(np.arange(n) * 15, unit='m')).values
+    values = 681. + np.cumsum(rng.normal(0, 0.05, n))
+    values[rng.rand(n) < 0.1] = np.nan
+    values[BLOCK_SIZE + 10:3 * BLOCK_SIZE] = np.nan
+    order = rng.permutation(n)
+    return times[order], values[order]
+
+
+def windows(times, rng, count=300):
+    """Windows of every kind: empty, between readings, inside one
+    block, across blocks, past either end of the series"""
+    first, last = times.min(), times.max()
+    step = np.timedelta64(15, 'm')
+    starts = [first - step, first, last, last + step, first + step // 2,
+              first + 5 * step]
+    ends = [first - step // 2, last, last, last + 2 * step,
+            first + step // 2, first - step]
+    span = int((last - first) // step)
+    for _ in xrange(count):
+        start = rng.randint(-3, span + 3)
+        length = rng.choice([0, 1, 5, BLOCK_SIZE - 1, BLOCK_SIZE,
+                             BLOCK_SIZE + 1, 3 * BLOCK_SIZE,
+                             rng.randint(0, span + 1)])
+        starts.append(first + start * step)
+        ends.append(first + (start + length) * step)
+    return np.array(starts), np.array(ends)
+
+
+class SeriesIndexTest(unittest.TestCase):
+
+    def check(self, times, values, starts, ends):
+        index = SeriesIndex(times, values)
+        for name, how in (('min', np.min), ('max', np.max),
+                          ('sum', np.sum)):
+            np.testing.assert_allclose(
+                getattr(index, name)(starts, ends),
+                brute(times, values, starts, ends, how),
+                err_msg=name)
+        np.testing.assert_array_equal(
+            index.count(starts, ends),
+            [np.count_nonzero((times >= start) & (times <= end) &
+                              ~np.isnan(values))
+             for start, end in zip(starts, ends)])
+
+    def test_many_blocks(self):
+        rng = np.random.RandomState(1)
+        times, values = lake_series(20 * BLOCK_SIZE + 7)
+        self.check(times, values, *windows(times, rng))
+
+    def test_every_window_of_three_blocks(self):
+        times, values = lake_series(3 * BLOCK_SIZE, seed=4)
+        ordered = np.sort(times)
+        lo, hi = np.triu_indices(ordered.shape[0])
+        self.check(times, values, ordered[lo], ordered[hi])
+
+    def test_shorter_than_a_block(self):
+        rng = np.random.RandomState(2)
+        times, values = lake_series(BLOCK_SIZE // 2, seed=2)
+        self.check(times, values, *windows(times, rng, count=50))
+
+    def test_whole_blocks(self):
+        rng = np.random.RandomState(3)
+        times, values = lake_series(4 * BLOCK_SIZE, seed=3)
+        self.check(times, values, *windows(times, rng, count=100))
+
+    def test_all_nan(self):
+        times = (pd.Timestamp('2012-01-01') +
+                 pd.to_timedelta(np.arange(200), unit='h')).values
+        values = np.full(200, np.nan)
+        index = SeriesIndex(times, values)
+        starts, ends = times[[0, 10, 0]], times[[199, 12, 0]]
+        for result in (index.min(starts, ends), index.max(starts, ends),
+                       index.sum(starts, ends)):
+            self.assertTrue(np.isnan(result).all())
+
+    def test_empty_series(self):
+        index = SeriesIndex(np.array([], dtype='datetime64[ns]'), [])
+        starts = pd.to_datetime(['2012-01-01'])
+        ends = pd.to_datetime(['2012-02-01'])
+        self.assertTrue(np.isnan(index.min(starts, ends)).all())
+        self.assertTrue(np.isnan(index.max(starts, ends)).all())
+        self.assertEqual(list(index.count(starts, ends)), [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
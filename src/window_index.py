@@ -0,0 +1,298 @@
+"""In-process index for window aggregates over hydromet series.
+
+Answers "total rain at gauge X between t0 and t1" and "lake min/max
+in a window" without touching the database once the extract is
+loaded. Every (gauge, sensor) series keeps its sorted times, prefix
+sums for O(log n) range sums (the log is the binary search for the
+window edges) and, built on first use, block tables for range
+min/max in O(n) memory. Queries take arrays of windows and are
+answered in a few vectorized passes.
+
+Windows are inclusive on both ends like the BETWEEN/tsrange '[]'
+storm queries, and an empty window gives NaN like SQL's NULL.
+
+    index = WindowIndex.from_database(md, gauges=['4594', '3963'])
+    rain = index.window_sum('4594', RAIN_SENSOR, starts, ends)
+    low, high = index.window_min_max('3963', LAKE_SENSOR, starts, ends)
+"""
+
+import numpy as np
+import pandas as pd
+
+
+RAIN_SENSOR = 'Rain (inches)'
+LAKE_SENSOR = 'Lake Level (ft above MSL)'
+
+# Readings per block of the min/max tables
+BLOCK_SIZE = 64
+
+
+class SeriesIndex(object):
+    """
+    Window aggregates for one gauge/sensor series
+    """
+
+    def __init__(self, times, values):
+        times = np.asarray(times, dtype='datetime64[ns]')
+        values = np.asarray(values, dtype=np.float64)
+        order = np.argsort(times, kind='mergesort')
+        self.times = times[order]
+        self.values = values[order]
+
+        known = ~np.isnan(self.values)
+        self.prefix_sum = np.concatenate(
+            [[0.], np.cumsum(np.where(known, self.values, 0.))])
+        self.prefix_count = np.concatenate(
+            [[0], np.cumsum(known, dtype=np.int64)])
+        self._min_table = None
+        self._max_table = None
+
+
+    def bounds(self, starts, ends):
+        """Row range [lo, hi) of each inclusive window"""
+        starts = np.asarray(pd.to_datetime(starts).values)
+        ends = np.asarray(pd.to_datetime(ends).values)
+        lo = np.searchsorted(self.times, starts, side='left')
+        hi = np.searchsorted(self.times, ends, side='right')
+        return lo, np.maximum(hi, lo)
+
+
+    def count(self, starts, ends):
+        """Readings (not NULL) in each window"""
+        lo, hi = self.bounds(starts, ends)
+        return self.prefix_count[hi] - self.prefix_count[lo]
+
+
+    def sum(self, starts, ends):
+        """Sum of readings in each window, NaN if there are none"""
+        lo, hi = self.bounds(starts, ends)
+        total = self.prefix_sum[hi] - self.prefix_sum[lo]
+        count = self.prefix_count[hi] - self.prefix_count[lo]
+        return np.where(count > 0, total, np.nan)
+
+
+    def min(self, starts, ends):
+        if self._min_table is None:
+            self._min_table = _block_table(self.values, np.fmin)
+        return _range_query(self._min_table, np.fmin,
+                            *self.bounds(starts, ends))
+
+
+    def max(self, starts, ends):
+        if self._max_table is None:
+            self._max_table = _block_table(self.values, np.fmax)
+        return _range_query(self._max_table, np.fmax,
+                            *self.bounds(starts, ends))
+
+
+class WindowIndex(object):
+    """
+    SeriesIndex for every (gauge, sensor) of a hydromet extract
+    """
+
+    def __init__(self):
+        self.series = {}
+
+
+    @classmethod
+    def from_frame(cls, df):
+        """Builds from a frame with collection_time, gauge, sensor and
+        value columns"""
+        index = cls()
+        for (gauge, sensor), group in df.groupby(['gauge', 'sensor']):
+            index.add_series(gauge, sensor, group['collection_time'].values,
+                             group['value'].values)
+        return index
+
+
+    @classmethod
+    def from_database(cls, md, gauges=None,
+                      sensors=(RAIN_SENSOR, LAKE_SENSOR),
+                      start_time=None, end_time=None, itersize=100000):
+        """Builds from hydromet, streamed so only arrays are held
+
+        INPUT:
+            ManipulateDatabase
+            gauges              | gauge ids, None for all
+            sensors             | sensors to load
+            start_time/end_time | limit the extract to a time range
+        """
+        q = '''SELECT gauge, sensor, collection_time, value
+               FROM hydromet
+               WHERE sensor = ANY(%(sensors)s)
+                 AND (%(gauges)s::text[] IS NULL OR
+                      gauge = ANY(%(gauges)s))
+                 AND (%(start)s::timestamp IS NULL OR
+                      collection_time >= %(start)s)
+                 AND (%(end)s::timestamp IS NULL OR
+                      collection_time <= %(end)s)
+               ORDER BY gauge, sensor, collection_time'''
+        params = {'sensors': list(sensors),
+                  'gauges': None if gauges is None
+                            else [str(gauge) for gauge in gauges],
+                  'start': start_time,
+                  'end': end_time}
+
+        index = cls()
+        parts = {}
+        # Names as categoricals, a few codes instead of a string
+        # object per row
+        for chunk in md.iter_query(q, params,
+                                   columns=['gauge', 'sensor',
+                                            'collection_time', 'value'],
+                                   dtypes={'gauge': 'category',
+                                           'sensor': 'category',
+                                           'value': np.float64},
+                                   itersize=itersize,
+                                   name='sql.window_index'):
+            for key, group in chunk.groupby(['gauge', 'sensor'], sort=False,
+                                            observed=True):
+                parts.setdefault(key, []).append(
+                    (group['collection_time'].values, group['value'].values))
+        for (gauge, sensor), pieces in parts.items():
+            index.add_series(gauge, sensor,
+                             np.concatenate([t for t, _ in pieces]),
+                             np.concatenate([v for _, v in pieces]))
+        return index
+
+
+    def add_series(self, gauge, sensor, times, values):
+        self.series[(str(gauge), sensor)] = SeriesIndex(times, values)
+
+
+    def window_sum(self, gauge, sensor, starts, ends):
+        return self._query(gauge, sensor, 'sum', starts, ends)
+
+
+    def window_count(self, gauge, sensor, starts, ends):
+        series = self.series.get((str(gauge), sensor))
+        if series is None:
+            return np.zeros(len(starts), dtype=np.int64)
+        return series.count(starts, ends)
+
+
+    def window_min_max(self, gauge, sensor, starts, ends):
+        return (self._query(gauge, sensor, 'min', starts, ends),
+                self._query(gauge, sensor, 'max', starts, ends))
+
+
+    def storm_aggregates(self, stormlist, rain_gauges, lake_gauges):
+        """ManipulateDatabase.get_storm_aggregates from the index
+
+        OUTPUT:
+            list    | [(storm index, gauge, rain sum), ...]
+            list    | [(storm index, gauge, lake min, lake max), ...]
+
+        Gauges with no readings in a storm are left out, as the SQL
+        join leaves them out
+        """
+        starts = [start for start, _ in stormlist]
+        ends = [end for _, end in stormlist]
+
+        raindata = []
+        for gauge in rain_gauges:
+            total = self.window_sum(gauge, RAIN_SENSOR, starts, ends)
+            raindata.extend((i, str(gauge), total[i])
+                            for i in np.flatnonzero(~np.isnan(total)))
+
+        lakedata = []
+        for gauge in lake_gauges:
+            low, high = self.window_min_max(gauge, LAKE_SENSOR, starts, ends)
+            lakedata.extend((i, str(gauge), low[i], high[i])
+                            for i in np.flatnonzero(~np.isnan(low)))
+        return raindata, lakedata
+
+
+    def _query(self, gauge, sensor, how, starts, ends):
+        series = self.series.get((str(gauge), sensor))
+        if series is None:
+            return np.full(len(starts), np.nan)
+        return getattr(series, how)(starts, ends)
+
+
+def _block_table(values, combine):
+    """Range min/max tables of values in BLOCK_SIZE blocks
+
+    OUTPUT:
+        tuple   | (values, prefix, suffix, levels): combine over each
+                  block up to and from every position, and a sparse
+                  table over the combines of whole blocks. 2n entries
+                  plus n / BLOCK_SIZE * log2(n / BLOCK_SIZE) for the
+                  sparse table, below n for any realistic n.
+    """
+    n = values.shape[0]
+    n_blocks = -(-n // BLOCK_SIZE)
+    # NaN padding, ignored by fmin/fmax like missing readings
+    blocks = np.full(n_blocks * BLOCK_SIZE, np.nan)
+    blocks[:n] = values
+    blocks = blocks.reshape(n_blocks, BLOCK_SIZE)
+    prefix = combine.accumulate(blocks, axis=1)
+    suffix = combine.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+    levels = _sparse_table(prefix[:, -1].copy(), combine)
+    return values, prefix.ravel(), suffix.ravel(), levels
+
+
+def _range_query(table, combine, lo, hi):
+    """combine over values[lo:hi] for every window, NaN if empty
+
+    A window across blocks takes the suffix of its first block, the
+    prefix of its last block and the sparse table for the whole
+    blocks in between. A window inside one block is scanned, at most
+    BLOCK_SIZE readings.
+    """
+    values, prefix, suffix, levels = table
+    out = np.full(lo.shape[0], np.nan)
+    nonempty = hi > lo
+    last = np.where(nonempty, hi - 1, lo)
+    first_block = lo // BLOCK_SIZE
+    last_block = last // BLOCK_SIZE
+
+    rows = np.flatnonzero(nonempty & (first_block != last_block))
+    out[rows] = combine(suffix[lo[rows]], prefix[last[rows]])
+    rows = rows[last_block[rows] - first_block[rows] > 1]
+    out[rows] = combine(out[rows],
+                        _sparse_query(levels, combine,
+                                      first_block[rows] + 1,
+                                      last_block[rows]))
+
+    rows = np.flatnonzero(nonempty & (first_block == last_block))
+    if rows.size:
+        start = lo[rows]
+        length = hi[rows] - start
+        scanned = values[start]
+        for offset in xrange(1, length.max()):
+            more = np.flatnonzero(length > offset)
+            scanned[more] = combine(scanned[more],
+                                    values[start[more] + offset])
+        out[rows] = scanned
+    return out
+
+
+def _sparse_table(values, combine):
+    """levels[k][i] = combine over values[i:i + 2**k]"""
+    levels = [values]
+    width = 1
+    while width * 2 <= values.shape[0]:
+        previous = levels[-1]
+        levels.append(combine(previous[:-width], previous[width:]))
+        width *= 2
+    return levels
+
+
+def _sparse_query(levels, combine, lo, hi):
+    """combine over values[lo:hi] for every window, NaN if empty.
+    Two overlapping power of two blocks cover each window."""
+    out = np.full(lo.shape[0], np.nan)
+    length = hi - lo
+    nonempty = length > 0
+    k = np.zeros(lo.shape[0], dtype=np.int64)
+    k[nonempty] = np.floor(np.log2(length[nonempty])).astype(np.int64)
+    # Float log2 can land one off at exact powers of two
+    k[nonempty & (2 ** (k + 1) <= length)] += 1
+    k[nonempty & (2 ** k > length)] -= 1
+
+    for level in np.unique(k[nonempty]):
+        rows = np.flatnonzero(nonempty & (k == level))
+        table = levels[level]
+        out[rows] = combine(table[lo[rows]], table[hi[rows] - 2 ** level])
+    return out